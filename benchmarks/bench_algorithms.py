@@ -0,0 +1,68 @@
+from __future__ import print_function, division
+
+import sympy
+from discretizer.algorithms import discretize
+from discretizer.algorithms import extract_hoppings
+from discretizer.algorithms import _discretize_summand
+from discretizer.algorithms import wavefunction_name
+from discretizer.postprocessing import offset_to_direction
+from discretizer.interpolation import interpolate_tb_hamiltonian
+
+from .models import cases, make_model
+
+
+class TimeDiscretize(object):
+    params = [cases, [False, True]]
+    param_names = ['model', 'position_dependent']
+    timeout = 300
+
+    def setup(self, case, position_dependent):
+        self.hamiltonian, self.discrete_coordinates = \
+            make_model(case, position_dependent)
+
+    def time_discretize(self, case, position_dependent):
+        discretize(self.hamiltonian, self.discrete_coordinates)
+
+
+class TimeExtractHoppings(object):
+    params = [cases, [False, True]]
+    param_names = ['model', 'position_dependent']
+    timeout = 300
+
+    def setup(self, case, position_dependent):
+        hamiltonian, discrete_coordinates = make_model(case, position_dependent)
+        elements = hamiltonian if isinstance(hamiltonian, sympy.MatrixBase) \
+            else [hamiltonian]
+
+        names = sorted(discrete_coordinates)
+        coordinates = [sympy.Symbol(c, commutative=False) for c in names]
+        wf = sympy.Function(wavefunction_name)(*coordinates)
+
+        self.discrete_coordinates = discrete_coordinates
+        self.summands = []
+        for element in elements:
+            expression = sympy.expand(element * wf)
+            if expression == 0:
+                continue
+            summands = expression.args if expression.func == sympy.Add \
+                else [expression]
+            self.summands.extend(_discretize_summand(s, discrete_coordinates)
+                                 for s in summands)
+
+    def time_extract_hoppings(self, case, position_dependent):
+        for summand in self.summands:
+            extract_hoppings(summand, self.discrete_coordinates)
+
+
+class TimeInterpolate(object):
+    params = [cases]
+    param_names = ['model']
+    timeout = 300
+
+    def setup(self, case):
+        hamiltonian, discrete_coordinates = make_model(case, True)
+        tb_ham = discretize(hamiltonian, discrete_coordinates)
+        self.tb_ham = offset_to_direction(tb_ham, discrete_coordinates)
+
+    def time_interpolate_tb_hamiltonian(self, case):
+        interpolate_tb_hamiltonian(self.tb_ham)
@@ -0,0 +1,79 @@
+from __future__ import print_function, division
+
+from types import SimpleNamespace
+
+import numpy as np
+import sympy
+from sympy.core.function import AppliedUndef
+from discretizer import Discretizer
+
+from .models import cases, make_model
+
+
+# number of sites along every direction of the built systems
+system_size = {1: 1000, 2: 40, 3: 12}
+
+
+def _parameters(hamiltonian):
+    """Parameters with arbitrary values for all symbols of a model."""
+    hamiltonian = sympy.sympify(hamiltonian)
+    values = {}
+    for function in hamiltonian.atoms(AppliedUndef):
+        values[function.func.__name__] = \
+            lambda *xs: 1 + 0.1 * np.cos(xs[0])
+    for symbol in hamiltonian.free_symbols:
+        if symbol.name not in ('x', 'y', 'z'):
+            values[symbol.name] = 0.5
+    return SimpleNamespace(**values)
+
+
+def _box(dim):
+    size = system_size[dim]
+    return lambda pos: all(0 <= r < size for r in pos), (0,) * dim
+
+
+class TimeDiscretizer(object):
+    params = [cases, [False, True]]
+    param_names = ['model', 'position_dependent']
+    timeout = 300
+
+    def setup(self, case, position_dependent):
+        self.hamiltonian, self.discrete_coordinates = \
+            make_model(case, position_dependent)
+
+    def time_discretizer(self, case, position_dependent):
+        Discretizer(self.hamiltonian, self.discrete_coordinates)
+
+    def time_discretizer_interpolate(self, case, position_dependent):
+        Discretizer(self.hamiltonian, self.discrete_coordinates,
+                    interpolate=True)
+
+
+class TimeBuild(object):
+    params = [cases, [False, True]]
+    param_names = ['model', 'position_dependent']
+    timeout = 300
+
+    def setup(self, case, position_dependent):
+        try:
+            import kwant
+        except ImportError:
+            raise NotImplementedError('Kwant is not available.')
+
+        hamiltonian, discrete_coordinates = make_model(case, position_dependent)
+        self.discretizer = Discretizer(hamiltonian, discrete_coordinates)
+        self.shape, self.start = _box(len(discrete_coordinates))
+        self.p = _parameters(hamiltonian)
+        self.system = self.discretizer.build(self.shape, self.start).finalized()
+
+    def time_build(self, case, position_dependent):
+        self.discretizer.build(self.shape, self.start)
+
+    def time_build_finalized(self, case, position_dependent):
+        self.discretizer.build(self.shape, self.start).finalized()
+
+    def time_hamiltonian_submatrix(self, case, position_dependent):
+        self.system.hamiltonian_submatrix(args=[self.p], sparse=True)
+
+    def time_assemble(self, case, position_dependent):
+        self.discretizer.assemble(self.shape, self.start, self.p)
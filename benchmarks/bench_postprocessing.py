@@ -0,0 +1,27 @@
+from __future__ import print_function, division
+
+import sympy
+from discretizer.algorithms import discretize
+from discretizer.postprocessing import offset_to_direction
+from discretizer.postprocessing import make_kwant_functions
+
+from .models import cases, make_model
+
+
+class TimeMakeKwantFunctions(object):
+    params = [cases, [False, True], [False, True]]
+    param_names = ['model', 'position_dependent', 'vectorized']
+    timeout = 300
+
+    def setup(self, case, position_dependent, vectorized):
+        hamiltonian, discrete_coordinates = make_model(case, position_dependent)
+        tb_ham = discretize(hamiltonian, discrete_coordinates)
+        tb_ham = offset_to_direction(tb_ham, discrete_coordinates)
+
+        self.discrete_coordinates = discrete_coordinates
+        self.tb_ham = {k: v.subs(sympy.Symbol('a'), 1)
+                       for k, v in tb_ham.items()}
+
+    def time_make_kwant_functions(self, case, position_dependent, vectorized):
+        make_kwant_functions(self.tb_ham, self.discrete_coordinates,
+                             vectorized=vectorized)
@@ -0,0 +1,163 @@
+"""Continuum models used by the benchmarks.
+
+Every model is a function ``model(dim, position_dependent)`` returning
+the symbolic Hamiltonian and its discrete coordinates. If
+``position_dependent`` is True, material parameters are functions of
+position and enter the Hamiltonian in a symmetrized (hermitian) order.
+"""
+from __future__ import print_function, division
+
+import sympy
+from discretizer import momentum_operators, coordinates
+
+
+I = sympy.I
+kx, ky, kz = momentum_operators
+x, y, z = coordinates
+
+s0 = sympy.eye(2)
+sx = sympy.Matrix([[0, 1], [1, 0]])
+sy = sympy.Matrix([[0, -I], [I, 0]])
+sz = sympy.Matrix([[1, 0], [0, -1]])
+
+
+def _coordinates(dim):
+    names = ['x', 'y', 'z'][:dim]
+    return set(names), list(momentum_operators[:dim]), list(coordinates[:dim])
+
+
+def _parameter(name, position_dependent, args):
+    if position_dependent:
+        return sympy.Function(name)(*args)
+    return sympy.Symbol(name)
+
+
+def _sandwich(k1, parameter, k2):
+    """Hermitian product ``(k1 P k2 + k2 P k1) / 2``."""
+    return (k1 * parameter * k2 + k2 * parameter * k1) / 2
+
+
+def _kron(a, b):
+    return sympy.Matrix(a.rows * b.rows, a.cols * b.cols,
+                        lambda i, j: a[i // b.rows, j // b.cols] *
+                                     b[i % b.rows, j % b.cols])
+
+
+def laplacian(dim, position_dependent):
+    """Scalar Laplacian with a potential, ``k A k + V``."""
+    discrete_coordinates, ks, xs = _coordinates(dim)
+    A = _parameter('A', position_dependent, xs)
+    V = _parameter('V', position_dependent, xs)
+    return sum(_sandwich(k, A, k) for k in ks) + V, discrete_coordinates
+
+
+def rashba(dim, position_dependent):
+    """Rashba wire (1D) or 2D electron gas in a Zeeman field."""
+    discrete_coordinates, ks, xs = _coordinates(dim)
+    A = _parameter('A', position_dependent, xs)
+    V = _parameter('V', position_dependent, xs)
+    alpha, B = sympy.symbols('alpha B')
+
+    hamiltonian = sum(_sandwich(k, A, k) for k in ks) * s0 + V * s0
+    hamiltonian += alpha * ks[0] * sy + B * sx
+    if dim > 1:
+        hamiltonian -= alpha * ks[1] * sx
+    return hamiltonian, discrete_coordinates
+
+
+def bhz(dim, position_dependent):
+    """Bernevig-Hughes-Zhang model of a quantum well (2D)."""
+    discrete_coordinates, ks, xs = _coordinates(dim)
+    C = _parameter('C', position_dependent, xs)
+    M = _parameter('M', position_dependent, xs)
+    A, B, D = sympy.symbols('A B D')
+
+    k2 = sum(k**2 for k in ks)
+    upper = sympy.Matrix([
+        [C + M - (D + B) * k2, A * (ks[0] + I * ks[1])],
+        [A * (ks[0] - I * ks[1]), C - M - (D - B) * k2],
+    ])
+    lower = sympy.Matrix([
+        [C + M - (D + B) * k2, -A * (ks[0] - I * ks[1])],
+        [-A * (ks[0] + I * ks[1]), C - M - (D - B) * k2],
+    ])
+    zero = sympy.zeros(2, 2)
+    hamiltonian = upper.row_join(zero).col_join(zero.row_join(lower))
+    return hamiltonian, discrete_coordinates
+
+
+def _valence_band(dim, position_dependent):
+    """Three band valence Hamiltonian in the basis of p-orbitals."""
+    discrete_coordinates, ks, xs = _coordinates(dim)
+    ks = ks + [0] * (3 - dim)
+    L = _parameter('L', position_dependent, xs)
+    M = _parameter('M', position_dependent, xs)
+    N = _parameter('N', position_dependent, xs)
+    Ev = _parameter('E_v', position_dependent, xs)
+
+    def element(i, j):
+        if i == j:
+            value = _sandwich(ks[i], L, ks[i]) + Ev
+            value += sum(_sandwich(ks[m], M, ks[m]) for m in range(3) if m != i)
+            return value
+        return _sandwich(ks[i], N, ks[j])
+
+    return sympy.Matrix(3, 3, element)
+
+
+def luttinger(dim, position_dependent):
+    """Six band Luttinger-Kohn model of the valence band."""
+    discrete_coordinates, _, _ = _coordinates(dim)
+    delta = sympy.Symbol('Delta')
+
+    angular_momentum = [sympy.Matrix(3, 3, lambda j, k: -I * sympy.LeviCivita(i, j, k))
+                        for i in range(3)]
+    spin_orbit = sum((_kron(l, s) for l, s in
+                      zip(angular_momentum, [sx, sy, sz])), sympy.zeros(6, 6))
+
+    hamiltonian = _kron(_valence_band(dim, position_dependent), s0)
+    return hamiltonian + delta / 3 * spin_orbit, discrete_coordinates
+
+
+def kane(dim, position_dependent):
+    """Eight band Kane model, conduction band coupled to ``luttinger``."""
+    discrete_coordinates, ks, xs = _coordinates(dim)
+    ks = ks + [0] * (3 - dim)
+    Ac = _parameter('A_c', position_dependent, xs)
+    Ec = _parameter('E_c', position_dependent, xs)
+    P = sympy.Symbol('P')
+
+    valence, _ = luttinger(dim, position_dependent)
+    conduction = (sum(_sandwich(k, Ac, k) for k in ks) + Ec) * s0
+    coupling = _kron(sympy.Matrix([[I * P * k for k in ks]]), s0)
+
+    upper = conduction.row_join(coupling)
+    lower = coupling.T.subs(I, -I).row_join(valence)
+    return upper.col_join(lower), discrete_coordinates
+
+
+models = {
+    'laplacian': laplacian,
+    'rashba': rashba,
+    'bhz': bhz,
+    'luttinger': luttinger,
+    'kane': kane,
+}
+
+# dimensions in which every model is benchmarked
+dimensions = {
+    'laplacian': [1, 2, 3],
+    'rashba': [1, 2],
+    'bhz': [2],
+    'luttinger': [1, 3],
+    'kane': [1, 3],
+}
+
+cases = ['{}-{}d'.format(name, dim)
+         for name in sorted(models) for dim in dimensions[name]]
+
+
+def make_model(case, position_dependent):
+    """Return hamiltonian and discrete coordinates of a benchmark case."""
+    name, dim = case.split('-')
+    return models[name](int(dim[:-1]), position_dependent)
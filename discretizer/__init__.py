@@ -1,10 +1,34 @@
-__all__ = ['algorithms']
+import importlib
 
+__all__ = ['algorithms']
 
-from.discretizer import Discretizer
-import sympy
 
 __version__ = '0.4.1'
 
-momentum_operators = sympy.symbols('k_x k_y k_z', commutative=False)
-coordinates = sympy.symbols('x y z', commutative=False)
+_submodules = ('algorithms', 'postprocessing', 'interpolation', 'assembly',
+               'cache', 'functions', 'model', 'profiling')
+
+
+def __getattr__(name):
+    # Heavy modules (sympy, kwant) are imported only on first use, such that
+    # ``import discretizer`` is cheap and models loaded with
+    # ``DiscreteModel.from_cache`` never import sympy.
+    if name == 'Discretizer':
+        from .discretizer import Discretizer
+        return Discretizer
+    if name == 'DiscreteModel':
+        from .model import DiscreteModel
+        return DiscreteModel
+    if name == 'GridParameter':
+        from .functions import GridParameter
+        return GridParameter
+    if name in ('momentum_operators', 'coordinates'):
+        import sympy
+        globals().update(
+            momentum_operators=sympy.symbols('k_x k_y k_z', commutative=False),
+            coordinates=sympy.symbols('x y z', commutative=False))
+        return globals()[name]
+    if name in _submodules:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__,
+                                                                   name))
@@ -1,26 +1,66 @@
 from __future__ import print_function, division
 
+import time
+import numbers
+import functools
 import itertools
+import multiprocessing
 import sympy
 import numpy as np
 from collections import defaultdict
+from collections import OrderedDict
 
-from .postprocessing import make_kwant_functions
-from .postprocessing import offset_to_direction
-
-from .interpolation import interpolate_tb_hamiltonian
-
-try:
-    # normal situation
-    from kwant.lattice import Monatomic
-except ImportError:
-    # probably run on gitlab-ci
-    pass
+from .profiling import ElementStats
+from .profiling import expression_size
 
 # ************************** Some globals *********************************
 wavefunction_name = 'Psi'
 
 
+class ExpressionMemo(object):
+    """Bounded memo of intermediate results of the discretization.
+
+    Discretization of many matrix elements (or many summands) repeatedly
+    derivates identical sub-expressions. Results are stored under keys built
+    from the expression, the operator and the discrete coordinates; when
+    ``maxsize`` is exceeded the least recently used results are dropped.
+
+    Parameters:
+    -----------
+    maxsize : int
+        Maximal number of stored results. Default is 4096.
+    """
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Return result stored under ``key`` or None if there is none."""
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Store ``value`` under ``key``."""
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
 # **************** Operation on sympy expressions **************************
 def read_coordinates(expression):
     """Read coordinates used in expression.
@@ -119,7 +159,108 @@ def split_factors(expression, discrete_coordinates):
     return output
 
 
-def derivate(expression, operator):
+@functools.lru_cache()
+def stencil(accuracy_order=2):
+    """Staggered stencil of the first derivative.
+
+    The derivative is ``f'(x) = sum_j w_j f(x + m_j*h) / (2*h)`` with odd
+    integers ``m_j``, i.e. the stencil uses half-integer points of a grid
+    with spacing ``2*h``. The stencil of order 2 is the central difference
+    ``(f(x+h) - f(x-h)) / (2*h)``.
+
+    Parameters:
+    -----------
+    accuracy_order : int
+        Order of the approximation, a positive even integer.
+
+    Returns:
+    --------
+    stencil : tuple
+        Tuple of ``(m_j, w_j)`` pairs with integer ``m_j`` and rational
+        weights ``w_j``.
+    """
+    if accuracy_order < 2 or accuracy_order % 2:
+        msg = 'Accuracy order must be a positive even integer, not {}.'
+        raise ValueError(msg.format(accuracy_order))
+
+    n = accuracy_order // 2
+    points = [sympy.Rational(2*j - 1, 2) for j in range(-n + 1, n + 1)]
+    weights = sympy.finite_diff_weights(1, points, 0)[1][-1]
+    return tuple((int(2*p), w) for p, w in zip(points, weights))
+
+
+@functools.lru_cache()
+def centred_stencil(derivative, accuracy_order=2):
+    """Centred stencil of a derivative of higher order.
+
+    The derivative is ``f^(n)(x) = sum_j w_j f(x + m_j*h) / (2*h)**n`` with
+    even integers ``m_j``, i.e. the stencil uses the points of a grid with
+    spacing ``2*h``, as the composition of staggered stencils of ``stencil``
+    does. For ``derivative=2`` and ``accuracy_order=2`` both are equal.
+
+    Parameters:
+    -----------
+    derivative : int
+        Order ``n`` of the derivative, a positive integer.
+    accuracy_order : int
+        Order of the approximation, a positive even integer.
+
+    Returns:
+    --------
+    stencil : tuple
+        Tuple of ``(m_j, w_j)`` pairs with integer ``m_j`` and nonzero
+        rational weights ``w_j``.
+    """
+    if accuracy_order < 2 or accuracy_order % 2:
+        msg = 'Accuracy order must be a positive even integer, not {}.'
+        raise ValueError(msg.format(accuracy_order))
+    if derivative < 1:
+        msg = 'Order of the derivative must be a positive integer, not {}.'
+        raise ValueError(msg.format(derivative))
+
+    n = (derivative + 1) // 2 - 1 + accuracy_order // 2
+    points = list(range(-n, n + 1))
+    weights = sympy.finite_diff_weights(derivative, points, 0)[-1][-1]
+    return tuple((2*p, w) for p, w in zip(points, weights) if w != 0)
+
+
+def _centred_coordinates(summand, discrete_coordinates, accuracy_order):
+    """Coordinates with centred stencils in a summand.
+
+    For ``accuracy_order`` above 2 a momentum operator ``k_i**n`` that is
+    the only factor of the summand with ``k_i`` is approximated with the
+    centred stencil of the ``n``-th derivative, which has a shorter range
+    than the composition of ``n`` staggered stencils. Operators ``k_i`` in
+    several factors, e.g. ``k_x * A(x) * k_x``, keep the staggered stencils,
+    such that parameters between them are evaluated at midpoints.
+    """
+    if accuracy_order == 2:
+        return frozenset()
+    momenta = _momentum_operators(discrete_coordinates)
+    factors = summand.args if isinstance(summand, sympy.Mul) else [summand]
+    counts = defaultdict(int)
+    for factor in factors:
+        base = factor.base if isinstance(factor, sympy.Pow) else factor
+        if base in momenta:
+            counts[momenta[base]] += 1
+    return frozenset(c for c, n in counts.items() if n == 1)
+
+
+def _split_power(lhs, operator):
+    """Split powers of ``operator`` from the right end of ``lhs``.
+
+    Returns the number of split operators and the rest of ``lhs``.
+    """
+    factors = list(lhs.args) if isinstance(lhs, sympy.Mul) else [lhs]
+    last = factors[-1]
+    if last == operator:
+        return 1, sympy.Mul(*factors[:-1])
+    if isinstance(last, sympy.Pow) and last.base == operator:
+        return int(last.exp), sympy.Mul(*factors[:-1])
+    return 0, lhs
+
+
+def derivate(expression, operator, memo=None, accuracy_order=2, power=None):
     """ Calculate derivate of expression for given momentum operator:
 
     Parameters:
@@ -128,6 +269,14 @@ def derivate(expression, operator):
         Sympy expression containing functions to to be derivated.
     operator : sympy.Symbol
         Sympy symbol representing momentum operator.
+    memo : ExpressionMemo instance
+        If provided, results are looked up in and stored to ``memo``.
+    accuracy_order : int
+        Order of the finite difference, see ``stencil``. Default is 2.
+    power : int
+        If provided, ``operator**power`` is applied with the centred stencil
+        of ``centred_stencil``. Otherwise ``operator`` is applied with the
+        staggered stencil.
 
     Returns:
     --------
@@ -142,24 +291,56 @@ def derivate(expression, operator):
 
     if isinstance(expression, (int, float, sympy.Symbol)):
         return 0
+
+    if memo is not None:
+        key = ('derivate', expression, operator, accuracy_order, power)
+        output = memo.get(key)
+        if output is not None:
+            return output
+
+    coordinate_name = operator.name.split('_')[1]
+    ct = sympy.Symbol(coordinate_name, commutative=True)
+    cf = sympy.Symbol(coordinate_name, commutative=False)
+    h = sympy.Symbol('a_'+coordinate_name)
+
+    if power is None:
+        output = sum(w * expression.subs({ct: ct + m*h, cf: cf + m*h})
+                     for m, w in stencil(accuracy_order)) / 2 / h
+        output = -sympy.I * sympy.expand(output)
     else:
-        coordinate_name = operator.name.split('_')[1]
-        ct = sympy.Symbol(coordinate_name, commutative=True)
-        cf = sympy.Symbol(coordinate_name, commutative=False)
-        h = sympy.Symbol('a_'+coordinate_name)
+        output = sum(w * expression.subs({ct: ct + m*h, cf: cf + m*h})
+                     for m, w in centred_stencil(power, accuracy_order))
+        output = (-sympy.I / 2 / h)**power * sympy.expand(output)
 
-        expr1 = expression.subs({ct: ct + h, cf: cf + h})
-        expr2 = expression.subs({ct: ct - h, cf: cf - h})
-        output = (expr1 - expr2) / 2 / h
-        return -sympy.I * sympy.expand(output)
+    if memo is not None:
+        memo.set(key, output)
+    return output
 
 
-def _discretize_summand(summand, discrete_coordinates):
+def _discretize_summand(summand, discrete_coordinates, memo=None,
+                        accuracy_order=2):
     """ Discretize one summand. """
     assert not isinstance(summand, sympy.Add), "Input should be one summand."
+    coordinates_key = tuple(sorted(discrete_coordinates))
+    centred = _centred_coordinates(summand, discrete_coordinates,
+                                   accuracy_order)
 
     def do_stuff(expr):
         """ Derivate expr recursively. """
+        if memo is not None:
+            key = ('summand', expr, coordinates_key, accuracy_order,
+                   centred)
+            output = memo.get(key)
+            if output is not None:
+                return output
+
+        output = _do_stuff(expr)
+
+        if memo is not None:
+            memo.set(key, output)
+        return output
+
+    def _do_stuff(expr):
         expr = sympy.expand(expr)
 
         if isinstance(expr, sympy.Add):
@@ -170,27 +351,131 @@ def _discretize_summand(summand, discrete_coordinates):
             return 0
         elif operator == 1:
             return lhs*rhs
-        elif lhs == 1:
-            return derivate(rhs, operator)
+
+        power = None
+        if operator.name.split('_')[1] in centred:
+            power, lhs = _split_power(lhs, operator)
+            power += 1
+        output = derivate(rhs, operator, memo, accuracy_order, power)
+        if lhs == 1:
+            return output
         else:
-            return do_stuff(lhs*derivate(rhs, operator))
+            return do_stuff(lhs*output)
 
     return do_stuff(summand)
 
 
-def _discretize_expression(expression, discrete_coordinates):
+# ****** shift operator engine ***********
+def _momentum_operators(discrete_coordinates):
+    """Map momentum operators of discrete coordinates to coordinate names."""
+    momenta = {}
+    for c in discrete_coordinates:
+        for commutative in [True, False]:
+            momenta[sympy.Symbol('k_' + c, commutative=commutative)] = c
+    return momenta
+
+
+def _apply_momentum(shifts, coordinate, index, accuracy_order=2,
+                    power=None):
+    """Apply momentum operator of ``coordinate`` on a map of shifts.
+
+    ``shifts`` maps integer shifts ``s`` to coefficients ``c_s(x)`` of the
+    term ``sum_s c_s(x) Psi(x + s*a)``. The derivative is taken with the
+    stencil of step ``a_i``, such that ``k_i`` moves every coefficient to the
+    shifts ``s + m_j*e_i`` of the stencil. For ``accuracy_order=2`` these
+    are ``s + e_i`` and ``s - e_i``. If ``power`` is provided, the operator
+    ``k_i**power`` is applied at once with the centred stencil.
+    """
+    ct = sympy.Symbol(coordinate, commutative=True)
+    cf = sympy.Symbol(coordinate, commutative=False)
+    h = sympy.Symbol('a_' + coordinate)
+    if power is None:
+        steps = [(m, -sympy.I * w / (2*h), {ct: ct + m*h, cf: cf + m*h})
+                 for m, w in stencil(accuracy_order)]
+    else:
+        steps = [(m, (-sympy.I / (2*h))**power * w,
+                  {ct: ct + m*h, cf: cf + m*h})
+                 for m, w in centred_stencil(power, accuracy_order)]
+
+    output = defaultdict(int)
+    for shift, coefficient in shifts.items():
+        coefficient = sympy.sympify(coefficient)
+        for m, weight, subs in steps:
+            target = shift[:index] + (shift[index] + m,) + shift[index+1:]
+            output[target] += weight * coefficient.subs(subs)
+    return output
+
+
+def _discretize_summand_shifts(summand, discrete_coordinates,
+                               accuracy_order=2):
+    """Discretize one summand into a map of shifts to coefficients.
+
+    Factors of the summand are applied to the wave function from right to
+    left: momentum operators shift the map with ``_apply_momentum`` and all
+    other factors multiply the coefficients from the left.
+
+    Returns:
+    --------
+    shifts : dict
+        Coefficients of ``Psi(x + s*a)`` keyed by integer shifts ``s``, in
+        units of the lattice constants ``a_x, a_y, a_z``. Zero coefficients
+        are dropped.
+    """
+    assert not isinstance(summand, sympy.Add), "Input should be one summand."
+    coordinates = sorted(discrete_coordinates)
+    momenta = _momentum_operators(coordinates)
+    centred = _centred_coordinates(summand, coordinates, accuracy_order)
+
+    factors = summand.args if isinstance(summand, sympy.Mul) else [summand]
+    shifts = {(0,) * len(coordinates): sympy.S.One}
+    for factor in reversed(factors):
+        base, exponent = factor, 1
+        if isinstance(factor, sympy.Pow) and factor.base in momenta:
+            base, exponent = factor.args
+
+        if base in momenta and momenta[base] in centred:
+            coordinate = momenta[base]
+            shifts = _apply_momentum(shifts, coordinate,
+                                     coordinates.index(coordinate),
+                                     accuracy_order, int(exponent))
+        elif base in momenta:
+            coordinate = momenta[base]
+            for _ in range(int(exponent)):
+                shifts = _apply_momentum(shifts, coordinate,
+                                         coordinates.index(coordinate),
+                                         accuracy_order)
+        else:
+            shifts = {k: factor * v for k, v in shifts.items()}
+
+    shifts = {k: sympy.expand(v) for k, v in shifts.items()}
+    return {k: v for k, v in shifts.items() if v != 0}
+
+
+def _discretize_expression(expression, discrete_coordinates, memo=None,
+                           record=None, engine='expand', accuracy_order=2):
     """ Discretize continous `expression` into discrete tb representation.
 
     Parameters:
     -----------
     expression : sympy.Expr instance
         The expression to be discretized.
+    memo : ExpressionMemo instance
+        Memo of intermediate results shared between calls.
+    record : ElementStats instance
+        If provided, number of summands and time spent on derivation and on
+        shortening are recorded in it.
+    engine : string
+        Discretization engine, ``'expand'`` or ``'shift'``. See
+        ``discretize``.
+    accuracy_order : int
+        Order of the finite differences, see ``stencil``.
 
     Returns:
     --------
     discrete_expression: dict
         dict in which key is offset of hopping ((0, 0, 0) for onsite)
-        and value is corresponding symbolic hopping (onsite).
+        and value is corresponding symbolic hopping (onsite). Hoppings
+        contain separate lattice constants ``a_x, a_y, a_z``.
 
     Note:
     -----
@@ -211,16 +496,45 @@ def _discretize_expression(expression, discrete_coordinates):
     if wf in expression.atoms(sympy.Function):
         raise ValueError("Input expression must not contain {}.".format(wf))
 
-    expression = sympy.expand(expression*wf)
+    if engine == 'expand':
+        expression = sympy.expand(expression*wf)
+    elif engine == 'shift':
+        expression = sympy.expand(expression)
+    else:
+        raise ValueError("Unknown discretization engine '{}'.".format(engine))
 
     # make sure we have list of summands
     summands = expression.args if expression.func == sympy.Add else [expression]
+    if record is not None:
+        record.summands += len(summands)
 
     # discretize every summand
+    coordinates_key = tuple(coordinates_names)
     outputs = []
     for summand in summands:
-        out = _discretize_summand(summand, discrete_coordinates)
-        out = extract_hoppings(out, discrete_coordinates)
+        key = ('hoppings' if engine == 'expand' else 'shifts', summand,
+               coordinates_key, accuracy_order)
+        out = memo.get(key) if memo is not None else None
+        if out is None:
+            start = time.perf_counter()
+            if engine == 'expand':
+                out = _discretize_summand(summand, discrete_coordinates, memo,
+                                          accuracy_order)
+                middle = time.perf_counter()
+                out = extract_hoppings(out, discrete_coordinates,
+                                       anisotropic=True)
+            else:
+                out = _discretize_summand_shifts(summand,
+                                                 discrete_coordinates,
+                                                 accuracy_order)
+                middle = time.perf_counter()
+                out = shorten_hoppings(out, discrete_coordinates,
+                                       anisotropic=True)
+            if record is not None:
+                record.derivation_time += middle - start
+                record.shortening_time += time.perf_counter() - middle
+            if memo is not None:
+                memo.set(key, out)
         outputs.append(out)
 
     # gather together
@@ -232,13 +546,116 @@ def _discretize_expression(expression, discrete_coordinates):
     return dict(discrete_expression)
 
 
-def discretize(hamiltonian, discrete_coordinates):
+def _discretize_element(index, expression, discrete_coordinates, memo,
+                        profile=False, engine='expand', accuracy_order=2):
+    """Discretize a single element, optionally recording ``ElementStats``.
+
+    Returns:
+    --------
+    hoppings : dict
+        Output of ``_discretize_expression``.
+    record : ElementStats instance or None
+        Statistics of the element if ``profile`` is True.
+    """
+    if not profile:
+        return _discretize_expression(expression, discrete_coordinates,
+                                      memo, engine=engine,
+                                      accuracy_order=accuracy_order), None
+
+    record = ElementStats(index)
+    start = time.perf_counter()
+    hoppings = _discretize_expression(expression, discrete_coordinates, memo,
+                                      record, engine, accuracy_order)
+    record.time = time.perf_counter() - start
+    record.input_size = expression_size(expression)
+    record.output_size = sum(expression_size(v) for v in hoppings.values())
+    record.hoppings = len(hoppings)
+    return hoppings, record
+
+
+def _discretize_elements(elements, discrete_coordinates, profile=False,
+                         engine='expand', accuracy_order=2):
+    """Discretize a chunk of matrix elements. Used by worker processes.
+
+    Parameters:
+    -----------
+    elements : list of tuples
+        List of ``(i, j, expression)`` tuples.
+    profile : bool
+        If True, ``ElementStats`` of every element are returned as well.
+    engine : string
+        Discretization engine, see ``discretize``.
+    accuracy_order : int
+        Order of the finite differences, see ``discretize``.
+
+    Returns:
+    --------
+    output : list of tuples
+        List of ``(i, j, hoppings, record)`` tuples, where hoppings is the
+        output of ``_discretize_expression`` and record is an
+        ``ElementStats`` instance (None if ``profile`` is False).
+    """
+    memo = ExpressionMemo()
+    return [(i, j) + _discretize_element((i, j), expression,
+                                         discrete_coordinates, memo, profile,
+                                         engine, accuracy_order)
+            for i, j, expression in elements]
+
+
+def discretize(hamiltonian, discrete_coordinates, memo=None, n_jobs=1,
+               executor=None, hermitian=False, check_hermiticity=0,
+               stats=None, engine='expand', accuracy_order=2,
+               anisotropic=False):
     """ Discretize continous `expression` into discrete tb representation.
 
     Parameters:
     -----------
     hamiltonian : sympy.Expr or sympy.Matrix instance
         The expression for the Hamiltonian.
+    memo : ExpressionMemo instance
+        Memo of intermediate results. Identical sub-expressions are derivated
+        only once within one call; pass the same instance to share results
+        between calls. If None, a new memo is used for every call.
+    n_jobs : int
+        Number of worker processes that discretize elements of a matrix
+        Hamiltonian in parallel. -1 uses all available CPUs. Default is 1,
+        which runs serially in the current process.
+    executor : concurrent.futures.Executor instance
+        If provided, matrix elements are discretized by tasks submitted to
+        this executor and ``n_jobs`` only sets the number of tasks. The
+        executor is not shut down.
+    hermitian : bool
+        If True, only the upper triangle of a matrix Hamiltonian is
+        discretized and the lower triangle is obtained by hermitian
+        conjugation. All parameters are then assumed to be real.
+        Default is False.
+    check_hermiticity : int
+        Number of randomly chosen elements of the lower triangle that are
+        also discretized directly and compared numerically with the derived
+        ones when ``hermitian=True``. Default is 0 (no check).
+    stats : DiscretizationStats instance
+        If provided, ``ElementStats`` of every discretized matrix element
+        (or of the whole expression) are added to it.
+    engine : string
+        ``'expand'`` (default) applies momentum operators recursively on the
+        expanded product of every summand and the wave function and extracts
+        hoppings from the result. ``'shift'`` represents every summand as a
+        map from integer shifts to coefficients and applies momentum
+        operators as shifts of this map, such that the cost grows with the
+        number of distinct shifts rather than with the size of expanded
+        expressions. Both engines give equal results.
+    accuracy_order : int
+        Order of the finite difference approximation of momentum operators,
+        a positive even integer. Higher orders give hoppings of longer range:
+        powers ``k_i**n`` that are the only factor with ``k_i`` in a term
+        use centred stencils (``centred_stencil``) of range
+        ``(n + 1) // 2 + accuracy_order // 2 - 1``, e.g. 2 for ``k_x**2``
+        with ``accuracy_order=4``. Other momentum operators use compositions
+        of the staggered stencils of ``stencil``. Default is 2.
+    anisotropic : bool
+        If True, hoppings contain separate lattice constants ``a_x, a_y,
+        a_z`` of the discrete coordinates, otherwise a single lattice
+        constant ``a``. Default is False.
 
     Returns:
     --------
@@ -250,22 +667,196 @@ def discretize(hamiltonian, discrete_coordinates):
     -----
     Recursive derivation implemented in _discretize_summand is applied
     on every summand. Shortening is applied before return on output.
+
+    Worker processes use their own memo, ``memo`` is used only when the
+    discretization runs serially.
+
+    Raises:
+    -------
+    ValueError
+        If ``n_jobs`` is neither -1 nor a positive integer, if
+        ``hermitian=True`` and the Hamiltonian is not a square matrix, or if
+        the check requested by ``check_hermiticity`` fails.
     """
+    if (not isinstance(n_jobs, numbers.Integral) or
+            not (n_jobs == -1 or n_jobs >= 1)):
+        msg = 'n_jobs must be -1 or a positive integer, not {!r}.'
+        raise ValueError(msg.format(n_jobs))
+
+    if memo is None:
+        memo = ExpressionMemo()
+
+    profile = stats is not None
+
     if not isinstance(hamiltonian, sympy.matrices.MatrixBase):
-        return _discretize_expression(hamiltonian, discrete_coordinates)
+        hoppings, record = _discretize_element((), hamiltonian,
+                                               discrete_coordinates, memo,
+                                               profile, engine,
+                                               accuracy_order)
+        if profile:
+            stats.add_element(record)
+        return _lattice_constants(hoppings, anisotropic)
 
     shape = hamiltonian.shape
+    elements = [(i, j, hamiltonian[i, j]) for i, j in
+                itertools.product(range(shape[0]), range(shape[1]))]
 
-    discrete_hamiltonian = defaultdict(lambda: sympy.zeros(*shape))
-    for i,j in itertools.product(range(shape[0]), range(shape[1])):
-        expression = hamiltonian[i, j]
-        hoppings = _discretize_expression(expression, discrete_coordinates)
+    if hermitian:
+        if shape[0] != shape[1]:
+            raise ValueError('Hermitian Hamiltonian must be a square matrix.')
+        elements = [(i, j, expr) for i, j, expr in elements if i <= j]
+
+    if n_jobs == -1:
+        n_jobs = multiprocessing.cpu_count()
+
+    if n_jobs == 1 and executor is None:
+        outputs = _discretize_elements_serial(elements, discrete_coordinates,
+                                              memo, profile, engine,
+                                              accuracy_order)
+    else:
+        outputs = _discretize_elements_parallel(elements, discrete_coordinates,
+                                                n_jobs, executor, profile,
+                                                engine, accuracy_order)
+
+    if profile:
+        for output in sorted(outputs, key=lambda o: o[:2]):
+            stats.add_element(output[3])
+    outputs = [output[:3] for output in outputs]
+
+    if hermitian:
+        lower = [(j, i, _conjugate_hoppings(hoppings, discrete_coordinates))
+                 for i, j, hoppings in outputs if i < j]
+        if check_hermiticity:
+            _check_hermiticity(hamiltonian, lower, discrete_coordinates,
+                               check_hermiticity, memo, engine,
+                               accuracy_order)
+        outputs += lower
 
-        for offset, hop in hoppings.items():
+    discrete_hamiltonian = defaultdict(lambda: sympy.zeros(*shape))
+    for i, j, hoppings in outputs:
+        for offset, hop in _lattice_constants(hoppings, anisotropic).items():
             discrete_hamiltonian[offset][i,j] += hop
     return discrete_hamiltonian
 
 
+def _lattice_constants(hoppings, anisotropic):
+    """Replace lattice constants ``a_x, a_y, a_z`` with ``a`` if isotropic."""
+    if anisotropic:
+        return hoppings
+    a = sympy.Symbol('a')
+    subs = {sympy.Symbol(s): a for s in ['a_x', 'a_y', 'a_z']}
+    return {k: sympy.sympify(v).xreplace(subs) for k, v in hoppings.items()}
+
+
+def _conjugate_hoppings(hoppings, discrete_coordinates):
+    """Hermitian conjugate of hoppings of a single matrix element.
+
+    For hoppings ``T_d(x)`` of element ``(i, j)``, i.e. coefficients of
+    ``Psi(x + d*a)``, return hoppings of element ``(j, i)`` equal to
+    ``T_{-d}(x) = conj(T_d(x - d*a))``. All symbols are assumed to be real.
+    Hoppings must contain separate lattice constants ``a_x, a_y, a_z``.
+    """
+    coordinates = sorted(discrete_coordinates)
+
+    output = {}
+    for offset, hopping in hoppings.items():
+        subs = {}
+        for c, d in zip(coordinates, offset):
+            a = sympy.Symbol('a_' + c)
+            for commutative in [True, False]:
+                s = sympy.Symbol(c, commutative=commutative)
+                subs[s] = s - d*a
+        hopping = sympy.sympify(hopping).subs(subs, simultaneous=True)
+        hopping = hopping.xreplace({sympy.I: -sympy.I})
+        output[tuple(-d for d in offset)] = sympy.expand(hopping)
+    return output
+
+
+def _random_values(expressions, seed=0):
+    """Random numerical values of symbols and functions in expressions."""
+    rng = np.random.RandomState(seed)
+    symbols = set()
+    functions = set()
+    for expr in expressions:
+        expr = sympy.sympify(expr)
+        symbols |= expr.free_symbols
+        functions |= {f.func for f in expr.atoms(sympy.function.AppliedUndef)}
+
+    symbols = {s: rng.uniform(0.5, 1.5) for s in symbols}
+    functions = {f: (rng.uniform(0.5, 1.5), rng.uniform(0, 2*np.pi))
+                 for f in functions}
+    return symbols, functions
+
+
+def _evaluate(expr, values):
+    """Evaluate expression numerically for values from ``_random_values``."""
+    symbols, functions = values
+
+    def replace(f):
+        scale, phase = functions[f.func]
+        return sympy.sin(scale * sympy.Add(*f.args) + phase)
+
+    expr = sympy.sympify(expr)
+    expr = expr.replace(lambda e: e.func in functions, replace)
+    return complex(expr.subs(symbols))
+
+
+def _check_hermiticity(hamiltonian, lower, discrete_coordinates, n_checks,
+                       memo, engine='expand', accuracy_order=2):
+    """Compare derived elements of the lower triangle with direct result."""
+    rng = np.random.RandomState(0)
+    indices = rng.permutation(len(lower))[:n_checks]
+
+    for index in indices:
+        i, j, derived = lower[index]
+        direct = _discretize_expression(hamiltonian[i, j],
+                                        discrete_coordinates, memo,
+                                        engine=engine,
+                                        accuracy_order=accuracy_order)
+        for offset in set(derived) | set(direct):
+            difference = derived.get(offset, 0) - direct.get(offset, 0)
+            values = _random_values([difference])
+            if abs(_evaluate(difference, values)) > 1e-8:
+                msg = ("Element ({}, {}) of the Hamiltonian is not a hermitian "
+                       "conjugate of element ({}, {}).")
+                raise ValueError(msg.format(i, j, j, i))
+
+
+def _discretize_elements_serial(elements, discrete_coordinates, memo,
+                                profile=False, engine='expand',
+                                accuracy_order=2):
+    return [(i, j) + _discretize_element((i, j), expression,
+                                         discrete_coordinates, memo, profile,
+                                         engine, accuracy_order)
+            for i, j, expression in elements]
+
+
+def _discretize_elements_parallel(elements, discrete_coordinates, n_jobs,
+                                  executor, profile=False, engine='expand',
+                                  accuracy_order=2):
+    # Elements are distributed round-robin, such that rows of similar
+    # complexity are spread among the chunks. Every chunk shares one memo.
+    n_chunks = max(1, min(n_jobs, len(elements)))
+    chunks = [elements[i::n_chunks] for i in range(n_chunks)]
+
+    if executor is None:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=n_chunks) as pool:
+            results = pool.map(_discretize_elements, chunks,
+                               [discrete_coordinates] * n_chunks,
+                               [profile] * n_chunks, [engine] * n_chunks,
+                               [accuracy_order] * n_chunks)
+            results = list(results)
+    else:
+        futures = [executor.submit(_discretize_elements, chunk,
+                                   discrete_coordinates, profile, engine,
+                                   accuracy_order)
+                   for chunk in chunks]
+        results = [f.result() for f in futures]
+
+    return [output for result in results for output in result]
+
+
 # ****** extracting hoppings ***********
 def read_hopping_from_wf(wf):
     """Read offset of a wave function in respect to (x,y,z).
@@ -279,13 +870,15 @@ def read_hopping_from_wf(wf):
     Returns:
     --------
     offset : tuple
-        tuple of integers or floats that represent offset in respect to (x,y,z).
+        tuple of integers (or ``sympy.Rational`` instances for fractional
+        offsets) that represent offset in respect to (x,y,z).
 
     Raises:
     -------
     ValueError
         If arguments of wf are repeated / do not stand for valid coordinates or
-        lattice constants / order of dimensions is not lexical.
+        lattice constants / order of dimensions is not lexical / are not of
+        the form ``x + n*a_x`` with rational ``n``.
     TypeError:
         If wf is not of type sympy.function.AppliedUndef or its name does not
         corresponds to global 'wavefunction_name'.
@@ -297,116 +890,128 @@ def read_hopping_from_wf(wf):
         msg = 'Input should be function that represents wavefunction in module.'
         raise TypeError(msg)
 
-    # Check if input is consistent and in lexical order.
-    # These are more checks for internal usage.
     coordinates_names = ['x', 'y', 'z']
-    lattice_const_names = ['a_x', 'a_y', 'a_z']
+
+    offset = []
     arg_coords = []
-    for arg in wf.args:
-        names = [s.name for s in arg.atoms(sympy.Symbol)]
-        ind = -1
-        for s in names:
-            if not any(s in coordinates_names for s in names):
-                raise ValueError("Wave function argument '{}' is incorrect.".format(s))
-            if s not in coordinates_names and s not in lattice_const_names:
-                raise ValueError("Wave function argument '{}' is incorrect.".format(s))
-            if s in lattice_const_names:
-                s = s.split('_')[1]
-            tmp = coordinates_names.index(s)
-            if tmp in arg_coords:
-                msg = "Wave function '{}' arguments are inconsistent."
-                raise ValueError(msg.format(wf))
-            if ind != -1:
-                if tmp != ind:
-                    msg = "Wave function '{}' arguments are inconsistent."
-                    raise ValueError(msg.format(wf))
-            else:
-                ind = tmp
-        arg_coords.append(ind)
+    for argument in wf.args:
+        names = {s.name for s in argument.atoms(sympy.Symbol)}
+        coordinates = names & set(coordinates_names)
+        if len(coordinates) != 1:
+            msg = "Wave function argument '{}' is incorrect."
+            raise ValueError(msg.format(argument))
+        coordinate = coordinates.pop()
+        if not names <= {coordinate, 'a_' + coordinate}:
+            msg = "Wave function '{}' arguments are inconsistent."
+            raise ValueError(msg.format(wf))
+        if coordinate in arg_coords:
+            msg = "Wave function '{}' arguments are inconsistent."
+            raise ValueError(msg.format(wf))
+        arg_coords.append(coordinate)
+
+        # argument is 'x + n*a_x', with x commutative or not
+        shift = sympy.expand(argument).as_independent(
+            sympy.Symbol(coordinate, commutative=False),
+            sympy.Symbol(coordinate, commutative=True), as_Add=True)[0]
+        n, rest = sympy.sympify(shift).as_coeff_Mul()
+        if shift == 0:
+            n = 0
+        elif (rest != sympy.Symbol('a_' + coordinate) or
+              not n.is_Rational):
+            msg = "Wave function argument '{}' is not of the form {} + n*{}."
+            raise ValueError(msg.format(argument, coordinate,
+                                        'a_' + coordinate))
+        offset.append(int(n) if n == int(n) else n)
+
     if arg_coords != sorted(arg_coords):
         msg = "Coordinates of wave function '{}' are not in lexical order."
         raise ValueError(msg.format(wf))
 
-    # function real body
-    offset = []
-    for argument in wf.args:
-        temp = sympy.expand(argument)
-        if temp in sympy.symbols('x y z', commutative = False):
-            offset.append(0)
-        elif temp.func == sympy.Add:
-            for arg_summands in temp.args:
-                if arg_summands.func == sympy.Mul:
-                    if len(arg_summands.args) > 2:
-                        print('More than two factors in an argument of wf')
-                    if not arg_summands.args[0] in sympy.symbols('a_x a_y a_z'):
-                        offset.append(arg_summands.args[0])
-                    else:
-                        offset.append(arg_summands.args[1])
-                elif arg_summands in sympy.symbols('a_x a_y a_z'):
-                    offset.append(1)
-        else:
-            print('Argument of \wf is neither a sum nor a single space variable.')
     return tuple(offset)
 
 
-def extract_hoppings(expression, discrete_coordinates):
-    """Extract hopping and perform shortening operation. """
+def shorten_hoppings(hoppings, discrete_coordinates, anisotropic=False):
+    """Shorten offsets of hoppings by their greatest common divisors.
+
+    Offsets along every direction are divided by their greatest common
+    divisor ``g_i`` and the lattice constant ``a_i`` of that direction is
+    replaced by ``a / g_i`` in all hoppings with a single substitution.
+    Lattice constants of other directions are replaced by ``a``.
+    If ``anisotropic`` is True, ``a_i`` is replaced by ``a_i / g_i`` instead
+    and lattice constants of other directions are kept.
+
+    Parameters:
+    -----------
+    hoppings : dict
+        Hoppings keyed by offsets in units of ``a_x, a_y, a_z``, with integer
+        or rational entries.
+    discrete_coordinates : set of strings
+        Set of discrete coordinates, corresponding to entries of offsets.
+
+    Returns:
+    --------
+    hoppings : dict
+        Hoppings keyed by integer offsets in units of the lattice constants.
+    """
+    discrete_coordinates = sorted(discrete_coordinates)
+    a = sympy.Symbol('a')
+
+    factors = []
+    for entries in zip(*hoppings):
+        factor = functools.reduce(sympy.gcd, entries, sympy.S.Zero)
+        factors.append(factor if factor != 0 else sympy.S.One)
+
+    subs = {} if anisotropic else {sympy.Symbol(s): a
+                                   for s in ['a_x', 'a_y', 'a_z']}
+    for c, factor in zip(discrete_coordinates, factors):
+        a_c = sympy.Symbol('a_' + c)
+        subs[a_c] = (a_c if anisotropic else a) / factor
+
+    output = {}
+    for offset, hopping in hoppings.items():
+        offset = tuple(int(i / f) for i, f in zip(offset, factors))
+        output[offset] = sympy.sympify(hopping).xreplace(subs)
+    return output
+
 
+def extract_hoppings(expression, discrete_coordinates, anisotropic=False):
+    """Extract hopping and perform shortening operation.
+
+    Parameters:
+    -----------
+    expression : sympy.Expr instance
+        Discretized expression, i.e. a sum of terms that end with the wave
+        function ``Psi(x + n_x*a_x, ...)``.
+    discrete_coordinates : set of strings
+        Set of discrete coordinates.
+    anisotropic : bool
+        Whether separate lattice constants are kept, see
+        ``shorten_hoppings``. Default is False.
+
+    Returns:
+    --------
+    hoppings : dict
+        Hoppings keyed by integer offsets, shortened by ``shorten_hoppings``.
+
+    Raises:
+    -------
+    ValueError
+        If a term does not end with the wave function.
+    """
     # make sure we have list of summands
     expression = sympy.expand(expression)
     summands = expression.args if expression.func == sympy.Add else [expression]
 
+    offsets = {}
     hoppings = defaultdict(int)
     for summand in summands:
-        if summand.func.__name__ == wavefunction_name:
-            hoppings[read_hopping_from_wf(summand)] += 1
-        else:
-            for i in range(len(summand.args)):
-                if summand.args[i].func.__name__ == wavefunction_name:
-                    index = i
-            if index < len(summand.args) - 1:
-                print('Psi is not in the very end of the term. Output will be wrong!')
-            hoppings[read_hopping_from_wf(summand.args[-1])] += sympy.Mul(*summand.args[:-1])
-
-    # START: shortenig
-    discrete_coordinates = sorted(list(discrete_coordinates))
-    tmps = ['a_{}'.format(s) for s in discrete_coordinates]
-    lattice_constants = sympy.symbols(tmps)
-    a = sympy.Symbol('a')
-
-    # make a list of all hopping kinds we have to consider during the shortening
-    hops_kinds = np.array(list(hoppings))
-    # find the longest hopping range in each direction
-    longest_ranges = [np.max(hops_kinds[:,i]) for i in range(len(hops_kinds[0,:]))]
-    # define an array in which we are going to store by which factor we
-    # can shorten the hoppings in each direction
-    shortening_factors = np.ones_like(longest_ranges)
-    # Loop over the direction and each potential shortening factor.
-    # Inside the loop test whether the hopping distances are actually
-    # multiples of the potential shortening factor.
-    for dim in np.arange(len(longest_ranges)):
-        for factor in np.arange(longest_ranges[dim])+1:
-            modulos = np.mod(hops_kinds[:, dim], factor)
-            if np.sum(modulos) < 0.1:
-                shortening_factors[dim] = factor
-    # Apply the shortening factors on the hopping.
-    short_hopping = {}
-    for hopping_kind in hoppings.keys():
-        short_hopping_kind = tuple(np.array(hopping_kind) / shortening_factors)
-
-        for i in short_hopping_kind:
-            if isinstance(i, float):
-                assert i.is_integer()
-        short_hopping_kind = tuple(int(i) for i in short_hopping_kind)
-
-        short_hopping[short_hopping_kind] = hoppings[hopping_kind]
-        for lat_const, factor in zip(lattice_constants, shortening_factors):
-            factor = int(factor)
-            subs = {lat_const: lat_const/factor}
-            short_hopping[short_hopping_kind] = short_hopping[short_hopping_kind].subs(subs)
-
-    # We don't need separate a_x, a_y and a_z anymore.
-    for key, val in short_hopping.items():
-        short_hopping[key] = val.subs({i: a for i in sympy.symbols('a_x a_y a_z')})
-
-    return short_hopping
+        factors = summand.args if summand.func == sympy.Mul else (summand,)
+        wf = factors[-1]
+        if wf.func.__name__ != wavefunction_name:
+            msg = "Term '{}' does not end with the wave function."
+            raise ValueError(msg.format(summand))
+        if wf not in offsets:
+            offsets[wf] = read_hopping_from_wf(wf)
+        hoppings[offsets[wf]] += sympy.Mul(*factors[:-1])
+
+    return shorten_hoppings(hoppings, discrete_coordinates, anisotropic)
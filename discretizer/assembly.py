@@ -0,0 +1,618 @@
+from __future__ import print_function, division
+
+import numpy as np
+
+
+def tags_to_positions(tags, lattice_constant):
+    """Real space positions of lattice points with integer ``tags``."""
+    return np.asarray(tags, dtype=float) * lattice_constant
+
+
+def flood_fill(shape, start, lattice_constant):
+    """Find lattice points inside a shape.
+
+    Parameters:
+    -----------
+    shape : function
+        A function of real space coordinates that returns a truth value:
+        true for coordinates inside the shape, and false otherwise.
+    start : 1d array-like
+        The real-space origin for the flood-fill algorithm.
+    lattice_constant : float or 1d array-like
+        Lattice constant of the cubic lattice, or lattice constants along
+        every direction of an orthorhombic lattice.
+
+    Returns:
+    --------
+    tags : numpy array
+        Integer tags of all lattice points inside the shape connected to
+        ``start``, of shape ``(N, dim)`` and sorted lexicographically.
+    """
+    start = np.atleast_1d(start)
+    dim = len(start)
+    start = tuple(np.round(start / lattice_constant).astype(int))
+
+    if not shape(tags_to_positions(start, lattice_constant)):
+        msg = 'No sites close to {0} are inside the desired shape.'
+        raise ValueError(msg.format(start))
+
+    deltas = np.concatenate([np.eye(dim, dtype=int), -np.eye(dim, dtype=int)])
+
+    visited = {start}
+    inside = [start]
+    frontier = np.array([start])
+    while len(frontier):
+        candidates = (frontier[:, None, :] + deltas[None, :, :])
+        candidates = np.unique(candidates.reshape(-1, dim), axis=0)
+
+        new = []
+        for tag in map(tuple, candidates):
+            if tag in visited:
+                continue
+            visited.add(tag)
+            if shape(tags_to_positions(tag, lattice_constant)):
+                new.append(tag)
+
+        inside.extend(new)
+        frontier = np.array(new, dtype=int).reshape(-1, dim)
+
+    return _sort_tags(np.array(inside, dtype=int))
+
+
+def _grid_slabs(bbox, lattice_constant, size, halo=0):
+    """Tags of all lattice points inside a bounding box, in slabs.
+
+    The box is cut along the first axis into slabs of at most about ``size``
+    lattice points. For every slab, in order, the lexicographically sorted
+    tags of its layers and of up to ``halo`` neighbouring layers on both
+    sides are yielded, together with the range ``(first, stop)`` of the
+    first tag component of the slab itself.
+    """
+    lower, upper = (np.atleast_1d(np.asarray(corner, dtype=float))
+                    for corner in bbox)
+    if lower.shape != upper.shape or lower.ndim != 1:
+        raise ValueError('Corners of the bounding box must be two points of '
+                         'the same dimension.')
+    a = np.broadcast_to(np.asarray(lattice_constant, dtype=float),
+                        lower.shape)
+    low = np.ceil(lower / a - 1e-8).astype(int)
+    high = np.floor(upper / a + 1e-8).astype(int)
+    if np.any(high < low):
+        raise ValueError('The bounding box contains no lattice points.')
+
+    extent = high - low + 1
+    thickness = max(1, size // int(np.prod(extent[1:])))
+    for first in range(low[0], high[0] + 1, thickness):
+        stop = min(first + thickness, high[0] + 1)
+        window_start = max(first - halo, low[0])
+        window_stop = min(stop + halo, high[0] + 1)
+        shape = (window_stop - window_start,) + tuple(extent[1:])
+        tags = np.indices(shape).reshape(len(shape), -1).T
+        tags[:, 0] += window_start
+        tags[:, 1:] += low[1:]
+        yield tags, (first, stop)
+
+
+def _grid_mask(shape, tags, lattice_constant):
+    """Evaluate a vectorized ``shape`` at lattice points with ``tags``."""
+    mask = np.asarray(shape(tags_to_positions(tags, lattice_constant)),
+                      dtype=bool)
+    if mask.shape != (len(tags),):
+        msg = ('A vectorized shape must return an array of shape (N,) for '
+               'positions of shape (N, dim), but it returned shape {0}.')
+        raise ValueError(msg.format(mask.shape))
+    return mask
+
+
+def grid_fill(shape, bbox, lattice_constant, chunk_size=2**20):
+    """Find lattice points inside a shape within a bounding box.
+
+    Contrary to ``flood_fill`` the shape is evaluated for whole arrays of
+    positions, so it must be vectorized, and all lattice points inside the
+    box are tested, so the parts of the shape need not be connected.
+
+    Parameters:
+    -----------
+    shape : function
+        A function of real space coordinates of shape ``(N, dim)`` that
+        returns a boolean array of shape ``(N,)``: true for coordinates
+        inside the shape, and false otherwise.
+    bbox : pair of 1d array-likes
+        Lower and upper corners of the bounding box in real space, e.g.
+        ``((x_min, y_min), (x_max, y_max))``. Lattice points on its faces
+        are included.
+    lattice_constant : float or 1d array-like
+        Lattice constant of the cubic lattice, or lattice constants along
+        every direction of an orthorhombic lattice.
+    chunk_size : int
+        Approximate number of lattice points for which ``shape`` is evaluated
+        at once. It bounds the size of temporary arrays.
+
+    Returns:
+    --------
+    tags : numpy array
+        Integer tags of all lattice points inside the shape and the bounding
+        box, of shape ``(N, dim)`` and sorted lexicographically.
+    """
+    inside = []
+    for tags, _ in _grid_slabs(bbox, lattice_constant, chunk_size):
+        inside.append(tags[_grid_mask(shape, tags, lattice_constant)])
+    tags = np.concatenate(inside)
+
+    if not len(tags):
+        msg = 'No sites inside the bounding box {0} are inside the shape.'
+        raise ValueError(msg.format(tuple(map(tuple, bbox))))
+    return tags
+
+
+def find_tags(shape, start, lattice_constant, bbox=None):
+    """Find lattice points inside a shape with ``flood_fill`` or, if a
+    bounding box is given, with ``grid_fill``.
+    """
+    if bbox is not None:
+        return grid_fill(shape, bbox, lattice_constant)
+    if start is None:
+        raise ValueError('Either start or bbox must be provided.')
+    return flood_fill(shape, start, lattice_constant)
+
+
+def _sort_tags(tags):
+    order = np.lexsort(tags.T[::-1])
+    return tags[order]
+
+
+class TagIndex(object):
+    """Map integer tags of lattice points to their indices.
+
+    Parameters:
+    -----------
+    tags : numpy array
+        Integer tags of shape ``(N, dim)``, sorted lexicographically.
+    """
+    def __init__(self, tags):
+        self.tags = tags
+        self._lower = tags.min(axis=0)
+        self._extent = tags.max(axis=0) - self._lower + 1
+        self._keys = self._ravel(tags)
+
+    def _ravel(self, tags):
+        return np.ravel_multi_index((tags - self._lower).T, self._extent)
+
+    def __call__(self, tags):
+        """Return indices of ``tags``, -1 for tags that are not present."""
+        tags = np.asarray(tags)
+        output = -np.ones(len(tags), dtype=int)
+
+        inside = np.all((tags >= self._lower) &
+                        (tags < self._lower + self._extent), axis=1)
+        keys = self._ravel(tags[inside])
+        indices = np.searchsorted(self._keys, keys)
+        indices[indices == len(self._keys)] = 0
+        found = self._keys[indices] == keys
+
+        output[np.flatnonzero(inside)[found]] = indices[found]
+        return output
+
+
+def _hopping_directions(hoppings):
+    """Directions of hoppings that are set, skipping reversed duplicates.
+
+    If both ``d`` and ``-d`` are present only one of them is used; the other
+    one is its hermitian conjugate.
+    """
+    directions = []
+    for d in hoppings:
+        reverse = tuple(-i for i in d)
+        if reverse in hoppings and tuple(d) < reverse:
+            continue
+        directions.append(d)
+    return sorted(directions)
+
+
+def _block_indices(rows, cols, norbs):
+    """Indices of matrix elements of ``norbs x norbs`` blocks."""
+    orbs = np.arange(norbs)
+    rows = rows[:, None, None] * norbs + orbs[None, :, None]
+    cols = cols[:, None, None] * norbs + orbs[None, None, :]
+    return (np.broadcast_to(rows, (len(rows), norbs, norbs)),
+            np.broadcast_to(cols, (len(cols), norbs, norbs)))
+
+
+def iter_blocks(onsite, hoppings, tags, lattice_constant, params,
+                index=None):
+    """Evaluate onsite and hopping blocks of lattice points.
+
+    Parameters:
+    -----------
+    onsite : function
+        Vectorized onsite function ``f(pos, p)``. If None, no onsite blocks
+        are evaluated.
+    hoppings : dict
+        Dictionary with hopping directions as keys and vectorized hopping
+        functions ``f(pos1, pos2, p)`` as values.
+    tags : numpy array
+        Integer tags of the lattice points, of shape ``(N, dim)``.
+    lattice_constant : float or 1d array-like
+        Lattice constant of the cubic lattice, or lattice constants along
+        every direction of an orthorhombic lattice.
+    params : object
+        Parameters passed as ``p`` to the value functions.
+    index : TagIndex instance
+        Index of all lattice points of the system. If None, ``tags`` are all
+        lattice points of the system.
+
+    Yields:
+    -------
+    rows, cols : numpy arrays
+        Indices of lattice points (of shape ``(M,)``).
+    values : numpy array
+        Values of the blocks (of shape ``(M, norbs, norbs)``).
+
+    Notes:
+    ------
+    For every hopping the block ``(target, source)`` and its hermitian
+    conjugate ``(source, target)`` are yielded.
+    """
+    if index is None:
+        index = TagIndex(tags)
+
+    sources = index(tags)
+    positions = tags_to_positions(tags, lattice_constant)
+    if onsite is not None:
+        yield sources, sources, onsite(positions, params)
+
+    for d in _hopping_directions(hoppings):
+        targets = index(tags + np.array(d))
+        present = targets >= 0
+        if not np.any(present):
+            continue
+        values = hoppings[d](positions[present] +
+                             tags_to_positions(d, lattice_constant),
+                             positions[present], params)
+        yield targets[present], sources[present], values
+        yield sources[present], targets[present], \
+            values.conj().transpose(0, 2, 1)
+
+
+def assemble(onsite, hoppings, tags, lattice_constant, params):
+    """Assemble a sparse Hamiltonian from vectorized value functions.
+
+    Parameters:
+    -----------
+    onsite : function
+        Vectorized onsite function ``f(pos, p)``.
+    hoppings : dict
+        Dictionary with hopping directions as keys and vectorized hopping
+        functions ``f(pos1, pos2, p)`` as values.
+    tags : numpy array
+        Integer tags of the lattice points, of shape ``(N, dim)`` and sorted
+        lexicographically. Their order defines the order of the sites.
+    lattice_constant : float or 1d array-like
+        Lattice constant of the cubic lattice, or lattice constants along
+        every direction of an orthorhombic lattice.
+    params : object
+        Parameters passed as ``p`` to the value functions.
+
+    Returns:
+    --------
+    hamiltonian : scipy.sparse.csr_matrix instance
+        Matrix of shape ``(N * norbs, N * norbs)``. Orbitals of every site
+        are stored consecutively.
+    """
+    import scipy.sparse
+
+    rows, cols, data, size = _coo_arrays(onsite, hoppings, tags,
+                                         lattice_constant, params)
+    hamiltonian = scipy.sparse.coo_matrix((data, (rows, cols)),
+                                          shape=(size, size)).tocsr()
+    hamiltonian.eliminate_zeros()
+    return hamiltonian
+
+
+def _coo_arrays(onsite, hoppings, tags, lattice_constant, params):
+    rows, cols, data = [], [], []
+    norbs = 0
+    for block_rows, block_cols, values in iter_blocks(
+            onsite, hoppings, tags, lattice_constant, params):
+        norbs = values.shape[1]
+        block_rows, block_cols = _block_indices(block_rows, block_cols, norbs)
+        rows.append(block_rows.ravel())
+        cols.append(block_cols.ravel())
+        data.append(values.ravel())
+
+    if not data:
+        return (np.zeros(0, int), np.zeros(0, int), np.zeros(0, complex),
+                len(tags) * norbs)
+    return (np.concatenate(rows), np.concatenate(cols), np.concatenate(data),
+            len(tags) * norbs)
+
+
+def _slab_windows(shape, bbox, lattice_constant, chunk_size, halo):
+    """Lattice points inside a shape, slab by slab.
+
+    Yields ``(offset, tags, slab)``, where ``tags`` are the lattice points of
+    a slab and its ``halo`` neighbouring layers, ``tags[slab]`` those of the
+    slab itself and ``offset`` the index of ``tags[0]`` among all lattice
+    points inside the shape and the bounding box.
+    """
+    count = 0
+    for tags, (first, stop) in _grid_slabs(bbox, lattice_constant,
+                                           chunk_size, halo):
+        tags = tags[_grid_mask(shape, tags, lattice_constant)]
+        begin, end = np.searchsorted(tags[:, 0], [first, stop])
+        if end > begin:
+            yield count - begin, tags, slice(begin, end)
+        count += end - begin
+
+
+def _coo_slabs(onsite, hoppings, shape, bbox, lattice_constant, params,
+               chunk_size):
+    """Evaluate COO blocks slab by slab.
+
+    Yields ``(offset, tags, blocks)``: the index of the first lattice point
+    of a slab, tags of its lattice points and an iterator over blocks as
+    yielded by ``iter_blocks``, with indices of all lattice points.
+    """
+    halo = max([abs(d[0]) for d in hoppings] + [0])
+    for offset, tags, slab in _slab_windows(shape, bbox, lattice_constant,
+                                            chunk_size, halo):
+        blocks = iter_blocks(onsite, hoppings, tags[slab], lattice_constant,
+                             params, index=TagIndex(tags))
+        blocks = ((rows + offset, cols + offset, values)
+                  for rows, cols, values in blocks)
+        yield offset + slab.start, tags[slab], blocks
+
+
+def iter_coo(onsite, hoppings, shape, bbox, lattice_constant, params,
+             chunk_size=2**20):
+    """Evaluate a sparse Hamiltonian in COO blocks with bounded memory.
+
+    The lattice points inside a vectorized shape and a bounding box (as in
+    ``grid_fill``) are never stored all at once: the box is walked in slabs
+    and all onsites and hoppings of sites in a slab are evaluated together.
+    Lattice points are ordered as in ``assemble``.
+
+    Parameters:
+    -----------
+    onsite : function
+        Vectorized onsite function ``f(pos, p)``.
+    hoppings : dict
+        Dictionary with hopping directions as keys and vectorized hopping
+        functions ``f(pos1, pos2, p)`` as values.
+    shape : function
+        A vectorized function of real space coordinates of shape ``(N, dim)``
+        that returns a boolean array of shape ``(N,)``.
+    bbox : pair of 1d array-likes
+        Lower and upper corners of the bounding box in real space.
+    lattice_constant : float or 1d array-like
+        Lattice constant of the cubic lattice, or lattice constants along
+        every direction of an orthorhombic lattice.
+    params : object
+        Parameters passed as ``p`` to the value functions.
+    chunk_size : int
+        Approximate number of lattice points in a slab.
+
+    Yields:
+    -------
+    rows, cols, data : numpy arrays
+        Matrix elements of a block in COO format. Orbitals of every site are
+        stored consecutively. Zero matrix elements are not removed.
+    """
+    for _, _, blocks in _coo_slabs(onsite, hoppings, shape, bbox,
+                                   lattice_constant, params, chunk_size):
+        for rows, cols, values in blocks:
+            rows, cols = _block_indices(rows, cols, values.shape[1])
+            yield rows.ravel(), cols.ravel(), values.ravel()
+
+
+def _count_coo(onsite, hoppings, shape, bbox, lattice_constant, params,
+               chunk_size):
+    """Count lattice points and blocks of ``iter_coo`` without evaluating
+    hoppings. Returns ``(sites, blocks, norbs)`` as Python integers.
+    """
+    halo = max([abs(d[0]) for d in hoppings] + [0])
+    sites, blocks, norbs = 0, 0, None
+    for _, tags, slab in _slab_windows(shape, bbox, lattice_constant,
+                                       chunk_size, halo):
+        index = TagIndex(tags)
+        sources = tags[slab]
+        sites += int(len(sources))
+        blocks += int(len(sources))
+        for d in _hopping_directions(hoppings):
+            present = index(sources + np.array(d)) >= 0
+            blocks += 2 * int(np.count_nonzero(present))
+        if norbs is None:
+            positions = tags_to_positions(sources[:1], lattice_constant)
+            norbs = int(onsite(positions, params).shape[1])
+    return sites, blocks, norbs
+
+
+def save_coo(prefix, onsite, hoppings, shape, bbox, lattice_constant, params,
+             chunk_size=2**20):
+    """Assemble a sparse Hamiltonian into memory-mapped ``.npy`` files.
+
+    The matrix elements are evaluated with ``iter_coo`` and written to the
+    files ``<prefix>_rows.npy``, ``<prefix>_cols.npy`` and
+    ``<prefix>_data.npy``, the site positions to ``<prefix>_positions.npy``
+    and the shape of the matrix to ``<prefix>_shape.npy``. A first pass
+    over the bounding box counts the matrix elements, such that the files
+    are allocated once and the memory used does not grow with the system
+    size.
+
+    Parameters:
+    -----------
+    prefix : string
+        Path prefix of the output files.
+    onsite, hoppings, shape, bbox, lattice_constant, params, chunk_size
+        As in ``iter_coo``.
+
+    Returns:
+    --------
+    rows, cols, data : numpy memmap instances
+        Matrix elements in COO format, of shape ``(nnz,)``.
+    positions : numpy memmap instance
+        Positions of the sites, of shape ``(N, dim)``.
+    shape : tuple of ints
+        Shape ``(N * norbs, N * norbs)`` of the matrix.
+    """
+    from numpy.lib.format import open_memmap
+
+    sites, blocks, norbs = _count_coo(onsite, hoppings, shape, bbox,
+                                      lattice_constant, params, chunk_size)
+    if not sites:
+        msg = 'No sites inside the bounding box {0} are inside the shape.'
+        raise ValueError(msg.format(tuple(map(tuple, bbox))))
+
+    nnz = blocks * norbs**2
+    dim = int(len(np.atleast_1d(bbox[0])))
+    size = sites * norbs
+    rows = open_memmap(prefix + '_rows.npy', mode='w+', dtype=np.int64,
+                       shape=(nnz,))
+    cols = open_memmap(prefix + '_cols.npy', mode='w+', dtype=np.int64,
+                       shape=(nnz,))
+    data = open_memmap(prefix + '_data.npy', mode='w+', dtype=complex,
+                       shape=(nnz,))
+    positions = open_memmap(prefix + '_positions.npy', mode='w+',
+                            dtype=float, shape=(sites, dim))
+
+    start = 0
+    for offset, tags, blocks in _coo_slabs(onsite, hoppings, shape, bbox,
+                                           lattice_constant, params,
+                                           chunk_size):
+        positions[offset:offset + len(tags)] = \
+            tags_to_positions(tags, lattice_constant)
+        for block_rows, block_cols, values in blocks:
+            block_rows, block_cols = _block_indices(block_rows, block_cols,
+                                                    norbs)
+            stop = start + values.size
+            rows[start:stop] = block_rows.ravel()
+            cols[start:stop] = block_cols.ravel()
+            data[start:stop] = values.ravel()
+            start = stop
+
+    for array in (rows, cols, data, positions):
+        array.flush()
+    np.save(prefix + '_shape.npy', np.array([size, size]))
+    return rows, cols, data, positions, (size, size)
+
+
+def bulk_hamiltonian(onsite, hoppings, k, lattice_constant, params,
+                     pos=None):
+    """Evaluate the Bloch Hamiltonian of a translationally invariant system.
+
+    The Hamiltonian is ``H(k) = sum_d T_d exp(-i k.d a)``, where ``T_d`` is
+    the hopping in direction ``d`` (the onsite for ``d = 0``). Hoppings that
+    are given only in one of the directions ``d`` and ``-d`` are complemented
+    by their hermitian conjugates.
+
+    Parameters:
+    -----------
+    onsite : function
+        Vectorized onsite function ``f(pos, p)``.
+    hoppings : dict
+        Dictionary with hopping directions as keys and vectorized hopping
+        functions ``f(pos1, pos2, p)`` as values.
+    k : array-like
+        Momenta of shape ``(Nk, dim)``, or ``(Nk,)`` if ``dim`` is 1.
+    lattice_constant : float or 1d array-like
+        Lattice constant of the cubic lattice, or lattice constants along
+        every direction of an orthorhombic lattice.
+    params : object
+        Parameters passed as ``p`` to the value functions.
+    pos : 1d array-like
+        Position at which space dependent parameters are evaluated. Default
+        is the origin.
+
+    Returns:
+    --------
+    hamiltonian : numpy array
+        Hamiltonians of shape ``(Nk, norbs, norbs)``.
+    """
+    k = np.asarray(k, dtype=float)
+    if k.ndim == 1:
+        k = k[:, None]
+    if pos is None:
+        source = np.zeros((1, k.shape[1]))
+    else:
+        source = np.reshape(np.asarray(pos, dtype=float), (1, k.shape[1]))
+
+    directions = _hopping_directions(hoppings)
+    values = [hoppings[d](source + tags_to_positions(d, lattice_constant),
+                          source, params)[0] for d in directions]
+    onsite = onsite(source, params)[0]
+    if not directions:
+        return np.broadcast_to(onsite, (len(k),) + onsite.shape).copy()
+
+    # H(k) = H_0 + sum_d (T_d exp(-i k.d a) + h.c.)
+    values = np.array(values)
+    phases = np.exp(-1j * k.dot(tags_to_positions(directions,
+                                                  lattice_constant).T))
+    hamiltonian = np.einsum('kd,dij->kij', phases, values)
+    hamiltonian += hamiltonian.conj().transpose(0, 2, 1)
+    return hamiltonian + onsite
+
+
+class AffineHamiltonian(object):
+    """Sparse Hamiltonian that depends linearly on scalar parameters.
+
+    The Hamiltonian is ``H(p) = sum_k c_k(p) * M_k``, where the sparse
+    matrices ``M_k`` are assembled once. All ``M_k`` are stored on the union
+    of their sparsity patterns, so that evaluation for new parameters only
+    sums the data arrays.
+
+    Parameters:
+    -----------
+    coefficients : list of functions
+        Functions ``c_k(p)`` returning scalars.
+    terms : list of tuples
+        For every coefficient a tuple ``(onsite, hoppings)`` of vectorized
+        value functions of the corresponding ``M_k``.
+    tags : numpy array
+        Integer tags of the lattice points, of shape ``(N, dim)``.
+    lattice_constant : float or 1d array-like
+        Lattice constant of the cubic lattice, or lattice constants along
+        every direction of an orthorhombic lattice.
+    params : object
+        Parameters passed as ``p`` to the value functions of ``M_k``.
+
+    Notes:
+    ------
+    Coefficients are assumed to be real, since hermitian conjugates of
+    hoppings are included in ``M_k``.
+    """
+    def __init__(self, coefficients, terms, tags, lattice_constant, params):
+        self.coefficients = coefficients
+
+        rows, cols, data = [], [], []
+        size = 0
+        for onsite, hoppings in terms:
+            r, c, d, n = _coo_arrays(onsite, hoppings, tags,
+                                     lattice_constant, params)
+            size = max(size, n)
+            rows.append(r)
+            cols.append(c)
+            data.append(d)
+        self.shape = (size, size)
+
+        keys = [r * size + c for r, c in zip(rows, cols)]
+        unique, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+        bounds = np.cumsum([0] + [len(k) for k in keys])
+
+        self.data = np.zeros((len(terms), len(unique)), dtype=complex)
+        for k, d in enumerate(data):
+            np.add.at(self.data[k], inverse[bounds[k]:bounds[k+1]], d)
+
+        self.indices = unique % size
+        self.indptr = np.searchsorted(unique // size, np.arange(size + 1))
+
+    def __call__(self, params):
+        """Return the Hamiltonian for ``params`` as a sparse CSR matrix."""
+        import scipy.sparse
+
+        weights = np.array([c(params) for c in self.coefficients],
+                           dtype=complex)
+        data = weights.dot(self.data)
+        if not np.any(data.imag):
+            data = data.real
+        return scipy.sparse.csr_matrix((data, self.indices, self.indptr),
+                                       shape=self.shape)
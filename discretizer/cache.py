@@ -0,0 +1,210 @@
+from __future__ import print_function, division
+
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+
+
+def default_cache_dir():
+    """Return the default location of the on-disk cache.
+
+    The location can be set through the ``DISCRETIZER_CACHE_DIR`` environment
+    variable, otherwise ``~/.cache/discretizer`` is used.
+    """
+    path = os.environ.get('DISCRETIZER_CACHE_DIR')
+    if path is None:
+        path = os.path.join(os.path.expanduser('~'), '.cache', 'discretizer')
+    return path
+
+
+def encode_hamiltonian(discrete_hamiltonian):
+    """Encode a discrete hamiltonian into a JSON serializable list.
+
+    Parameters:
+    -----------
+    discrete_hamiltonian: dict
+        dict in which key is offset of hopping ((0, 0, 0) for onsite)
+        and value is corresponding symbolic hopping (onsite).
+
+    Returns:
+    --------
+    output : list
+        List of ``[offset, srepr]`` pairs.
+    """
+    import sympy
+
+    return [[list(k), sympy.srepr(v)]
+            for k, v in sorted(discrete_hamiltonian.items())]
+
+
+def decode_hamiltonian(encoded):
+    """Invert ``encode_hamiltonian``."""
+    import sympy
+
+    return {tuple(k): sympy.sympify(v) for k, v in encoded}
+
+
+def encode_lines(function_lines):
+    """Encode lines of generated value functions into a JSON list."""
+    return [[list(k), v] for k, v in sorted(function_lines.items())]
+
+
+def decode_lines(encoded):
+    """Invert ``encode_lines``."""
+    return {tuple(k): v for k, v in encoded}
+
+
+def lattice_constant_key(lattice_constant):
+    """Key of value functions for ``lattice_constant`` in a cache entry.
+
+    The key does not depend on the type of the lattice constant, such that
+    e.g. ``1`` and ``1.0``, or ``(1, 2)`` and ``[1, 2]`` share value
+    functions.
+    """
+    return repr(tuple(float(a) for a in np.atleast_1d(lattice_constant)))
+
+
+class DiscretizationCache(object):
+    """Content-addressed on-disk cache of discretization results.
+
+    Every entry is stored in a separate JSON file named after the hash of the
+    input of ``Discretizer``. Entries hold the symbolic result of the
+    discretization and the source of generated value functions for every
+    lattice constant used so far. Writes are atomic, so the same cache may be
+    shared by many processes.
+
+    Parameters:
+    -----------
+    path : string
+        Directory of the cache. If None, ``default_cache_dir()`` is used.
+    max_size : int
+        Maximal size of the cache in bytes. When it is exceeded the least
+        recently used entries are removed. Default is 64 MiB.
+    """
+    def __init__(self, path=None, max_size=64 * 2**20):
+        self.path = default_cache_dir() if path is None else path
+        self.max_size = max_size
+
+    @staticmethod
+    def key(hamiltonian, discrete_coordinates, interpolate,
+            both_hoppings_directions, **options):
+        """Return the key of an entry for the given ``Discretizer`` input.
+
+        Additional keyword arguments are options of ``Discretizer`` which
+        change the symbolic result; they are included in the key as well.
+        """
+        import sympy
+        from . import __version__
+
+        if discrete_coordinates is not None:
+            discrete_coordinates = sorted(discrete_coordinates)
+
+        content = [sympy.srepr(hamiltonian), repr(discrete_coordinates),
+                   repr(interpolate), repr(both_hoppings_directions),
+                   repr(sorted(options.items())), __version__]
+        content = '\n'.join(content).encode('utf-8')
+        return hashlib.sha256(content).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def load(self, key):
+        """Return the entry stored under ``key`` or None if there is none."""
+        filename = self._filename(key)
+        try:
+            with open(filename) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        try:
+            # mark the entry as recently used
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return entry
+
+    def store(self, key, entry):
+        """Store ``entry`` under ``key`` and evict old entries if needed."""
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            if not os.path.isdir(self.path):
+                raise
+
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp, self._filename(key))
+        except Exception:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the size bound holds.
+
+        Parameters:
+        -----------
+        keep : string
+            Key of an entry that should not be removed.
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        size = sum(e[1] for e in entries)
+        for _, entry_size, name in sorted(entries):
+            if size <= self.max_size:
+                break
+            if keep is not None and name == keep + '.json':
+                continue
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            size -= entry_size
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        if not os.path.isdir(self.path):
+            return
+        for name in os.listdir(self.path):
+            if name.endswith('.json'):
+                os.remove(os.path.join(self.path, name))
+
+
+def as_cache(cache):
+    """Interpret the ``cache`` argument of ``Discretizer``.
+
+    Parameters:
+    -----------
+    cache : None, bool, string or DiscretizationCache instance
+        None or False disables caching, True uses the default location and
+        a string is interpreted as a cache directory.
+
+    Returns:
+    --------
+    cache : DiscretizationCache instance or None
+    """
+    if cache is None or cache is False:
+        return None
+    if cache is True:
+        return DiscretizationCache()
+    if isinstance(cache, DiscretizationCache):
+        return cache
+    return DiscretizationCache(cache)
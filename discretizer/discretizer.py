@@ -8,22 +8,32 @@ from .algorithms import read_coordinates
 from .algorithms import discretize
 
 from .postprocessing import offset_to_direction
+from .postprocessing import make_function_lines
+from .postprocessing import make_kernel_lines
 from .postprocessing import make_kwant_functions
-from .postprocessing import offset_to_direction
+from .postprocessing import make_parameter_function
+from .postprocessing import affine_decomposition
+
+from .cache import as_cache
+from .cache import encode_hamiltonian
+from .cache import decode_hamiltonian
+from .cache import encode_lines
+from .cache import decode_lines
+from .cache import lattice_constant_key
 
 from .interpolation import interpolate_tb_hamiltonian
 
-try:
-    # normal situation
-    from kwant import Builder
-    from kwant import TranslationalSymmetry
-    from kwant import HoppingKind
-    from kwant.lattice import Monatomic
-except ImportError:
-    # probably run on gitlab-ci
-    pass
-
-class Discretizer(object):
+from .profiling import DiscretizationStats
+from .profiling import hamiltonian_size
+from .profiling import stage
+
+from .model import DiscreteModel
+from .model import _use_kernels
+
+from . import assembly
+
+
+class Discretizer(DiscreteModel):
     """Discretize continous Hamiltonian into its tight binding representation.
 
     This class provides easy and nice interface for passing models to Kwant.
@@ -38,15 +48,57 @@ class Discretizer(object):
         differential operators. For example ``discrete_coordinates={'x', 'y'}``.
         If left as a None they will be obtained from the input hamiltonian by
         reading present coordinates and momentum operators.
-    interpolate : bool
+    lattice_constant : float or sequence of floats
+        Lattice constant of the cubic lattice, or lattice constants along
+        the discrete coordinates (in alphabetical order) of an orthorhombic
+        lattice, e.g. ``(ax, ay, az)``. In the latter case the symbolic
+        Hamiltonian contains separate lattice constants ``a_x, a_y, a_z``
+        instead of ``a``. Default is 1.
+    interpolate : bool or string
         If True all space dependent parameters in onsite and hopping will be
         interpolated to depenend only on the values at site positions.
-        Default is False.
+        If ``'runtime'``, the value functions instead evaluate every space
+        dependent parameter once per site through ``site_parameters`` and
+        interpolate between sites numerically; the parameters must then
+        depend only on discrete coordinates. Default is False.
     both_hoppings_directions : bool
         If True all hoppings will be returned. For example, if set to True, both
         hoppings into (1, 0) and (-1, 0) will be returned. Default is False.
     verbose : bool
         If True additional information will be printed. Default is False.
+    cache : None, bool, string or DiscretizationCache instance
+        On-disk cache of the symbolic result and of the generated value
+        functions, keyed by the input Hamiltonian. True uses the default
+        location (see ``discretizer.cache.default_cache_dir``) and a string
+        is interpreted as a cache directory. Default is None (no caching).
+    n_jobs : int
+        Number of worker processes used to discretize elements of a matrix
+        Hamiltonian, -1 uses all available CPUs. Default is 1 (serial).
+    hermitian : bool
+        If True, only the upper triangle of a matrix Hamiltonian is
+        discretized and the lower triangle is obtained by hermitian
+        conjugation, which requires all parameters to be real.
+        Default is False.
+    profile : bool or function
+        If True, wall time and sizes of expressions and generated code are
+        recorded for every stage and every matrix element in ``stats``. If a
+        function, it is additionally called with every recorded
+        ``StageStats`` and ``ElementStats`` instance. Default is False.
+    engine : string
+        Discretization engine, ``'expand'`` (default) or ``'shift'``. Both
+        give equal results, see ``discretizer.algorithms.discretize``.
+    accuracy_order : int
+        Order of the finite difference approximation of momentum operators,
+        a positive even integer. Orders higher than 2 give hoppings of longer
+        range, but allow larger lattice constants for the same accuracy.
+        Default is 2.
+    backend : string
+        ``'python'`` (default) or ``'numba'``. With ``'numba'`` value
+        functions that depend on position are evaluated by kernels compiled
+        with Numba on first use; plain Python functions passed as space
+        dependent parameters are compiled as well. If a kernel cannot be
+        compiled for given parameters the Python implementation is used.
+        Requires Numba, otherwise ``'python'`` is used with a warning.
 
     Attributes:
     -----------
@@ -56,21 +108,57 @@ class Discretizer(object):
     lattice : kwant.lattice.Monatomic instance
         Lattice to create kwant system. Lattice constant is set to
         lattice_constant value.
-    onsite : function
-        The value of the onsite Hamiltonian.
+    onsite : function or constant
+        The value of the onsite Hamiltonian. Values that depend neither on
+        position nor on parameters are precomputed.
     hoppings : dict
         A dictionary with keys being tuples of the lattice hopping, and values
-        the corresponding value functions.
+        the corresponding value functions (or precomputed constant values).
+    vectorized_onsite : function
+        Array-mode variant of ``onsite`` with signature ``f(pos, p)``. It takes
+        an array of shape ``(N, dim)`` with site positions and returns the
+        onsite values of all sites stacked in an array of shape
+        ``(N, norb, norb)``. Space dependent parameters must accept arrays.
+    vectorized_hoppings : dict
+        A dictionary with keys being the hopping directions, and values the
+        array-mode hopping functions ``f(pos1, pos2, p)``, returning arrays of
+        shape ``(N, norb, norb)``. As in kwant, ``pos1`` are the positions of
+        the target sites and ``pos2`` of the source sites.
+    site_parameters : SiteParameterCache instance
+        Values of space dependent parameters at sites, used if
+        ``interpolate='runtime'``.
     discrete_coordinates : set of strings
         As in input.
     input_hamiltonian : sympy.Expr or sympy.Matrix instance
         The input hamiltonian after preprocessing (substitution of functions).
+    cache_key : string
+        Key of the cache entry if ``cache`` was used, None otherwise.
+    stats : DiscretizationStats instance or None
+        Statistics recorded if ``profile`` was used, None otherwise.
     """
     def __init__(self, hamiltonian, discrete_coordinates=None,
                  lattice_constant=1, interpolate=False,
-                 both_hoppings_directions=False, verbose=False):
+                 both_hoppings_directions=False, verbose=False, cache=None,
+                 n_jobs=1, hermitian=False, profile=False, engine='expand',
+                 accuracy_order=2, backend='python'):
 
+        if interpolate not in (False, True, 'runtime'):
+            raise ValueError("interpolate must be a bool or 'runtime', not "
+                             "{!r}.".format(interpolate))
         self.input_hamiltonian = hamiltonian
+        self._runtime_interpolation = interpolate == 'runtime'
+
+        if backend == 'numba' and self._runtime_interpolation:
+            raise ValueError("backend='numba' does not support "
+                             "interpolate='runtime'.")
+        use_kernels = _use_kernels(backend)
+
+        if profile:
+            callback = profile if callable(profile) else None
+            self.stats = DiscretizationStats(callback)
+        else:
+            self.stats = None
+        stats = self.stats
 
         if discrete_coordinates is None:
             self.discrete_coordinates = read_coordinates(hamiltonian)
@@ -81,43 +169,147 @@ class Discretizer(object):
             print('Discrete coordinates set to: ',
                   sorted(self.discrete_coordinates), end='\n\n')
 
-        # discretization
+        anisotropic = np.ndim(lattice_constant) > 0
+        if anisotropic:
+            lattice_constant = tuple(lattice_constant)
+            if len(lattice_constant) != len(self.discrete_coordinates):
+                msg = ('Number of lattice constants {} does not match the '
+                       'discrete coordinates {}.')
+                raise ValueError(msg.format(
+                    lattice_constant, sorted(self.discrete_coordinates)))
+
+        cache = as_cache(cache)
+        entry = None
+        if cache is not None:
+            with stage(stats, 'cache_load') as info:
+                self.cache_key = cache.key(hamiltonian,
+                                           self.discrete_coordinates,
+                                           interpolate,
+                                           both_hoppings_directions,
+                                           hermitian=hermitian,
+                                           accuracy_order=accuracy_order,
+                                           anisotropic=anisotropic)
+                entry = cache.load(self.cache_key)
+                info['hit'] = entry is not None
+        else:
+            self.cache_key = None
+
+        if entry is not None:
+            tb_ham = decode_hamiltonian(entry['symbolic'])
+            self.discrete_coordinates = set(entry['discrete_coordinates'])
+        else:
+            tb_ham = self._discretize(hamiltonian, interpolate,
+                                      both_hoppings_directions, n_jobs,
+                                      hermitian, engine, accuracy_order,
+                                      anisotropic)
+            entry = {'symbolic': encode_hamiltonian(tb_ham),
+                     'discrete_coordinates': sorted(self.discrete_coordinates),
+                     'sources': {}}
+
+        self.symbolic_hamiltonian = tb_ham.copy()
+        self.lattice_constant = lattice_constant
+
+        # making kwant functions
+        sources = entry['sources'].setdefault(
+            lattice_constant_key(lattice_constant), {})
+        missing = {'scalar', 'vectorized'} - set(sources)
+        if use_kernels and 'kernels' not in sources:
+            missing.add('kernels')
+
+        if missing:
+            with stage(stats, 'substitute') as info:
+                subs = self._lattice_constant_subs()
+                for key, val in tb_ham.items():
+                    tb_ham[key] = val.subs(subs)
+                if stats is not None:
+                    info['size'] = hamiltonian_size(tb_ham)
+
+            if 'scalar' in missing:
+                with stage(stats, 'codegen') as info:
+                    lines = make_function_lines(
+                        tb_ham, self.discrete_coordinates,
+                        site_parameters=self._runtime_interpolation)
+                    info['lines'] = sum(len(v) for v in lines.values())
+                sources['scalar'] = encode_lines(lines)
+
+            if 'vectorized' in missing:
+                with stage(stats, 'codegen_vectorized') as info:
+                    lines = make_function_lines(
+                        tb_ham, self.discrete_coordinates, vectorized=True,
+                        site_parameters=self._runtime_interpolation)
+                    info['lines'] = sum(len(v) for v in lines.values())
+                sources['vectorized'] = encode_lines(lines)
+
+            if 'kernels' in missing:
+                with stage(stats, 'codegen_kernels') as info:
+                    lines = make_kernel_lines(tb_ham,
+                                              self.discrete_coordinates)
+                    info['lines'] = sum(len(v) for v in lines.values())
+                sources['kernels'] = encode_lines(lines)
+
+            if cache is not None:
+                with stage(stats, 'cache_store'):
+                    cache.store(self.cache_key, entry)
+
+        lines = decode_lines(sources['scalar'])
+        vectorized_lines = decode_lines(sources['vectorized'])
+        kernel_lines = None
+        if use_kernels:
+            kernel_lines = decode_lines(sources['kernels'])
+
+        if stats is not None:
+            stats.add_functions(lines)
+
+        self._compile(lines, vectorized_lines, verbose, stats, kernel_lines)
+
+    def _discretize(self, hamiltonian, interpolate, both_hoppings_directions,
+                    n_jobs, hermitian, engine, accuracy_order, anisotropic):
+        """Perform the symbolic part of the discretization."""
+        stats = self.stats
         if self.discrete_coordinates:
-            tb_ham = discretize(hamiltonian, self.discrete_coordinates)
-            tb_ham = offset_to_direction(tb_ham, self.discrete_coordinates)
+            with stage(stats, 'discretize') as info:
+                tb_ham = discretize(hamiltonian, self.discrete_coordinates,
+                                    n_jobs=n_jobs, hermitian=hermitian,
+                                    stats=stats, engine=engine,
+                                    accuracy_order=accuracy_order,
+                                    anisotropic=anisotropic)
+                info['hoppings'] = len(tb_ham)
+            with stage(stats, 'offset_to_direction'):
+                tb_ham = offset_to_direction(tb_ham, self.discrete_coordinates,
+                                             anisotropic)
         else:
             tb_ham = {(0,0,0): hamiltonian}
             self.discrete_coordinates = {'x', 'y', 'z'}
 
-        if interpolate:
-            tb_ham = interpolate_tb_hamiltonian(tb_ham)
+        if interpolate and interpolate != 'runtime':
+            with stage(stats, 'interpolate') as info:
+                tb_ham = interpolate_tb_hamiltonian(tb_ham)
+                if stats is not None:
+                    info['size'] = hamiltonian_size(tb_ham)
 
         if not both_hoppings_directions:
             keys = list(tb_ham)
             tb_ham = {k: v for k, v in tb_ham.items()
                               if k in sorted(keys)[len(keys)//2:]}
 
-        self.symbolic_hamiltonian = tb_ham.copy()
+        return tb_ham
 
-        for key, val in tb_ham.items():
-            tb_ham[key] = val.subs(sympy.Symbol('a'), lattice_constant)
+    def _lattice_constant_subs(self):
+        """Substitution of the lattice constant symbols by their values."""
+        if np.ndim(self.lattice_constant) == 0:
+            return {sympy.Symbol('a'): self.lattice_constant}
+        return {sympy.Symbol('a_' + c): a for c, a in
+                zip(sorted(self.discrete_coordinates), self.lattice_constant)}
 
-        # making kwant lattice
-        dim = len(self.discrete_coordinates)
+    def assemble_affine(self, shape, start, params, parameters=None,
+                        bbox=None):
+        """Assemble a sparse Hamiltonian for fast sweeps of parameters.
 
-        self.lattice = Monatomic(lattice_constant*np.eye(dim).reshape(dim, dim))
-        self.lattice_constant = lattice_constant
-
-        # making kwant functions
-        tb = make_kwant_functions(tb_ham, self.discrete_coordinates, verbose)
-        self.onsite = tb.pop((0,)*len(self.discrete_coordinates))
-        self.hoppings = {HoppingKind(d, self.lattice): val
-                         for d, val in tb.items()}
-
-    def build(self, shape, start, symmetry=None, periods=None):
-        """Build Kwant's system.
-
-        Convienient functions that simplifies building of a Kwant's system.
+        The Hamiltonian is decomposed as ``sum_k c_k(p) * M_k``, where
+        ``c_k`` are products of scalar ``parameters`` and the sparse
+        matrices ``M_k`` do not depend on them. ``M_k`` are assembled once,
+        afterwards the Hamiltonian for new values of ``parameters`` is only a
+        weighted sum of them.
 
         Parameters:
         -----------
@@ -126,35 +318,53 @@ class Discretizer(object):
             true for coordinates inside the shape, and false otherwise.
         start : 1d array-like
             The real-space origin for the flood-fill algorithm.
-        symmetry : 1d array-like
-            Deprecated. Please use ```periods=[symmetry]`` instead.
-        periods : list of tuples
-            If periods are provided a translational invariant system will be
-            built. Periods corresponds basically to a translational symmetry
-            defined in real space. This vector will be scalled by a lattice
-            constant before passing it to ``kwant.TranslationalSymmetry``.
-            Examples: ``periods=[(1,0,0)]`` or ``periods=[(1,0), (0,1)]``.
-            In second case one will need https://gitlab.kwant-project.org/cwg/wraparound
-            in order to finalize system.
+        params : object
+            Parameters passed as ``p`` to the value functions. Values of space
+            dependent parameters are taken from it once.
+        parameters : iterable of strings
+            Names of swept scalar parameters. They must enter the Hamiltonian
+            as (real) multiplicative factors. If None, all parameters that
+            are not space dependent are used.
+        bbox : pair of 1d array-likes
+            Lower and upper corners of a bounding box in real space. If
+            provided, lattice points are found with a vectorized ``shape`` as
+            in ``build``, and ``start`` is not used.
 
         Returns:
         --------
-        system : kwant.Builder instance
+        hamiltonian : discretizer.assembly.AffineHamiltonian instance
+            Calling ``hamiltonian(p)`` returns the Hamiltonian as a sparse
+            CSR matrix.
+        positions : numpy array
+            Positions of the sites, of shape ``(N, dim)``.
         """
-        if symmetry is not None:
-            warnings.warn("\nSymmetry argument is deprecated. " +
-                          "Please use ```periods=[symmetry]`` instead.",
-                          DeprecationWarning)
-            periods = [symmetry]
-
-        if periods is None:
-            sys = Builder()
-        else:
-            vecs = [self.lattice.vec(p) for p in periods]
-            sys = Builder(TranslationalSymmetry(*vecs))
+        subs = self._lattice_constant_subs()
+        tb_ham = {k: sympy.sympify(v).subs(subs)
+                  for k, v in self.symbolic_hamiltonian.items()}
+
+        if parameters is None:
+            parameters = set()
+            for val in tb_ham.values():
+                functions = {f.func.__name__ for f in
+                             val.atoms(sympy.function.AppliedUndef)}
+                parameters |= {s.name for s in val.free_symbols}
+                parameters -= functions
+            parameters -= {'x', 'y', 'z'}
 
-        sys[self.lattice.shape(shape, start)] = self.onsite
-        for hop, val in self.hoppings.items():
-            sys[hop] = val
+        onsite_key = (0,)*len(self.discrete_coordinates)
+        coefficients, terms = [], []
+        for c, term in affine_decomposition(tb_ham, parameters).items():
+            coefficients.append(make_parameter_function(c))
+            site_parameters = None
+            if self._runtime_interpolation:
+                site_parameters = self.site_parameters
+            functions = make_kwant_functions(term, self.discrete_coordinates,
+                                             vectorized=True,
+                                             site_parameters=site_parameters)
+            terms.append((functions.pop(onsite_key, None), functions))
 
-        return sys
+        tags = assembly.find_tags(shape, start, self.lattice_constant, bbox)
+        hamiltonian = assembly.AffineHamiltonian(coefficients, terms, tags,
+                                                 self.lattice_constant, params)
+        positions = assembly.tags_to_positions(tags, self.lattice_constant)
+        return hamiltonian, positions
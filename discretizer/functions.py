@@ -0,0 +1,806 @@
+from __future__ import print_function, division
+
+import types
+import warnings
+import weakref
+import functools
+import itertools
+from collections import OrderedDict
+
+import numpy as np
+
+# This module must not import sympy: it is used to compile value functions of
+# cached models without the symbolic machinery.
+
+constant_marker = '# constant'
+parameters_marker = '# parameters: '
+kernel_marker = '# kernel arguments: '
+
+
+class ParameterCachedFunction(object):
+    """Value function depending only on scalar parameters.
+
+    The value is computed once for every set of parameter values and reused
+    for all sites (hoppings).
+
+    Parameters:
+    -----------
+    function : function
+        Kwant value function. The last argument is the parameters object.
+    names : list of strings
+        Names of parameters that the value depends on.
+    maxsize : int
+        Maximal number of stored values. Default is 128.
+    """
+    def __init__(self, function, names, maxsize=128):
+        functools.update_wrapper(self, function)
+        self.function = function
+        self.names = names
+        self.maxsize = maxsize
+        self._values = OrderedDict()
+
+    def __call__(self, *args):
+        p = args[-1]
+        key = tuple(getattr(p, name) for name in self.names)
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable parameter values
+            return self.function(*args)
+
+        value = self.function(*args)
+        self._values[key] = value
+        while len(self._values) > self.maxsize:
+            self._values.popitem(last=False)
+        return value
+
+
+class SiteParameterCache(object):
+    """Values of space dependent parameters at lattice sites.
+
+    Every parameter is evaluated at most once per site and the values are
+    shared by all value functions of a model. Calls at points between sites,
+    e.g. ``A(x + a/2)``, are interpolated (multi)linearly from the values at
+    the neighbouring sites. Bound parameters accept scalar coordinates as
+    well as arrays of them.
+
+    Parameters:
+    -----------
+    lattice_constant : float or 1d array-like
+        Lattice constant of the cubic lattice, or lattice constants along
+        every discrete coordinate of an orthorhombic lattice.
+    dim : int
+        Number of discrete coordinates.
+    tolerance : float
+        Relative distance from a site below which a point is treated as the
+        site itself. Default is 1e-8.
+    """
+    def __init__(self, lattice_constant, dim, tolerance=1e-8):
+        self.spacing = np.broadcast_to(np.asarray(lattice_constant,
+                                                  dtype=float), (dim,))
+        self.tolerance = tolerance
+        self._parameters = {}
+
+    def bind(self, name, function, axes):
+        """Return a cached and interpolating variant of ``function``.
+
+        Parameters:
+        -----------
+        name : string
+            Name of the parameter.
+        function : function
+            Value of the parameter, ``p.<name>``. When a different function
+            is bound under the same name, the stored values are discarded.
+            ``GridParameter`` instances are returned unchanged.
+        axes : tuple of ints
+            For every argument of ``function`` the index of the corresponding
+            discrete coordinate (in alphabetical order).
+        """
+        if isinstance(function, GridParameter):
+            # indexed directly, caching would not save anything
+            return function
+
+        parameter = self._parameters.get((name, axes))
+        if parameter is None or parameter.function is not function:
+            parameter = _CachedParameter(function, self.spacing[list(axes)],
+                                         self.tolerance)
+            self._parameters[name, axes] = parameter
+        return parameter
+
+    def clear(self):
+        """Discard all stored values."""
+        self._parameters.clear()
+
+    def __reduce__(self):
+        # stored values refer to parameter functions, which are not sent
+        return SiteParameterCache, (self.spacing, len(self.spacing),
+                                    self.tolerance)
+
+
+class _CachedParameter(object):
+    def __init__(self, function, spacing, tolerance):
+        functools.update_wrapper(self, function)
+        self.function = function
+        self.spacing = spacing
+        self.tolerance = tolerance
+        self.values = {}
+
+    def _evaluate(self, tags):
+        """Evaluate the function at all sites in ``tags`` not stored yet."""
+        if tags[0].ndim == 0:
+            key = tuple(int(t) for t in tags)
+            if key not in self.values:
+                self.values[key] = self.function(*(key * self.spacing))
+            return
+
+        keys = zip(*[t.ravel().tolist() for t in tags])
+        missing = list({k for k in keys if k not in self.values})
+        if missing:
+            positions = np.array(missing, dtype=float) * self.spacing
+            values = np.broadcast_to(self.function(*positions.T),
+                                     (len(missing),))
+            self.values.update(zip(missing, values.tolist()))
+
+    def _lookup(self, tags):
+        if tags[0].ndim == 0:
+            return self.values[tuple(int(t) for t in tags)]
+        keys = zip(*[t.ravel().tolist() for t in tags])
+        return np.reshape([self.values[k] for k in keys], tags[0].shape)
+
+    def __call__(self, *coordinates):
+        corners = _interpolation_corners(coordinates, 0, self.spacing,
+                                         self.tolerance)
+        tags = corners[0][0]
+        if tags[0].ndim == 0:
+            for tags, _ in corners:
+                self._evaluate(tags)
+        else:
+            self._evaluate([np.concatenate([t[i].ravel() for t, _ in corners])
+                            for i in range(len(tags))])
+
+        output = 0
+        for tags, weight in corners:
+            output = output + weight * self._lookup(tags)
+        return np.asarray(output)[()] if np.ndim(output) == 0 else output
+
+
+class GridParameter(object):
+    """Space dependent parameter sampled on a regular grid.
+
+    Instances can be used as values of space dependent parameters, e.g. to
+    pass potentials obtained from a Poisson solver. Calls at grid points index
+    the array directly, calls between them interpolate (multi)linearly. Arrays
+    of coordinates (vectorized value functions, ``assemble``) are gathered in
+    bulk.
+
+    Parameters:
+    -----------
+    values : array-like
+        Values of the parameter on the grid, with one axis per argument of
+        the parameter.
+    origin : float or 1d array-like
+        Position of the grid point ``values[0, ..., 0]``. Default is 0.
+    spacing : float or 1d array-like
+        Distance of grid points along every axis. Default is 1.
+    clip : bool
+        If True, positions outside the grid take the values at its boundary,
+        otherwise a ValueError is raised for them. Default is False.
+    tolerance : float
+        Relative distance from a grid point below which a position is treated
+        as the grid point itself. Default is 1e-8.
+    """
+    def __init__(self, values, origin=0, spacing=1, clip=False,
+                 tolerance=1e-8):
+        self.values = np.asarray(values)
+        dim = self.values.ndim
+        self.origin = np.broadcast_to(np.asarray(origin, dtype=float), (dim,))
+        self.spacing = np.broadcast_to(np.asarray(spacing, dtype=float),
+                                       (dim,))
+        self.clip = clip
+        self.tolerance = tolerance
+
+    def __call__(self, *coordinates):
+        if len(coordinates) != self.values.ndim:
+            msg = ('GridParameter of {} dimensions takes {} arguments, '
+                   'but {} were given.')
+            raise TypeError(msg.format(self.values.ndim, self.values.ndim,
+                                       len(coordinates)))
+
+        corners = _interpolation_corners(coordinates, self.origin,
+                                         self.spacing, self.tolerance)
+        shape = self.values.shape
+        output = 0
+        for tags, weight in corners:
+            if self.clip:
+                tags = [np.clip(t, 0, n - 1) for t, n in zip(tags, shape)]
+            elif not all(np.all((t >= 0) & (t < n))
+                         for t, n in zip(tags, shape)):
+                raise ValueError('Positions outside of the grid.')
+            output = output + weight * self.values[tuple(tags)]
+        return output
+
+
+def _interpolation_corners(coordinates, origin, spacing, tolerance):
+    """Grid points and weights for (multi)linear interpolation.
+
+    Parameters:
+    -----------
+    coordinates : sequence of floats or arrays
+        Coordinates of the interpolated points, one per axis of the grid.
+    origin, spacing : float or 1d array-like
+        Position of the grid point with zero indices and distance of grid
+        points along every axis.
+    tolerance : float
+        Relative distance below which a point is treated as a grid point.
+
+    Returns:
+    --------
+    corners : list of tuples
+        Pairs ``(indices, weight)`` where ``indices`` is a list with the
+        integer indices of grid points along every axis. Only axes along
+        which some point lies between grid points are interpolated.
+    """
+    dim = len(coordinates)
+    coordinates = np.broadcast_arrays(*[np.asarray(c, dtype=float)
+                                        for c in coordinates])
+    origin = np.broadcast_to(origin, (dim,))
+    spacing = np.broadcast_to(spacing, (dim,))
+
+    lower, fractions = [], []
+    for c, o, s in zip(coordinates, origin, spacing):
+        t = (c - o) / s
+        tag = np.floor(t + tolerance)
+        fraction = t - tag
+        fraction = np.where(fraction < tolerance, 0, fraction)
+        lower.append(tag.astype(int))
+        fractions.append(fraction)
+
+    # Points on the grid along an axis use the same grid point for both
+    # corners, such that only points with non-zero weights are used.
+    axes = [i for i, f in enumerate(fractions) if np.any(f)]
+    corners = []
+    for corner in itertools.product((0, 1), repeat=len(axes)):
+        tags = list(lower)
+        weight = 1
+        for i, upper in zip(axes, corner):
+            if upper:
+                tags[i] = lower[i] + (fractions[i] > 0)
+                weight = weight * fractions[i]
+            else:
+                weight = weight * (1 - fractions[i])
+        corners.append((tags, weight))
+    return corners
+
+
+def _stack_matrix(rows, n):
+    """Stack a nested list of scalars or arrays into an ``(n, i, j)`` array.
+
+    Used by the vectorized value functions: every entry is broadcasted
+    against the number of evaluated sites ``n``.
+    """
+    dtype = np.result_type(float, *[np.asarray(v) for row in rows
+                                    for v in row])
+    output = np.empty((n, len(rows), len(rows[0])), dtype=dtype)
+    for i, row in enumerate(rows):
+        for j, value in enumerate(row):
+            output[:, i, j] = value
+    return output
+
+
+def value_function(content, name='_anonymous_func', onsite=True, verbose=False,
+                   vectorized=False, site_parameters=None):
+    """Generate a Kwant value function from a list of lines containing its body.
+
+    Parameters:
+    -----------
+    content : list of lines
+        Lines forming the body of the function.
+    name : string
+        Function name (not important).
+    onsite : bool
+        If True, the function call signature will be `f(site, p)`, otherwise
+        `f(site1, site2, p)`.
+    verbose : bool
+        Whether the function bodies should be printed.
+    vectorized : bool
+        If True, the function takes arrays of site positions instead of sites,
+        i.e. its call signature is `f(pos, p)` or `f(pos1, pos2, p)`.
+    site_parameters : SiteParameterCache instance
+        Cache available to the function as ``_site_parameters``.
+
+    Returns:
+    --------
+    f : ValueFunction instance
+        The function defined in a separated namespace.
+    """
+    func_code = function_source(content, name, onsite, vectorized)
+
+    if verbose:
+        print(func_code)
+    return ValueFunction(func_code, name, site_parameters)
+
+
+class ValueFunction(object):
+    """Function defined by generated source, that can be pickled.
+
+    The function is pickled as its source and rebuilt when unpickled, such
+    that value functions, and kwant systems using them, can be sent to
+    other processes. The signature is that of the defined function.
+
+    Parameters:
+    -----------
+    source : string
+        Source defining the function.
+    name : string
+        Name of the function in ``source``.
+    site_parameters : SiteParameterCache instance
+        Cache available to the function as ``_site_parameters``.
+    """
+    def __init__(self, source, name, site_parameters=None):
+        self.source = source
+        self.name = name
+        self.site_parameters = site_parameters
+
+        namespace = _function_namespace()
+        namespace['_site_parameters'] = site_parameters
+        exec(source, namespace)
+        self.function = namespace[name]
+        functools.update_wrapper(self, self.function)
+
+    def __call__(self, *args):
+        return self.function(*args)
+
+    def __reduce__(self):
+        return ValueFunction, (self.source, self.name, self.site_parameters)
+
+
+def function_source(content, name='_anonymous_func', onsite=True,
+                    vectorized=False):
+    """Return the source of a value function with body ``content``.
+
+    Parameters are as in ``value_function``.
+    """
+    if not content[-1].startswith('return'):
+        raise ValueError('The function does not end with a return statement')
+
+    separator = '\n' + 4 * ' '
+    if not vectorized:
+        site_string = 'site' if onsite else 'site1, site2'
+    else:
+        site_string = 'pos' if onsite else 'pos1, pos2'
+    header = 'def {0}({1}, p):'.format(name, site_string)
+    return separator.join([header] + list(content))
+
+
+def _function_namespace():
+    """Namespace in which generated functions are defined."""
+    namespace = {}
+    exec("from __future__ import division", namespace)
+    exec("import numpy as np", namespace)
+    exec("from numpy import *", namespace)
+    namespace['_stack_matrix'] = _stack_matrix
+    return namespace
+
+
+def compile_functions(function_lines, verbose=False, vectorized=False,
+                      site_parameters=None):
+    """Turn bodies generated by ``make_function_lines`` into functions.
+
+    Parameters:
+    -----------
+    function_lines : dict
+        dict in which key is offset of hopping ((0, 0, 0) for onsite)
+        and value is a list of lines forming the function body.
+    verbose : bool
+        Whether the function bodies should be printed.
+    vectorized : bool
+        Whether the bodies were generated for array-mode functions.
+    site_parameters : SiteParameterCache instance
+        Cache shared by all functions, required by bodies generated with
+        ``site_parameters=True``.
+
+    Returns:
+    --------
+    functions : dict
+        dict in which key is offset of hopping and value is the function.
+        Values of functions that do not depend on position or parameters
+        are precomputed and stored instead of the function. Functions that
+        depend only on parameters are wrapped in ``ParameterCachedFunction``.
+    """
+    functions = {}
+    for offset, lines in function_lines.items():
+        onsite = True if all(i == 0 for i in offset) else False
+
+        if verbose:
+            print("Function generated for {}:".format(offset))
+            f = value_function(lines, verbose=verbose, onsite=onsite,
+                               vectorized=vectorized,
+                               site_parameters=site_parameters)
+            print()
+        else:
+            f = value_function(lines, verbose=verbose, onsite=onsite,
+                               vectorized=vectorized,
+                               site_parameters=site_parameters)
+
+        if lines[0] == constant_marker:
+            f = f(*([None] * (2 if onsite else 3)))
+        elif lines[0].startswith(parameters_marker):
+            names = lines[0][len(parameters_marker):].split(', ')
+            f = ParameterCachedFunction(f, names)
+
+        functions[offset] = f
+
+    return functions
+
+
+# Numba compiled variants of parameter functions, see ``_jit``.
+_jitted = weakref.WeakKeyDictionary()
+
+
+def _grid_lookup(values, shape, origin, spacing, tolerance, clip, point):
+    """Value of a ``GridParameter`` at ``point``, compiled by ``_jit``.
+
+    ``values`` are the flattened values of the grid.
+    """
+    dim = point.shape[0]
+    lower = np.empty(dim, dtype=np.int64)
+    fractions = np.empty(dim)
+    for k in range(dim):
+        t = (point[k] - origin[k]) / spacing[k]
+        tag = np.floor(t + tolerance)
+        fraction = t - tag
+        lower[k] = int(tag)
+        fractions[k] = fraction if fraction >= tolerance else 0.
+
+    output = 0 * values[0]
+    for corner in range(2**dim):
+        weight = 1.
+        index = 0
+        for k in range(dim):
+            i = lower[k]
+            if (corner >> k) & 1:
+                i += 1
+                weight *= fractions[k]
+            else:
+                weight *= 1 - fractions[k]
+            if clip:
+                i = min(max(i, 0), shape[k] - 1)
+            elif i < 0 or i >= shape[k]:
+                if weight == 0:
+                    break
+                raise ValueError('Positions outside of the grid.')
+            index = index * shape[k] + i
+        if weight != 0:
+            output += weight * values[index]
+    return output
+
+
+def _jit_grid(grid):
+    """Numba compiled function of the coordinates of a ``GridParameter``."""
+    import numba
+
+    namespace = {'np': np, '_grid_lookup': numba.njit(_grid_lookup),
+                 '_values': np.ascontiguousarray(grid.values).ravel(),
+                 '_shape': np.array(grid.values.shape, dtype=np.int64),
+                 '_origin': np.array(grid.origin),
+                 '_spacing': np.array(grid.spacing)}
+    names = ', '.join('_x{}'.format(k) for k in range(grid.values.ndim))
+    source = ('def _grid({0}):\n'
+              '    return _grid_lookup(_values, _shape, _origin, _spacing, '
+              '{1!r}, {2!r}, np.array(({0},)))').format(
+                  names, float(grid.tolerance), bool(grid.clip))
+    exec(source, namespace)
+    return numba.njit(namespace['_grid'])
+
+
+def _jit(value):
+    """Numba compile functions passed as space dependent parameters.
+
+    Plain Python functions and ``GridParameter`` instances are compiled,
+    other values (e.g. numpy ufuncs or compiled functions) are returned
+    unchanged.
+    """
+    if isinstance(value, types.FunctionType):
+        import numba
+        jit = numba.njit
+    elif isinstance(value, GridParameter):
+        jit = _jit_grid
+    else:
+        return value
+
+    try:
+        return _jitted[value]
+    except KeyError:
+        jitted = _jitted[value] = jit(value)
+        return jitted
+
+
+class NumbaKernel(object):
+    """Value function for many sites, compiled with Numba on first use.
+
+    Space dependent parameters are compiled into the kernel, such that a
+    kernel is compiled for every set of parameter functions; the last
+    ``maxsize`` of them are kept.
+
+    Parameters:
+    -----------
+    lines : list of strings
+        Body of the kernel ``f(pos, *arguments)`` as generated by
+        ``make_kernel_lines``, beginning with ``kernel_marker`` followed by
+        the names of the parameters that are passed as ``arguments``.
+    verbose : bool
+        Whether the source of the kernel should be printed.
+    maxsize : int
+        Maximal number of stored compiled kernels. Default is 16.
+
+    Notes:
+    ------
+    If the kernel can not be compiled for some parameter functions, e.g.
+    because a function is not supported by Numba, the failure is stored in
+    place of the kernel and calling the kernel with these functions returns
+    None. Functions using the kernel then fall back to the Python
+    implementation.
+    """
+    def __init__(self, lines, verbose=False, maxsize=16):
+        arguments = lines[0][len(kernel_marker):]
+        self.arguments = arguments.split(', ') if arguments else []
+        self.lines = lines
+        self.verbose = verbose
+        self.maxsize = maxsize
+        self._kernels = OrderedDict()
+
+    def __getstate__(self):
+        # compiled kernels refer to parameter functions
+        state = self.__dict__.copy()
+        state['_kernels'] = OrderedDict()
+        return state
+
+    def _compile(self, functions):
+        import numba
+
+        names = [n for n in self.arguments if n not in functions]
+        header = 'def _kernel({}):'.format(', '.join(['pos'] + names))
+        source = ('\n' + 4 * ' ').join([header] + list(self.lines))
+        if self.verbose:
+            print(source)
+        namespace = _function_namespace()
+        namespace.update((n, _jit(f)) for n, f in functions.items())
+        exec(source, namespace)
+        return numba.njit(namespace['_kernel'])
+
+    def __call__(self, pos, p):
+        """Evaluate the kernel for positions of shape ``(N, dim)``.
+
+        Returns None if the kernel can not be compiled for the parameter
+        functions in ``p``.
+        """
+        values = [getattr(p, name) for name in self.arguments]
+        functions = {n: v for n, v in zip(self.arguments, values)
+                     if callable(v)}
+        key = tuple(id(f) for f in functions.values())
+        try:
+            kernel, _ = self._kernels[key]
+        except KeyError:
+            # functions are stored with the kernel to keep their ids valid
+            kernel = self._compile(functions)
+            self._kernels[key] = kernel, functions
+            while len(self._kernels) > self.maxsize:
+                self._kernels.popitem(last=False)
+        if kernel is None:
+            return None
+
+        arguments = [v for n, v in zip(self.arguments, values)
+                     if n not in functions]
+        try:
+            return kernel(pos, *arguments)
+        except _numba_error() as error:
+            self._kernels[key] = None, functions
+            warnings.warn('Value function could not be compiled with Numba, '
+                          'the Python implementation is used instead:\n' +
+                          str(error), RuntimeWarning)
+            return None
+
+
+def _numba_error():
+    try:
+        from numba.core.errors import NumbaError
+    except ImportError:
+        # numba < 0.49
+        from numba.errors import NumbaError
+    return NumbaError
+
+
+class NumbaFunction(object):
+    """Kwant value function evaluated by a ``NumbaKernel``.
+
+    Parameters:
+    -----------
+    kernel : NumbaKernel instance
+    function : function
+        Python implementation with the same signature, used when the kernel
+        cannot be compiled.
+    onsite : bool
+        If True, the call signature is ``f(site, p)``, otherwise
+        ``f(site1, site2, p)``.
+    vectorized : bool
+        If True, the function takes arrays of site positions instead of
+        sites, as the vectorized value functions.
+    """
+    def __init__(self, kernel, function, onsite=True, vectorized=False):
+        functools.update_wrapper(self, function)
+        self.kernel = kernel
+        self.function = function
+        self.onsite = onsite
+        self.vectorized = vectorized
+
+    def __call__(self, *args):
+        # hoppings are evaluated at the position of the source site
+        pos = args[-2]
+        if not self.vectorized:
+            pos = [pos.pos]
+        output = self.kernel(np.asarray(pos, dtype=float), args[-1])
+        if output is None:
+            return self.function(*args)
+        return output if self.vectorized else output[0]
+
+
+def compile_kernels(function_lines, kernel_lines, functions,
+                    vectorized_functions, verbose=False):
+    """Replace value functions by ``NumbaFunction`` instances.
+
+    Parameters:
+    -----------
+    function_lines : dict
+        Bodies of the scalar value functions, as passed to
+        ``compile_functions``.
+    kernel_lines : dict
+        Bodies of the kernels, as returned by ``make_kernel_lines``, keyed
+        by hopping direction.
+    functions, vectorized_functions : dict
+        Scalar and vectorized value functions returned by
+        ``compile_functions``. Precomputed constants and functions depending
+        only on parameters are kept, all other functions are replaced
+        in place.
+    verbose : bool
+        Whether the source of the kernels should be printed.
+    """
+    for offset, lines in kernel_lines.items():
+        onsite = all(i == 0 for i in offset)
+        kernel = NumbaKernel(lines, verbose)
+        scalar_lines = function_lines[offset]
+        if not (scalar_lines[0] == constant_marker or
+                scalar_lines[0].startswith(parameters_marker)):
+            functions[offset] = NumbaFunction(kernel, functions[offset],
+                                              onsite)
+        vectorized_functions[offset] = NumbaFunction(
+            kernel, vectorized_functions[offset], onsite, vectorized=True)
+
+
+_module_header = '''"""Value functions of a discretized model.
+
+Generated by discretizer {version}. The module depends only on numpy and
+``discretizer.functions``; kwant is imported by ``make_lattice`` and
+``make_hoppings``.
+"""
+from __future__ import division
+
+import numpy as np
+from numpy import *
+
+from discretizer.functions import ParameterCachedFunction
+from discretizer.functions import SiteParameterCache
+from discretizer.functions import _stack_matrix
+
+
+discrete_coordinates = set({coordinates!r})
+lattice_constant = {lattice_constant!r}
+lattice_vectors = {vectors!r}
+hopping_directions = {directions!r}
+
+_site_parameters = SiteParameterCache(lattice_constant, {dim})
+'''
+
+_module_footer = '''
+
+def make_lattice(norbs=None):
+    """Return the kwant lattice of the model."""
+    from kwant.lattice import Monatomic
+    return Monatomic(lattice_vectors, norbs=norbs)
+
+
+def make_hoppings(lattice=None):
+    """Return hopping values keyed by ``kwant.builder.HoppingKind``."""
+    from kwant import HoppingKind
+    if lattice is None:
+        lattice = make_lattice()
+    return {HoppingKind(d, lattice): hoppings[d] for d in hopping_directions}
+'''
+
+
+def _function_name(prefix, offset):
+    if all(i == 0 for i in offset):
+        return prefix + 'onsite'
+    direction = '_'.join(str(i).replace('-', 'm') for i in offset)
+    return '{}hopping_{}'.format(prefix, direction)
+
+
+def _value_source(name, offset, lines):
+    """Expression defining the value stored for a function, see
+    ``compile_functions``."""
+    onsite = all(i == 0 for i in offset)
+    if lines[0] == constant_marker:
+        arguments = ', '.join(['None'] * (2 if onsite else 3))
+        return '{}({})'.format(name, arguments)
+    elif lines[0].startswith(parameters_marker):
+        names = lines[0][len(parameters_marker):].split(', ')
+        return 'ParameterCachedFunction({}, {!r})'.format(name, names)
+    return name
+
+
+def module_source(discrete_coordinates, lattice_constant, function_lines,
+                  vectorized_lines, version=''):
+    """Return the source of a Python module defining value functions.
+
+    The module defines ``onsite``, ``hoppings``, ``vectorized_onsite`` and
+    ``vectorized_hoppings`` (hoppings keyed by direction) as the attributes
+    of ``DiscreteModel``, the lattice specification ``lattice_vectors``,
+    ``hopping_directions`` and functions ``make_lattice`` and
+    ``make_hoppings`` returning kwant objects.
+
+    Parameters:
+    -----------
+    discrete_coordinates : set of strings
+        Set of discrete coordinates.
+    lattice_constant : float or tuple of floats
+        Lattice constant of the cubic lattice, or lattice constants along
+        the discrete coordinates of an orthorhombic lattice.
+    function_lines, vectorized_lines : dict
+        Bodies of the scalar and vectorized value functions keyed by hopping
+        direction, as returned by ``make_function_lines``.
+    version : string
+        Version of discretizer recorded in the module docstring.
+
+    Returns:
+    --------
+    source : string
+    """
+    dim = len(discrete_coordinates)
+    if np.ndim(lattice_constant) == 0:
+        vectors = (lattice_constant * np.eye(dim)).tolist()
+    else:
+        vectors = np.diag(lattice_constant).tolist()
+    onsite_key = (0,) * dim
+    directions = sorted(d for d in function_lines if d != onsite_key)
+
+    parts = [_module_header.format(
+        version=version, coordinates=sorted(discrete_coordinates),
+        lattice_constant=lattice_constant, vectors=vectors,
+        directions=directions, dim=dim)]
+
+    values = {}
+    kinds = [('_', function_lines, False),
+             ('_vectorized_', vectorized_lines, True)]
+    for prefix, lines, vectorized in kinds:
+        for offset in sorted(lines):
+            name = _function_name(prefix, offset)
+            onsite = offset == onsite_key
+            source = function_source(lines[offset], name, onsite, vectorized)
+            parts.append('\n\n' + source)
+            value = name if vectorized else _value_source(name, offset,
+                                                          lines[offset])
+            values[prefix, offset] = value
+
+    hoppings = ', '.join('{!r}: {}'.format(d, values['_', d])
+                         for d in directions)
+    vectorized_hoppings = ', '.join(
+        '{!r}: {}'.format(d, values['_vectorized_', d]) for d in directions)
+    parts.append('\n')
+    parts.append('onsite = {}'.format(values['_', onsite_key]))
+    parts.append('hoppings = {{{}}}'.format(hoppings))
+    parts.append('vectorized_onsite = {}'.format(
+        values['_vectorized_', onsite_key]))
+    parts.append('vectorized_hoppings = {{{}}}'.format(vectorized_hoppings))
+    parts.append(_module_footer)
+    return '\n'.join(parts)
@@ -0,0 +1,430 @@
+from __future__ import print_function, division
+
+import warnings
+import importlib.util
+import numpy as np
+
+from .functions import compile_functions
+from .functions import module_source
+from .functions import compile_kernels
+from .functions import SiteParameterCache
+from .cache import as_cache
+from .cache import decode_lines
+from .cache import lattice_constant_key
+from .profiling import stage
+
+from . import assembly
+
+
+def _use_kernels(backend):
+    """Check ``backend`` and return whether Numba kernels can be used."""
+    if backend not in ('python', 'numba'):
+        raise ValueError("backend must be 'python' or 'numba', not "
+                         "{!r}.".format(backend))
+    if backend == 'numba' and importlib.util.find_spec('numba') is None:
+        warnings.warn("Numba is not available, backend='python' is "
+                      "used instead.", RuntimeWarning)
+        return False
+    return backend == 'numba'
+
+
+class DiscreteModel(object):
+    """Compiled value functions of a discretized Hamiltonian.
+
+    This class holds everything that is needed to build a system, but not the
+    symbolic result of the discretization. It does not import sympy, and kwant
+    only when ``lattice``, ``hoppings`` or ``build`` are used. Usually it is
+    created by ``Discretizer`` or loaded from a cache with ``from_cache``.
+
+    Parameters:
+    -----------
+    discrete_coordinates : set of strings
+        Set of discrete coordinates.
+    lattice_constant : float or tuple of floats
+        Lattice constant of the cubic lattice, or lattice constants along
+        the discrete coordinates of an orthorhombic lattice.
+    function_lines : dict
+        Bodies of the scalar value functions keyed by hopping direction (zeros
+        for onsite), as returned by ``make_function_lines``.
+    vectorized_lines : dict
+        Bodies of the vectorized value functions, as ``function_lines``.
+    verbose : bool
+        If True the generated functions are printed. Default is False.
+    kernel_lines : dict
+        If provided, bodies of Numba kernels as returned by
+        ``make_kernel_lines``. Value functions that depend on position are
+        then evaluated by the compiled kernels, see
+        ``discretizer.functions.NumbaFunction``.
+
+    Attributes:
+    -----------
+    lattice : kwant.lattice.Monatomic instance
+        Lattice to create kwant system. Lattice constants are set to
+        lattice_constant value.
+    onsite : function or constant
+        The value of the onsite Hamiltonian. Values that depend neither on
+        position nor on parameters are precomputed.
+    hoppings : dict
+        A dictionary with keys being ``kwant.builder.HoppingKind`` instances,
+        and values the corresponding value functions (or precomputed constant
+        values).
+    vectorized_onsite : function
+        Array-mode variant of ``onsite`` with signature ``f(pos, p)``. It takes
+        an array of shape ``(N, dim)`` with site positions and returns the
+        onsite values of all sites stacked in an array of shape
+        ``(N, norb, norb)``. Space dependent parameters must accept arrays.
+    vectorized_hoppings : dict
+        A dictionary with keys being the hopping directions, and values the
+        array-mode hopping functions ``f(pos1, pos2, p)``, returning arrays of
+        shape ``(N, norb, norb)``. As in kwant, ``pos1`` are the positions of
+        the target sites and ``pos2`` of the source sites.
+    site_parameters : SiteParameterCache instance
+        Values of space dependent parameters at sites, shared by all value
+        functions of a model discretized with ``interpolate='runtime'``.
+        Call ``site_parameters.clear()`` after modifying a parameter function
+        in place.
+    discrete_coordinates : set of strings
+        As in input.
+    """
+    def __init__(self, discrete_coordinates, lattice_constant, function_lines,
+                 vectorized_lines, verbose=False, kernel_lines=None):
+        self.discrete_coordinates = discrete_coordinates
+        self.lattice_constant = lattice_constant
+        self._compile(function_lines, vectorized_lines, verbose,
+                      kernel_lines=kernel_lines)
+
+    @classmethod
+    def from_cache(cls, key, lattice_constant=1, cache=True, verbose=False,
+                   backend='python'):
+        """Load value functions of a model from the on-disk cache.
+
+        Neither the input Hamiltonian nor sympy are needed, which makes
+        loading of already discretized models fast.
+
+        Parameters:
+        -----------
+        key : string
+            Key of the cache entry, e.g. ``Discretizer.cache_key``.
+        lattice_constant : float or tuple of floats
+            Lattice constant for which the model was discretized before.
+        cache : bool, string or DiscretizationCache instance
+            The cache, as ``cache`` argument of ``Discretizer``. Default is
+            True, which uses the default location.
+        verbose : bool
+            If True the generated functions are printed. Default is False.
+        backend : string
+            ``'python'`` (default) or ``'numba'``, as in ``Discretizer``.
+            Numba kernels are used only if the cache entry contains them,
+            i.e. if it was created with ``backend='numba'``.
+
+        Returns:
+        --------
+        model : DiscreteModel instance
+
+        Raises:
+        -------
+        KeyError
+            If the cache has no entry for ``key`` or no value functions for
+            ``lattice_constant``.
+        """
+        entry = as_cache(cache).load(key)
+        if entry is None:
+            raise KeyError('No cache entry with key {}.'.format(key))
+
+        sources = entry['sources'].get(lattice_constant_key(lattice_constant))
+        if sources is None:
+            msg = 'Cache entry {} has no value functions for lattice constant {}.'
+            raise KeyError(msg.format(key, lattice_constant))
+
+        kernel_lines = None
+        if _use_kernels(backend):
+            if 'kernels' in sources:
+                kernel_lines = decode_lines(sources['kernels'])
+            else:
+                warnings.warn("Cache entry {} has no Numba kernels, "
+                              "backend='python' is used instead."
+                              .format(key), RuntimeWarning)
+
+        return cls(set(entry['discrete_coordinates']), lattice_constant,
+                   decode_lines(sources['scalar']),
+                   decode_lines(sources['vectorized']), verbose, kernel_lines)
+
+    def _compile(self, function_lines, vectorized_lines, verbose=False,
+                 stats=None, kernel_lines=None):
+        onsite_key = (0,)*len(self.discrete_coordinates)
+        self._function_lines = function_lines
+        self._vectorized_lines = vectorized_lines
+        self._lattice = None
+        self._hoppings = None
+        self.site_parameters = SiteParameterCache(
+            self.lattice_constant, len(self.discrete_coordinates))
+
+        with stage(stats, 'compile', functions=len(function_lines)):
+            tb = compile_functions(function_lines, verbose,
+                                   site_parameters=self.site_parameters)
+
+        with stage(stats, 'compile_vectorized',
+                   functions=len(vectorized_lines)):
+            vectorized_tb = compile_functions(
+                vectorized_lines, verbose, vectorized=True,
+                site_parameters=self.site_parameters)
+
+        if kernel_lines is not None:
+            # kernels are compiled by Numba only when first called
+            compile_kernels(function_lines, kernel_lines, tb, vectorized_tb,
+                            verbose)
+
+        self.onsite = tb.pop(onsite_key)
+        self._direction_hoppings = tb
+        self.vectorized_onsite = vectorized_tb.pop(onsite_key)
+        self.vectorized_hoppings = vectorized_tb
+
+    def export(self, path):
+        """Write the value functions into an importable Python module.
+
+        The module depends neither on sympy nor on the input Hamiltonian, and
+        is compiled to cached bytecode when imported. It defines ``onsite``,
+        ``hoppings`` (keyed by direction), ``vectorized_onsite`` and
+        ``vectorized_hoppings`` as this model, the lattice specification
+        ``lattice_constant``, ``lattice_vectors`` and ``hopping_directions``,
+        and functions ``make_lattice()`` and ``make_hoppings(lattice=None)``
+        that return the kwant lattice and a dictionary of hopping values
+        keyed by ``kwant.builder.HoppingKind``.
+
+        Parameters:
+        -----------
+        path : string
+            Name of the written ``.py`` file.
+        """
+        from . import __version__
+
+        source = module_source(self.discrete_coordinates,
+                               self.lattice_constant, self._function_lines,
+                               self._vectorized_lines, __version__)
+        with open(path, 'w') as f:
+            f.write(source)
+
+    @property
+    def lattice(self):
+        if self._lattice is None:
+            from kwant.lattice import Monatomic
+            dim = len(self.discrete_coordinates)
+            if np.ndim(self.lattice_constant) == 0:
+                vectors = self.lattice_constant * np.eye(dim).reshape(dim, dim)
+            else:
+                vectors = np.diag(self.lattice_constant)
+            self._lattice = Monatomic(vectors)
+        return self._lattice
+
+    @property
+    def hoppings(self):
+        if self._hoppings is None:
+            from kwant import HoppingKind
+            self._hoppings = {HoppingKind(d, self.lattice): val
+                              for d, val in self._direction_hoppings.items()}
+        return self._hoppings
+
+    def build(self, shape, start=None, symmetry=None, periods=None,
+              bbox=None):
+        """Build Kwant's system.
+
+        Convienient functions that simplifies building of a Kwant's system.
+
+        Parameters:
+        -----------
+        shape : function
+            A function of real space coordinates that returns a truth value:
+            true for coordinates inside the shape, and false otherwise.
+        start : 1d array-like
+            The real-space origin for the flood-fill algorithm. Not used if
+            ``bbox`` is provided.
+        symmetry : 1d array-like
+            Deprecated. Please use ```periods=[symmetry]`` instead.
+        periods : list of tuples
+            If periods are provided a translational invariant system will be
+            built. Periods corresponds basically to a translational symmetry
+            defined in real space. This vector will be scalled by a lattice
+            constant before passing it to ``kwant.TranslationalSymmetry``.
+            Examples: ``periods=[(1,0,0)]`` or ``periods=[(1,0), (0,1)]``.
+            In second case one will need https://gitlab.kwant-project.org/cwg/wraparound
+            in order to finalize system.
+        bbox : pair of 1d array-likes
+            Lower and upper corners of a bounding box in real space. If
+            provided, ``shape`` must be vectorized: it is called with
+            positions of shape ``(N, dim)`` and returns a boolean array of
+            shape ``(N,)``. It is evaluated on the whole lattice grid inside
+            the box instead of site by site with the flood-fill algorithm,
+            and sites and hoppings are added in bulk, which is much faster
+            for large systems. All sites inside the shape and the box are
+            added, also if they are not connected.
+
+        Returns:
+        --------
+        system : kwant.Builder instance
+        """
+        if symmetry is not None:
+            warnings.warn("\nSymmetry argument is deprecated. " +
+                          "Please use ```periods=[symmetry]`` instead.",
+                          DeprecationWarning)
+            periods = [symmetry]
+
+        from kwant import Builder
+        from kwant import TranslationalSymmetry
+
+        if periods is None:
+            sys = Builder()
+        else:
+            vecs = [self.lattice.vec(p) for p in periods]
+            sys = Builder(TranslationalSymmetry(*vecs))
+
+        if bbox is None:
+            sys[self.lattice.shape(shape, start)] = self.onsite
+            for hop, val in self.hoppings.items():
+                sys[hop] = val
+            return sys
+
+        import tinyarray
+        from kwant.builder import Site
+
+        tags = assembly.grid_fill(shape, bbox, self.lattice_constant)
+        # tags are integer already, every site is created once and without
+        # normalization
+        sites = [Site(self.lattice, tinyarray.array(tag), True)
+                 for tag in tags.tolist()]
+        sys[sites] = self.onsite
+        if periods is not None:
+            # hoppings may cross the boundary of the fundamental domain
+            for hop, val in self.hoppings.items():
+                sys[hop] = val
+            return sys
+
+        index = assembly.TagIndex(tags)
+        for d, val in self._direction_hoppings.items():
+            targets = index(tags + np.array(d))
+            present = targets >= 0
+            pairs = zip(targets[present].tolist(),
+                        np.flatnonzero(present).tolist())
+            sys[((sites[i], sites[j]) for i, j in pairs)] = val
+
+        return sys
+
+    def assemble(self, shape, start, params, bbox=None):
+        """Assemble a sparse Hamiltonian matrix without building a system.
+
+        Lattice points inside the shape are enumerated and all onsites and
+        hoppings are evaluated with the vectorized value functions, such that
+        space dependent parameters must accept arrays of coordinates.
+
+        Parameters:
+        -----------
+        shape : function
+            A function of real space coordinates that returns a truth value:
+            true for coordinates inside the shape, and false otherwise.
+        start : 1d array-like
+            The real-space origin for the flood-fill algorithm.
+        params : object
+            Parameters passed as ``p`` to the value functions.
+        bbox : pair of 1d array-likes
+            Lower and upper corners of a bounding box in real space. If
+            provided, lattice points are found with a vectorized ``shape`` as
+            in ``build``, and ``start`` is not used.
+
+        Returns:
+        --------
+        hamiltonian : scipy.sparse.csr_matrix instance
+            Hamiltonian matrix. Orbitals of every site are stored
+            consecutively.
+        positions : numpy array
+            Positions of the sites, of shape ``(N, dim)``.
+        """
+        tags = assembly.find_tags(shape, start, self.lattice_constant, bbox)
+        hamiltonian = assembly.assemble(self.vectorized_onsite,
+                                        self.vectorized_hoppings, tags,
+                                        self.lattice_constant, params)
+        positions = assembly.tags_to_positions(tags, self.lattice_constant)
+        return hamiltonian, positions
+
+    def iter_coo(self, shape, bbox, params, chunk_size=2**20):
+        """Evaluate the Hamiltonian matrix in COO blocks with bounded memory.
+
+        The lattice points inside a vectorized shape and a bounding box are
+        walked in slabs, such that neither a system nor the whole matrix are
+        ever stored. Sites are ordered as in ``assemble`` with ``bbox``.
+
+        Parameters:
+        -----------
+        shape : function
+            A function of real space coordinates of shape ``(N, dim)`` that
+            returns a boolean array of shape ``(N,)``: true for coordinates
+            inside the shape, and false otherwise.
+        bbox : pair of 1d array-likes
+            Lower and upper corners of the bounding box in real space.
+        params : object
+            Parameters passed as ``p`` to the value functions.
+        chunk_size : int
+            Approximate number of lattice points in a slab.
+
+        Yields:
+        -------
+        rows, cols, data : numpy arrays
+            Matrix elements of a block in COO format.
+        """
+        return assembly.iter_coo(self.vectorized_onsite,
+                                 self.vectorized_hoppings, shape, bbox,
+                                 self.lattice_constant, params, chunk_size)
+
+    def save_coo(self, prefix, shape, bbox, params, chunk_size=2**20):
+        """Assemble the Hamiltonian matrix into memory-mapped ``.npy`` files.
+
+        Matrix elements from ``iter_coo`` are written to
+        ``<prefix>_rows.npy``, ``<prefix>_cols.npy`` and ``<prefix>_data.npy``,
+        site positions to ``<prefix>_positions.npy`` and the matrix shape to
+        ``<prefix>_shape.npy``, e.g. for out-of-core solvers.
+
+        Parameters:
+        -----------
+        prefix : string
+            Path prefix of the output files.
+        shape, bbox, params, chunk_size
+            As in ``iter_coo``.
+
+        Returns:
+        --------
+        rows, cols, data : numpy memmap instances
+            Matrix elements in COO format.
+        positions : numpy memmap instance
+            Positions of the sites, of shape ``(N, dim)``.
+        shape : tuple of ints
+            Shape of the matrix.
+        """
+        return assembly.save_coo(prefix, self.vectorized_onsite,
+                                 self.vectorized_hoppings, shape, bbox,
+                                 self.lattice_constant, params, chunk_size)
+
+    def bulk_hamiltonian(self, k_array, params, pos=None):
+        """Evaluate the Bloch Hamiltonian of the discretized model.
+
+        All momenta are evaluated in one batch with the vectorized value
+        functions, which is useful e.g. to compare the dispersion of the
+        discretized model with the continuum one.
+
+        Parameters:
+        -----------
+        k_array : array-like
+            Momenta of shape ``(Nk, dim)`` with components along the sorted
+            discrete coordinates, or of shape ``(Nk,)`` if ``dim`` is 1.
+        params : object
+            Parameters passed as ``p`` to the value functions.
+        pos : 1d array-like
+            Position at which space dependent parameters are evaluated.
+            Default is the origin.
+
+        Returns:
+        --------
+        hamiltonian : numpy array
+            Hamiltonians of shape ``(Nk, norbs, norbs)``.
+        """
+        return assembly.bulk_hamiltonian(self.vectorized_onsite,
+                                         self.vectorized_hoppings, k_array,
+                                         self.lattice_constant, params, pos)
+
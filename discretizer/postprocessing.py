@@ -5,13 +5,28 @@ from sympy.utilities.lambdify import lambdastr
 from sympy.printing.lambdarepr import LambdaPrinter
 from sympy.core.function import AppliedUndef
 
+from .functions import constant_marker
+from .functions import parameters_marker
+from .functions import kernel_marker
+from .functions import value_function
+from .functions import ValueFunction
+from .functions import compile_functions
+
+__all__ = ['NumericPrinter', 'offset_to_direction', 'make_cse_lines',
+           'make_return_string', 'assign_symbols', 'function_axes',
+           'make_parameter_function', 'affine_decomposition',
+           'make_function_lines', 'make_kernel_lines', 'make_kwant_functions',
+           # moved to discretizer.functions, re-exported for compatibility
+           'value_function']
+
 
 class NumericPrinter(LambdaPrinter):
     def _print_ImaginaryUnit(self, expr):
         return "1.j"
 
 
-def offset_to_direction(discrete_hamiltonian, discrete_coordinates):
+def offset_to_direction(discrete_hamiltonian, discrete_coordinates,
+                        anisotropic=False):
     """Translate hopping keys from offsets to directions.
 
     Parameters:
@@ -21,6 +36,9 @@ def offset_to_direction(discrete_hamiltonian, discrete_coordinates):
         corresponds to symbolic hopping.
     discrete_coordinates: set
         Set of discrete coordinates.
+    anisotropic : bool
+        Whether hoppings contain separate lattice constants ``a_x, a_y, a_z``
+        instead of ``a``. Default is False.
 
     Returns:
     --------
@@ -33,26 +51,80 @@ def offset_to_direction(discrete_hamiltonian, discrete_coordinates):
     Coordinates (x,y,z) in output stands for a position of a source of the
     hopping.
     """
-    coordinates = sorted(list(discrete_coordinates))
-    coordinates = [sympy.Symbol(s, commutative=False) for s in coordinates]
-    a = sympy.Symbol('a')
+    names = sorted(list(discrete_coordinates))
+    coordinates = [sympy.Symbol(s, commutative=False) for s in names]
+    if anisotropic:
+        lattice_constants = [sympy.Symbol('a_' + s) for s in names]
+    else:
+        lattice_constants = [sympy.Symbol('a')] * len(names)
 
     onsite_zeros = (0,)*len(discrete_coordinates)
     output = {onsite_zeros: discrete_hamiltonian.pop(onsite_zeros)}
     for offset, hopping in discrete_hamiltonian.items():
         direction = tuple(-c for c in offset)
-        subs = {c: c + d*a for c, d in zip(coordinates, direction)}
+        subs = {c: c + d*a for c, d, a in zip(coordinates, direction,
+                                              lattice_constants)}
         output[direction] = hopping.subs(subs)
 
     return output
 
 # ************ Making kwant functions ***********
-def make_return_string(expr):
+def _print_expression(expr):
+    """Print a sympy expression into an evaluatable Python string."""
+    expr = expr.subs(sympy.I, sympy.Symbol('1.j')) # quick hack
+    output = lambdastr((), expr, printer=NumericPrinter)[len('lambda : '):]
+    output = output.replace('MutableDenseMatrix', 'np.array')
+    output = output.replace('ImmutableMatrix', 'np.array')
+    output = output.replace('ImmutableDenseMatrix', 'np.array')
+    return output
+
+
+def make_cse_lines(expr):
+    """Extract common subexpressions of ``expr`` into assignments.
+
+    All entries of a matrix are processed together, so each distinct
+    sub-expression (in particular each call of a space dependent function)
+    is evaluated only once.
+
+    Parameters:
+    -----------
+    expr : sympy.Expr or sympy.Matrix instance
+
+    Returns:
+    --------
+    lines : list of strings
+        Assignments ``_cse0 = ...`` of the common subexpressions.
+    expr : sympy.Expr or sympy.Matrix instance
+        Input expression rewritten in terms of the ``_cse`` symbols.
+    """
+    expr = sympy.sympify(expr)
+    if isinstance(expr, sympy.MatrixBase):
+        entries = list(expr)
+    else:
+        entries = [expr]
+
+    symbols = sympy.numbered_symbols('_cse')
+    replacements, reduced = sympy.cse(entries, symbols=symbols)
+    lines = ['{} = {}'.format(symbol, _print_expression(sub))
+             for symbol, sub in replacements]
+
+    if isinstance(expr, sympy.MatrixBase):
+        reduced = sympy.Matrix(expr.shape[0], expr.shape[1], reduced)
+    else:
+        reduced = reduced[0]
+
+    return lines, reduced
+
+
+def make_return_string(expr, vectorized=False):
     """Process a sympy expression into an evaluatable Python return statement.
 
     Parameters:
     -----------
     expr : sympy.Expr instance
+    vectorized : bool
+        If True, the return statement stacks the value for ``_n`` sites into
+        an array of shape ``(_n, norb, norb)``. Default is False.
 
     Returns:
     --------
@@ -69,16 +141,21 @@ def make_return_string(expr):
     free_symbols = {i for i in expr.free_symbols if i.name not in ['x', 'y', 'z']}
     const_symbols = free_symbols - func_symbols
 
-    expr = expr.subs(sympy.I, sympy.Symbol('1.j')) # quick hack
-    output = lambdastr((), expr, printer=NumericPrinter)[len('lambda : '):]
-    output = output.replace('MutableDenseMatrix', 'np.array')
-    output = output.replace('ImmutableMatrix', 'np.array')
+    if not vectorized:
+        output = _print_expression(expr)
+    else:
+        if not isinstance(expr, sympy.MatrixBase):
+            expr = sympy.Matrix([[expr]])
+        rows = [[_print_expression(sympy.sympify(expr[i, j]))
+                 for j in range(expr.shape[1])] for i in range(expr.shape[0])]
+        rows = ', '.join('[{}]'.format(', '.join(row)) for row in rows)
+        output = '_stack_matrix([{}], _n)'.format(rows)
 
     return 'return {}'.format(output), func_symbols, const_symbols
 
 
 def assign_symbols(func_symbols, const_symbols, discrete_coordinates,
-                   onsite=True):
+                   onsite=True, vectorized=False, function_axes=None):
     """Generate a series of assingments defining a set of symbols.
 
     Parameters:
@@ -87,6 +164,10 @@ def assign_symbols(func_symbols, const_symbols, discrete_coordinates,
         All space dependent functions that appear in the expression.
     const_symbols : set of sympy.Symbol instances
         All constants that appear in the expression.
+    function_axes : dict
+        If provided, functions are bound to the ``SiteParameterCache`` of the
+        model; the dict maps function names to the discrete coordinates of
+        their arguments, as returned by ``function_axes``.
 
     Returns:
     --------
@@ -106,12 +187,23 @@ def assign_symbols(func_symbols, const_symbols, discrete_coordinates,
     where A, B, C are symbols representing constants and f, g, h are symbols
     representing functions. Separation of constant and func symbols is probably
     not necessary but I leave it for now, just in case.
+
+    If vectorized=True the coordinates are read as columns of the position
+    array instead, `x,y,z = np.transpose(pos)` (`pos2` for hoppings), and the
+    number of sites is stored in `_n`.
+
+    If function_axes is provided, functions are assigned one per line as
+    `f = _site_parameters.bind('f', p.f, (0, 1))`.
     """
     lines = []
     func_names = [i.name for i in func_symbols]
     const_names = [i.name for i in const_symbols]
 
-    if func_names:
+    if function_axes is not None:
+        for name in sorted(func_names, reverse=True):
+            lines.insert(0, "{0} = _site_parameters.bind('{0}', p.{0}, {1})"
+                         .format(name, function_axes[name]))
+    elif func_names:
         lines.insert(0, ', '.join(func_names) + ' = p.' +
                      ', p.'.join(func_names))
 
@@ -119,96 +211,329 @@ def assign_symbols(func_symbols, const_symbols, discrete_coordinates,
         lines.insert(0, ', '.join(const_names) + ' = p.' +
                      ', p.'.join(const_names))
 
-    if onsite:
-        site = 'site'
-    else:
-        site = 'site2'
-
     names = sorted(list(discrete_coordinates))
-    lines.insert(0, '({}, ) = {}.pos'.format(', '.join(names), site))
+    if not vectorized:
+        site = 'site' if onsite else 'site2'
+        lines.insert(0, '({}, ) = {}.pos'.format(', '.join(names), site))
+    else:
+        pos = 'pos' if onsite else 'pos2'
+        lines.insert(0, '_n = len({})'.format(pos))
+        lines.insert(0, '({}, ) = np.transpose({})'.format(', '.join(names),
+                                                          pos))
 
     return lines
 
 
-def value_function(content, name='_anonymous_func', onsite=True, verbose=False):
-    """Generate a Kwant value function from a list of lines containing its body.
+def function_axes(discrete_hamiltonian, discrete_coordinates):
+    """Find the discrete coordinates of arguments of space dependent functions.
+
+    Parameters:
+    -----------
+    discrete_hamiltonian: dict
+        dict in which key is offset of hopping ((0, 0, 0) for onsite)
+        and value is corresponding symbolic hopping (onsite).
+    discrete_coordinates : set of strings
+        Set of discrete coordinates.
+
+    Returns:
+    --------
+    axes : dict
+        dict in which key is the name of a function and value is a tuple
+        with, for every argument, the index of its coordinate in the sorted
+        ``discrete_coordinates``.
+
+    Raises:
+    -------
+    ValueError
+        If an argument is not a discrete coordinate shifted by a constant, or
+        if arguments of one function differ between its applications.
+    """
+    names = sorted(discrete_coordinates)
+    axes = {}
+    for hopping in discrete_hamiltonian.values():
+        for f in sympy.sympify(hopping).atoms(AppliedUndef):
+            f_axes = []
+            for arg in f.args:
+                coordinates = [s.name for s in arg.free_symbols
+                               if s.name in ('x', 'y', 'z')]
+                if len(coordinates) != 1 or coordinates[0] not in names:
+                    msg = ("Argument '{}' of '{}' is not a discrete "
+                           "coordinate shifted by a constant.")
+                    raise ValueError(msg.format(arg, f))
+                f_axes.append(names.index(coordinates[0]))
+            name = f.func.__name__
+            if axes.setdefault(name, tuple(f_axes)) != tuple(f_axes):
+                msg = "Function '{}' is applied to different coordinates."
+                raise ValueError(msg.format(name))
+    return axes
+
+
+def make_parameter_function(expr, name='_coefficient'):
+    """Generate a function ``f(p)`` evaluating an expression of parameters.
 
     Parameters:
     -----------
-    content : list of lines
-        Lines forming the body of the function.
+    expr : sympy.Expr instance
+        Expression depending only on scalar parameters.
     name : string
         Function name (not important).
-    onsite : bool
-        If True, the function call signature will be `f(site, p)`, otherwise
-        `f(site1, site2, p)`.
-    verbose : bool
-        Whether the function bodies should be printed.
 
     Returns:
     --------
-    f : function
+    f : ValueFunction instance
         The function defined in a separated namespace.
     """
-    if not content[-1].startswith('return'):
-        raise ValueError('The function does not end with a return statement')
-
-    separator = '\n' + 4 * ' '
-    site_string = 'site' if onsite else 'site1, site2'
-    header = 'def {0}({1}, p):'.format(name, site_string)
-    func_code = separator.join([header] + list(content))
+    return_string, func_symbols, const_symbols = make_return_string(expr)
+    if func_symbols:
+        raise ValueError('Expression {} depends on functions.'.format(expr))
+
+    lines = ['def {}(p):'.format(name)]
+    names = sorted(s.name for s in const_symbols)
+    if names:
+        lines.append(', '.join(names) + ' = p.' + ', p.'.join(names))
+    lines.append(return_string)
+
+    return ValueFunction(('\n' + 4 * ' ').join(lines), name)
+
+
+def _split_parameters(summand, parameters):
+    """Split a summand into a parameter coefficient and the remainder."""
+    coefficient, remainder = [], []
+    factors = summand.args if isinstance(summand, sympy.Mul) else [summand]
+    for factor in factors:
+        names = {s.name for s in factor.free_symbols}
+        if not names & parameters:
+            remainder.append(factor)
+        elif names <= parameters and not factor.atoms(AppliedUndef):
+            coefficient.append(factor)
+        else:
+            msg = "Term '{}' is not a product of parameters {} and the rest."
+            raise ValueError(msg.format(summand, sorted(parameters)))
+    return sympy.Mul(*coefficient), sympy.Mul(*remainder)
 
-    namespace = {}
-    if verbose:
-        print(func_code)
-    exec("from __future__ import division", namespace)
-    exec("import numpy as np", namespace)
-    exec("from numpy import *", namespace)
-    exec(func_code, namespace)
-    return namespace[name]
 
+def affine_decomposition(discrete_hamiltonian, parameters):
+    """Decompose a discrete hamiltonian into terms linear in parameters.
 
-def make_kwant_functions(discrete_hamiltonian, discrete_coordinates,
-                         verbose=False):
-    """Transform discrete hamiltonian into valid kwant functions.
+    Every onsite (hopping) is written as ``sum_k c_k(params) * M_k``, where
+    ``c_k`` are products of ``parameters`` and ``M_k`` do not depend on them.
 
     Parameters:
     -----------
     discrete_hamiltonian: dict
         dict in which key is offset of hopping ((0, 0, 0) for onsite)
         and value is corresponding symbolic hopping (onsite).
+    parameters : iterable of strings
+        Names of scalar parameters.
 
-    verbose : bool
-        Whether the function bodies should be printed.
+    Returns:
+    --------
+    decomposition : dict
+        dict in which key is the coefficient ``c_k`` (``1`` for the part
+        independent of parameters) and value is a discrete hamiltonian with
+        the corresponding ``M_k``.
+
+    Raises:
+    -------
+    ValueError
+        If a term depends on parameters in a non-multiplicative way, for
+        example through arguments of a function.
+    """
+    parameters = set(parameters)
+    decomposition = {}
+    for offset, hopping in discrete_hamiltonian.items():
+        hopping = sympy.sympify(hopping)
+        if isinstance(hopping, sympy.MatrixBase):
+            shape = hopping.shape
+            entries = list(hopping)
+        else:
+            shape = None
+            entries = [hopping]
+
+        for index, entry in enumerate(entries):
+            entry = sympy.expand(entry)
+            summands = entry.args if isinstance(entry, sympy.Add) else [entry]
+            for summand in summands:
+                if summand == 0:
+                    continue
+                coefficient, remainder = _split_parameters(summand, parameters)
+                terms = decomposition.setdefault(coefficient, {})
+                if shape is None:
+                    terms[offset] = terms.get(offset, 0) + remainder
+                else:
+                    if offset not in terms:
+                        terms[offset] = sympy.zeros(*shape)
+                    terms[offset][index] += remainder
+
+    return decomposition
+
+
+def make_function_lines(discrete_hamiltonian, discrete_coordinates,
+                        vectorized=False, cse=True, site_parameters=False):
+    """Generate bodies of value functions for a discrete hamiltonian.
 
+    Parameters:
+    -----------
+    discrete_hamiltonian: dict
+        dict in which key is offset of hopping ((0, 0, 0) for onsite)
+        and value is corresponding symbolic hopping (onsite).
     discrete_coordinates : tuple/list
         List of discrete coordinates. Must corresponds to offsets in
         discrete_hamiltonian keys.
+    vectorized : bool
+        If True, bodies of array-mode functions are generated.
+    cse : bool
+        If True, common subexpressions of all entries of the onsite (hopping)
+        are evaluated only once per call. Default is True.
+    site_parameters : bool
+        If True, space dependent functions are read through the
+        ``SiteParameterCache`` of the model, which evaluates them once per
+        site and interpolates values between sites numerically.
+        Default is False.
 
-    Note:
-    -----
+    Returns:
+    --------
+    function_lines : dict
+        dict in which key is offset of hopping and value is a list of lines
+        forming the body of the corresponding value function.
 
+    Notes:
+    ------
+    Bodies of functions that do not depend on the position begin with a
+    comment line: ``constant_marker`` if they depend on no parameters at
+    all, otherwise ``parameters_marker`` followed by the parameter names.
+    ``compile_functions`` uses it to precompute or cache the values.
     """
     dim = len(discrete_coordinates)
     if not all(len(i)==dim for i in list(discrete_hamiltonian.keys())):
         raise ValueError("Dimension of offsets and discrete_coordinates" +
                          "do not match.")
 
-    functions = {}
+    axes = None
+    if site_parameters:
+        axes = function_axes(discrete_hamiltonian, discrete_coordinates)
+
+    function_lines = {}
     for offset, hopping in discrete_hamiltonian.items():
         onsite = True if all(i == 0 for i in offset) else False
-        return_string, func_symbols, const_symbols = make_return_string(hopping)
+        return_string, func_symbols, const_symbols = \
+            make_return_string(hopping, vectorized=vectorized)
         lines = assign_symbols(func_symbols, const_symbols, onsite=onsite,
-                               discrete_coordinates=discrete_coordinates)
+                               discrete_coordinates=discrete_coordinates,
+                               vectorized=vectorized, function_axes=axes)
+
+        free_names = {s.name for s in sympy.sympify(hopping).free_symbols}
+        if not (vectorized or func_symbols or free_names & {'x', 'y', 'z'}):
+            # coordinates are not needed
+            lines.pop(0)
+            if const_symbols:
+                names = sorted(s.name for s in const_symbols)
+                lines.insert(0, parameters_marker + ', '.join(names))
+            else:
+                lines.insert(0, constant_marker)
+
+        if cse:
+            cse_lines, hopping = make_cse_lines(hopping)
+            lines.extend(cse_lines)
+            return_string, _, _ = make_return_string(hopping,
+                                                     vectorized=vectorized)
         lines.append(return_string)
+        function_lines[offset] = lines
 
-        if verbose:
-            print("Function generated for {}:".format(offset))
-            f = value_function(lines, verbose=verbose, onsite=onsite)
-            print()
-        else:
-            f = value_function(lines, verbose=verbose, onsite=onsite)
+    return function_lines
+
+
+def make_kernel_lines(discrete_hamiltonian, discrete_coordinates):
+    """Generate bodies of Numba kernels for a discrete hamiltonian.
+
+    Every kernel ``f(pos, *arguments)`` loops over positions of shape
+    ``(N, dim)`` and fills the ``(N, norb, norb)`` output element by element,
+    see ``discretizer.functions.NumbaKernel``.
+
+    Parameters:
+    -----------
+    discrete_hamiltonian: dict
+        dict in which key is offset of hopping ((0, 0, 0) for onsite)
+        and value is corresponding symbolic hopping (onsite).
+    discrete_coordinates : tuple/list
+        List of discrete coordinates. Must corresponds to offsets in
+        discrete_hamiltonian keys.
+
+    Returns:
+    --------
+    kernel_lines : dict
+        dict in which key is offset of hopping and value is a list of lines
+        forming the body of the kernel. The first line is ``kernel_marker``
+        followed by names of the parameters passed to the kernel.
+    """
+    names = sorted(discrete_coordinates)
+    kernel_lines = {}
+    for offset, hopping in discrete_hamiltonian.items():
+        hopping = sympy.sympify(hopping)
+        if not isinstance(hopping, sympy.MatrixBase):
+            hopping = sympy.Matrix([[hopping]])
+        _, func_symbols, const_symbols = make_return_string(hopping)
+        arguments = sorted(s.name for s in const_symbols | func_symbols)
+        dtype = 'complex128' if hopping.has(sympy.I) else 'float64'
+
+        body = ['{} = pos[_i, {}]'.format(name, i)
+                for i, name in enumerate(names)]
+        cse_lines, hopping = make_cse_lines(hopping)
+        body.extend(cse_lines)
+        for i in range(hopping.shape[0]):
+            for j in range(hopping.shape[1]):
+                if hopping[i, j] != 0:
+                    body.append('_out[_i, {}, {}] = {}'.format(
+                        i, j, _print_expression(hopping[i, j])))
+
+        lines = [kernel_marker + ', '.join(arguments),
+                 '_n = pos.shape[0]',
+                 '_out = np.zeros((_n, {}, {}), dtype=np.{})'.format(
+                     hopping.shape[0], hopping.shape[1], dtype),
+                 'for _i in range(_n):']
+        lines.extend(4 * ' ' + line for line in body)
+        lines.append('return _out')
+        kernel_lines[offset] = lines
+
+    return kernel_lines
+
+
+def make_kwant_functions(discrete_hamiltonian, discrete_coordinates,
+                         verbose=False, vectorized=False,
+                         site_parameters=None):
+    """Transform discrete hamiltonian into valid kwant functions.
+
+    Parameters:
+    -----------
+    discrete_hamiltonian: dict
+        dict in which key is offset of hopping ((0, 0, 0) for onsite)
+        and value is corresponding symbolic hopping (onsite).
+
+    verbose : bool
+        Whether the function bodies should be printed.
+
+    discrete_coordinates : tuple/list
+        List of discrete coordinates. Must corresponds to offsets in
+        discrete_hamiltonian keys.
 
-        functions[offset] = f
+    vectorized : bool
+        If True, array-mode functions are generated. They take arrays of
+        shape ``(N, dim)`` with site positions (``f(pos, p)`` for onsite,
+        ``f(pos1, pos2, p)`` for hoppings) and return the values for all
+        sites stacked in an array of shape ``(N, norb, norb)``. Space
+        dependent parameters must then accept arrays of coordinates.
+        Default is False.
 
-    return functions
+    site_parameters : SiteParameterCache instance
+        If provided, space dependent functions are evaluated once per site
+        through this cache, and interpolated between sites numerically.
+
+    Note:
+    -----
+
+    """
+    function_lines = make_function_lines(
+        discrete_hamiltonian, discrete_coordinates, vectorized,
+        site_parameters=site_parameters is not None)
+    return compile_functions(function_lines, verbose, vectorized,
+                             site_parameters)
@@ -0,0 +1,185 @@
+from __future__ import print_function, division
+
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def expression_size(expression):
+    """Number of operations in an expression or in all matrix elements."""
+    import sympy
+
+    if isinstance(expression, sympy.MatrixBase):
+        return sum(sympy.count_ops(e) for e in expression)
+    return sympy.count_ops(expression)
+
+
+def hamiltonian_size(discrete_hamiltonian):
+    """Total number of operations of all onsites and hoppings."""
+    import sympy
+
+    return sum(expression_size(sympy.sympify(v))
+               for v in discrete_hamiltonian.values())
+
+
+class StageStats(object):
+    """Timing of a single stage of the discretization.
+
+    Attributes:
+    -----------
+    name : string
+        Name of the stage.
+    time : float
+        Wall time of the stage in seconds.
+    info : dict
+        Additional information recorded by the stage, e.g. number of
+        hoppings, size of expressions or of the generated code.
+    """
+    def __init__(self, name, time=0, info=None):
+        self.name = name
+        self.time = time
+        self.info = {} if info is None else info
+
+    def __repr__(self):
+        return 'StageStats({!r}, time={:.4g}, info={!r})'.format(
+            self.name, self.time, self.info)
+
+
+class ElementStats(object):
+    """Timing of the discretization of a single matrix element.
+
+    Attributes:
+    -----------
+    index : tuple
+        Index ``(i, j)`` of the element, ``()`` for a scalar Hamiltonian.
+    time : float
+        Total wall time in seconds.
+    derivation_time : float
+        Time spent on application of momentum operators.
+    shortening_time : float
+        Time spent on extraction and shortening of hoppings.
+    summands : int
+        Number of summands of the expanded element.
+    input_size, output_size : int
+        Number of operations of the element and of all its hoppings.
+    hoppings : int
+        Number of hoppings (including the onsite) of the element.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.time = 0
+        self.derivation_time = 0
+        self.shortening_time = 0
+        self.summands = 0
+        self.input_size = 0
+        self.output_size = 0
+        self.hoppings = 0
+
+    def __repr__(self):
+        return ('ElementStats({!r}, time={:.4g}, summands={}, '
+                'input_size={}, output_size={})').format(
+                    self.index, self.time, self.summands, self.input_size,
+                    self.output_size)
+
+
+class DiscretizationStats(object):
+    """Statistics of the stages of ``Discretizer``.
+
+    Parameters:
+    -----------
+    callback : function
+        If provided, called with every ``StageStats`` and ``ElementStats``
+        instance as soon as it is recorded.
+
+    Attributes:
+    -----------
+    stages : OrderedDict
+        ``StageStats`` instances keyed by name of the stage, in order of
+        execution.
+    elements : list
+        ``ElementStats`` instances of all discretized matrix elements.
+    functions : dict
+        Size of the generated source of value functions, keyed by hopping
+        direction (zeros for onsite); values are dicts with ``'lines'`` and
+        ``'characters'``.
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.stages = OrderedDict()
+        self.elements = []
+        self.functions = {}
+
+    @property
+    def total_time(self):
+        """Total wall time of all stages in seconds."""
+        return sum(s.time for s in self.stages.values())
+
+    @contextmanager
+    def stage(self, name, **info):
+        """Context manager measuring wall time of a stage.
+
+        It yields the ``info`` dictionary of the stage, such that the stage
+        may record additional information in it.
+        """
+        record = StageStats(name, info=info)
+        start = time.perf_counter()
+        try:
+            yield record.info
+        finally:
+            record.time = time.perf_counter() - start
+            self.stages[name] = record
+            self._notify(record)
+
+    def add_element(self, record):
+        """Add ``ElementStats`` of a discretized matrix element."""
+        self.elements.append(record)
+        self._notify(record)
+
+    def add_functions(self, function_lines):
+        """Record size of the generated source of value functions."""
+        for direction, lines in function_lines.items():
+            self.functions[direction] = {
+                'lines': len(lines),
+                'characters': sum(len(line) + 1 for line in lines)}
+
+    def _notify(self, record):
+        if self.callback is not None:
+            self.callback(record)
+
+    def slowest_elements(self, n=5):
+        """Return ``n`` matrix elements that took longest to discretize."""
+        return sorted(self.elements, key=lambda e: e.time, reverse=True)[:n]
+
+    def report(self):
+        """Return a human readable summary as a string."""
+        lines = ['{:<22}{:>10}  {}'.format('stage', 'time [s]', 'info')]
+        for record in self.stages.values():
+            info = ', '.join('{}={}'.format(k, v)
+                             for k, v in sorted(record.info.items()))
+            lines.append('{:<22}{:>10.4f}  {}'.format(record.name,
+                                                      record.time, info))
+        lines.append('{:<22}{:>10.4f}'.format('total', self.total_time))
+
+        if self.elements:
+            lines.append('')
+            lines.append('{:<10}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+                'element', 'time [s]', 'summands', 'input', 'output',
+                'hoppings'))
+            for e in self.slowest_elements():
+                lines.append('{:<10}{:>10.4f}{:>10}{:>10}{:>10}{:>10}'.format(
+                    str(e.index), e.time, e.summands, e.input_size,
+                    e.output_size, e.hoppings))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return self.report()
+
+
+@contextmanager
+def stage(stats, name, **info):
+    """Measure a stage with ``stats.stage`` or do nothing if stats is None."""
+    if stats is None:
+        yield info
+    else:
+        with stats.stage(name, **info) as info:
+            yield info
@@ -7,6 +7,10 @@ from discretizer.algorithms import split_factors
 from discretizer.algorithms import wavefunction_name
 from discretizer.algorithms import derivate
 from discretizer.algorithms import _discretize_summand
+from discretizer.algorithms import discretize
+from discretizer.algorithms import ExpressionMemo
+from discretizer.algorithms import stencil
+from discretizer.algorithms import centred_stencil
 
 from nose.tools import raises
 from nose.tools import assert_raises
@@ -118,3 +122,177 @@ def test_discretize_summand_1():
 @raises(AssertionError)
 def test_discretize_summand_2():
     _discretize_summand(kx*A(x)+ B(x), discrete_coordinates={'x', 'y', 'z'})
+
+
+def test_discretize_memo():
+    A = sympy.Function('A')
+    hamiltonian = sympy.Matrix([[kx * A(x) * kx, kx * A(x) * kx + ky],
+                                [kx * A(x) * kx - ky, ky**2]])
+
+    memo = ExpressionMemo()
+    got = discretize(hamiltonian, {'x', 'y'}, memo=memo)
+    assert memo.hits > 0
+    assert len(memo) <= memo.maxsize
+
+    for i, j in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+        expected = discretize(hamiltonian[i, j], {'x', 'y'},
+                              memo=ExpressionMemo(maxsize=0))
+        for offset, value in expected.items():
+            assert sympy.expand(got[offset][i, j] - value) == 0
+
+    memo = ExpressionMemo(maxsize=2)
+    discretize(hamiltonian, {'x', 'y'}, memo=memo)
+    assert len(memo) == 2
+
+
+def test_discretize_parallel():
+    from concurrent.futures import ThreadPoolExecutor
+
+    A = sympy.Function('A')
+    hamiltonian = sympy.Matrix([[kx * A(x) * kx, ky * kx],
+                                [kx * ky, ky**2 + A(x)]])
+    expected = discretize(hamiltonian, {'x', 'y'})
+
+    with ThreadPoolExecutor(2) as executor:
+        got_executor = discretize(hamiltonian, {'x', 'y'}, n_jobs=3,
+                                  executor=executor)
+    got_pool = discretize(hamiltonian, {'x', 'y'}, n_jobs=2)
+
+    # compare structure, functions created in worker processes need not
+    # cancel against the originals
+    for got in [got_executor, got_pool]:
+        assert set(got) == set(expected)
+        for offset, value in expected.items():
+            assert sympy.srepr(got[offset]) == sympy.srepr(value)
+
+    for n_jobs in [0, -2, 1.5]:
+        assert_raises(ValueError, discretize, hamiltonian, {'x', 'y'},
+                      n_jobs=n_jobs)
+
+
+def test_discretize_hermitian():
+    A = sympy.Function('A')
+    alpha, beta = sympy.symbols('alpha beta')
+    hamiltonian = sympy.Matrix([
+        [kx * A(x, y) * kx + ky**2, alpha * kx - sympy.I * beta * A(x, y) * ky],
+        [kx * alpha + sympy.I * ky * beta * A(x, y), -kx * A(x, y) * kx],
+    ])
+    expected = discretize(hamiltonian, {'x', 'y'})
+    got = discretize(hamiltonian, {'x', 'y'}, hermitian=True,
+                     check_hermiticity=1)
+
+    assert set(got) == set(expected)
+    for offset, value in expected.items():
+        difference = (got[offset] - value).expand()
+        assert difference == sympy.zeros(2, 2), \
+            "Should be: {}. Not {}".format(value, got[offset])
+
+    hamiltonian[1, 0] = kx * alpha
+    assert_raises(ValueError, discretize, hamiltonian, {'x', 'y'},
+                  hermitian=True, check_hermiticity=1)
+    assert_raises(ValueError, discretize, sympy.Matrix([[kx, ky]]), {'x', 'y'},
+                  hermitian=True)
+
+
+def test_discretize_shift_engine():
+    A = sympy.Function('A')
+    alpha = sympy.Symbol('alpha')
+    tests = [
+        kx**4,
+        kx**2 * A(x) * kx**2 + alpha * ky**3,
+        kx * A(x, y) * ky + ky * A(x, y) * kx + A(x, y),
+        sympy.Matrix([[kx * A(x) * kx, alpha * ky], [alpha * ky, -kx**2]]),
+        alpha,
+    ]
+    for inp in tests:
+        expected = discretize(inp, {'x', 'y'})
+        got = discretize(inp, {'x', 'y'}, engine='shift')
+        assert set(got) == set(expected)
+        for offset, value in expected.items():
+            assert got[offset] == value, \
+                "Should be: {}. Not {}".format(value, got[offset])
+
+    assert_raises(ValueError, discretize, kx**2, {'x'}, engine='unknown')
+
+
+def test_stencil():
+    R = sympy.Rational
+    assert stencil(2) == ((-1, -1), (1, 1))
+    assert stencil(4) == ((-3, R(1, 24)), (-1, R(-9, 8)),
+                          (1, R(9, 8)), (3, R(-1, 24)))
+    for order in [0, 3, -2]:
+        assert_raises(ValueError, stencil, order)
+
+    # grid of spacing 2*h, equal to the composed stencil for order 2
+    assert centred_stencil(2, 2) == ((-2, 1), (0, -2), (2, 1))
+    assert centred_stencil(2, 4) == ((-4, R(-1, 12)), (-2, R(4, 3)),
+                                     (0, R(-5, 2)), (2, R(4, 3)),
+                                     (4, R(-1, 12)))
+    assert centred_stencil(1, 4) == ((-4, R(1, 12)), (-2, R(-2, 3)),
+                                     (2, R(2, 3)), (4, R(-1, 12)))
+    assert_raises(ValueError, centred_stencil, 0, 2)
+    assert_raises(ValueError, centred_stencil, 2, 3)
+
+
+def test_discretize_accuracy_order():
+    a = sympy.Symbol('a')
+    A = sympy.Function('A')
+
+    assert discretize(kx**2, {'x'}, accuracy_order=2) == \
+        discretize(kx**2, {'x'})
+
+    # error of the dispersion of kx**2 decreases with the order, centred
+    # stencils have range order / 2
+    q = 0.1
+    errors = []
+    for order in [2, 4, 6]:
+        tb = discretize(kx**2, {'x'}, accuracy_order=order)
+        assert max(abs(d[0]) for d in tb) == order // 2
+        assert max(abs(d[0]) for d in
+                   discretize(kx, {'x'}, accuracy_order=order)) == order // 2
+        energy = sum(complex(v.subs(a, 1)) * np.exp(1j * q * d[0])
+                     for d, v in tb.items())
+        errors.append(abs(energy - q**2))
+    assert errors[0] > 100 * errors[1] > 100**2 * errors[2]
+
+    # operators in several factors keep the staggered stencils
+    tb = discretize(kx * A(x) * kx, {'x'}, accuracy_order=4)
+    assert max(abs(d[0]) for d in tb) == 3
+    assert A(x + 3*a/2) in tb[(3,)].atoms(sympy.Function)
+
+    hamiltonian = kx * A(x, y) * kx + ky**3 + kx**2 * ky
+    expected = discretize(hamiltonian, {'x', 'y'}, accuracy_order=4)
+    got = discretize(hamiltonian, {'x', 'y'}, accuracy_order=4,
+                     engine='shift')
+    assert set(got) == set(expected)
+    for offset, value in expected.items():
+        assert sympy.expand(got[offset] - value) == 0
+
+
+def test_discretize_anisotropic():
+    from discretizer.postprocessing import offset_to_direction
+
+    A = sympy.Function('A')
+    a = sympy.Symbol('a')
+    alpha = sympy.Symbol('alpha')
+    hamiltonian = sympy.Matrix([[kx * A(x, y) * kx + ky**2, alpha * ky],
+                                [alpha * ky, -kx**2]])
+
+    isotropic = discretize(hamiltonian, {'x', 'y'})
+    for kwargs in [{}, {'hermitian': True}, {'engine': 'shift'}]:
+        got = discretize(hamiltonian, {'x', 'y'}, anisotropic=True, **kwargs)
+        assert set(got) == set(isotropic)
+        for offset, value in got.items():
+            assert value.free_symbols.isdisjoint({a})
+            assert sympy.expand(value.subs({ax: a, ay: a}) -
+                                isotropic[offset]) == sympy.zeros(2, 2)
+
+    got = discretize(kx**2 + ky**2, {'x', 'y'}, anisotropic=True)
+    assert got[(0, 0)] == 2 / ax**2 + 2 / ay**2
+    assert got[(1, 0)] == -1 / ax**2
+    assert got[(0, -1)] == -1 / ay**2
+
+    got = discretize(A(x, y) * ky + ky**2, {'x', 'y'}, anisotropic=True)
+    got = offset_to_direction(got, {'x', 'y'}, anisotropic=True)
+    expected = -sympy.I * A(x, y - ay) / (2 * ay) - 1 / ay**2
+    assert sympy.expand(got[(0, -1)] - expected) == 0
@@ -0,0 +1,155 @@
+from __future__ import print_function, division
+
+import os
+import shutil
+import tempfile
+import numpy as np
+from nose.tools import assert_raises
+
+from discretizer.assembly import flood_fill
+from discretizer.assembly import grid_fill
+from discretizer.assembly import TagIndex
+from discretizer.assembly import assemble
+from discretizer.assembly import AffineHamiltonian
+from discretizer.assembly import bulk_hamiltonian
+from discretizer.assembly import iter_coo
+from discretizer.assembly import save_coo
+
+
+def test_flood_fill():
+    disk = lambda r: r[0]**2 + r[1]**2 <= 4
+    tags = flood_fill(disk, (0.1, -0.2), 1)
+    assert len(tags) == 13
+    assert np.all(np.sum(tags**2, axis=1) <= 4)
+    assert [tuple(t) for t in tags] == sorted(tuple(t) for t in tags)
+
+    tags = flood_fill(disk, (0, 0), 0.5)
+    assert len(tags) == 49
+
+    # disconnected parts are not reached
+    two_dots = lambda r: abs(r[0]) < 1 or abs(r[0] - 5) < 1
+    assert len(flood_fill(two_dots, (0,), 1)) == 1
+
+
+def test_grid_fill():
+    disk = lambda r: r[:, 0]**2 + r[:, 1]**2 <= 4
+    expected = flood_fill(lambda r: r[0]**2 + r[1]**2 <= 4, (0, 0), 0.5)
+    for chunk_size in [1, 7, 2**20]:
+        tags = grid_fill(disk, ((-3, -2), (2.9, 2)), 0.5, chunk_size)
+        assert np.all(tags == expected)
+
+    # anisotropic lattice, faces of the box included
+    box = lambda r: np.ones(len(r), dtype=bool)
+    tags = grid_fill(box, ((-1, -1), (1, 1)), (0.5, 1))
+    assert len(tags) == 5 * 3
+    assert tags[0].tolist() == [-2, -1] and tags[-1].tolist() == [2, 1]
+
+    # disconnected parts are found
+    two_dots = lambda r: (np.abs(r[:, 0]) < 1) | (np.abs(r[:, 0] - 5) < 1)
+    assert grid_fill(two_dots, ((-10,), (10,)), 1).ravel().tolist() == [0, 5]
+
+    assert_raises(ValueError, grid_fill, two_dots, ((2,), (3,)), 1)
+    assert_raises(ValueError, grid_fill, two_dots, ((0.2,), (0.8,)), 1)
+    assert_raises(ValueError, grid_fill, lambda r: True, ((0,), (3,)), 1)
+
+
+def test_tag_index():
+    tags = np.array([[0, 0], [0, 2], [1, -1], [3, 0]])
+    index = TagIndex(tags)
+    got = index(np.array([[3, 0], [0, 1], [0, 0], [1, -1], [9, 9]]))
+    assert np.all(got == [3, -1, 0, 2, -1])
+
+
+def test_assemble_chain():
+    onsite = lambda pos, p: np.full((len(pos), 1, 1), 2.0 + pos[:, 0, None, None])
+    hopping = lambda pos1, pos2, p: np.full((len(pos1), 1, 1), -1j)
+    tags = np.arange(4)[:, None]
+
+    got = assemble(onsite, {(1,): hopping}, tags, 0.5, None).toarray()
+    expected = (np.diag(2 + 0.5 * np.arange(4)) + np.diag([-1j] * 3, -1) +
+                np.diag([1j] * 3, 1))
+    assert np.allclose(got, expected)
+
+
+def test_affine_hamiltonian():
+    ones = lambda pos, p: np.ones((len(pos), 1, 1))
+    position = lambda pos, p: pos[:, 0, None, None].astype(complex)
+    hopping = lambda pos1, pos2, p: np.full((len(pos1), 1, 1), 1j)
+    tags = np.arange(3)[:, None]
+
+    coefficients = [lambda p: p[0], lambda p: p[1]]
+    terms = [(ones, {}), (position, {(1,): hopping})]
+    hamiltonian = AffineHamiltonian(coefficients, terms, tags, 1, None)
+
+    for params in [(1, 0), (0.5, 2)]:
+        expected = sum(c(params) * assemble(onsite, hoppings, tags, 1, None)
+                       for c, (onsite, hoppings) in zip(coefficients, terms))
+        assert np.allclose(hamiltonian(params).toarray(), expected.toarray())
+
+
+def test_flood_fill_anisotropic():
+    box = lambda r: abs(r[0]) <= 1 and abs(r[1]) <= 1
+    tags = flood_fill(box, (0, 0), (0.5, 1))
+    assert len(tags) == 5 * 3
+    assert np.all(np.abs(tags[:, 0]) <= 2) and np.all(np.abs(tags[:, 1]) <= 1)
+
+
+def test_bulk_hamiltonian():
+    onsite = lambda pos, p: 2.0 + pos[:, :1, None]
+    hopping = lambda pos1, pos2, p: np.full((len(pos1), 1, 1), -1j)
+    k = np.linspace(-np.pi, np.pi, 11)
+
+    # chain with lattice constant 0.5: 2 - 1j exp(-i k a) + 1j exp(i k a)
+    expected = 2 - 2 * np.sin(0.5 * k)
+    got = bulk_hamiltonian(onsite, {(1,): hopping}, k, 0.5, None)
+    assert got.shape == (11, 1, 1)
+    assert np.allclose(got[:, 0, 0], expected)
+
+    # reversed hoppings are used if given, the onsite at the position
+    reverse = lambda pos1, pos2, p: np.full((len(pos1), 1, 1), 1j)
+    got = bulk_hamiltonian(onsite, {(1,): hopping, (-1,): reverse}, k, 0.5,
+                           None, pos=[1])
+    assert np.allclose(got[:, 0, 0], expected + 1)
+
+    # anisotropic square lattice
+    hoppings = {(1, 0): lambda pos1, pos2, p: -np.ones((len(pos1), 1, 1)),
+                (0, 1): lambda pos1, pos2, p: -np.ones((len(pos1), 1, 1))}
+    k = np.random.rand(5, 2)
+    got = bulk_hamiltonian(onsite, hoppings, k, (0.5, 2), None)
+    expected = 2 - 2 * np.cos(0.5 * k[:, 0]) - 2 * np.cos(2 * k[:, 1])
+    assert np.allclose(got[:, 0, 0], expected)
+
+
+def test_streaming_assembly():
+    onsite = lambda pos, p: np.array([[[1, 0], [0, -1]]]) * pos[:, :1, None]
+    hopping = lambda pos1, pos2, p: np.full((len(pos1), 2, 2), 1 + 0.5j)
+    hoppings = {(1, 0): hopping, (0, 1): hopping, (2, 1): hopping}
+    disk = lambda r: r[:, 0]**2 + r[:, 1]**2 <= 9
+    bbox = ((-3, -3), (3, 3))
+
+    tags = grid_fill(disk, bbox, 0.5)
+    expected = assemble(onsite, hoppings, tags, 0.5, None).toarray()
+    for chunk_size in [1, 20, 2**20]:
+        got = np.zeros_like(expected)
+        for rows, cols, data in iter_coo(onsite, hoppings, disk, bbox, 0.5,
+                                         None, chunk_size):
+            np.add.at(got, (rows, cols), data)
+        assert np.allclose(got, expected)
+
+    path = tempfile.mkdtemp()
+    try:
+        prefix = os.path.join(path, 'hamiltonian')
+        rows, cols, data, positions, shape = save_coo(
+            prefix, onsite, hoppings, disk, bbox, 0.5, None, 20)
+        del rows, cols, data
+        assert shape == expected.shape
+        assert tuple(np.load(prefix + '_shape.npy')) == expected.shape
+        got = np.zeros_like(expected)
+        np.add.at(got, (np.load(prefix + '_rows.npy', mmap_mode='r'),
+                        np.load(prefix + '_cols.npy', mmap_mode='r')),
+                  np.load(prefix + '_data.npy', mmap_mode='r'))
+        assert np.allclose(got, expected)
+        assert np.allclose(positions, 0.5 * tags)
+        del positions
+    finally:
+        shutil.rmtree(path)
@@ -0,0 +1,199 @@
+from __future__ import print_function, division
+
+import os
+import shutil
+import tempfile
+
+import sympy
+from discretizer.algorithms import discretize
+from discretizer.cache import DiscretizationCache
+from discretizer.cache import encode_hamiltonian
+from discretizer.cache import decode_hamiltonian
+from discretizer.cache import lattice_constant_key
+from nose.tools import assert_raises
+
+
+kx, ky, kz = sympy.symbols('k_x k_y k_z', commutative=False)
+x, y, z = sympy.symbols('x y z', commutative=False)
+A = sympy.Function('A')
+
+
+def test_encode_hamiltonian():
+    tests = [
+        kx**2 + ky**2,
+        kx * A(x) * kx + sympy.Symbol('V'),
+        sympy.Matrix([[kx**2, sympy.I*ky], [-sympy.I*ky, A(x, y)]]),
+    ]
+    for inp in tests:
+        tb = discretize(inp, {'x', 'y'})
+        got = decode_hamiltonian(encode_hamiltonian(tb))
+        assert got == dict(tb), \
+            "Should be: {}. Not {}".format(dict(tb), got)
+
+
+def test_cache_key():
+    key = DiscretizationCache.key
+    assert key(kx**2, {'x'}, False, False) == key(kx**2, {'x'}, False, False)
+    assert key(kx**2, {'x'}, False, False) != key(kx**2, {'x'}, True, False)
+    assert key(kx**2, {'x'}, False, False) != key(ky**2, {'x'}, False, False)
+    assert key(kx**2, {'x', 'y'}, False, False) != \
+        key(kx**2, {'x'}, False, False)
+    assert key(kx**2, {'x'}, False, False, accuracy_order=2) != \
+        key(kx**2, {'x'}, False, False, accuracy_order=4)
+
+
+def test_cache_eviction():
+    path = tempfile.mkdtemp()
+    try:
+        cache = DiscretizationCache(path, max_size=100)
+        cache.store('first', {'data': 'a' * 60})
+        assert cache.load('first') == {'data': 'a' * 60}
+        cache.store('second', {'data': 'b' * 60})
+        assert cache.load('first') is None
+        assert cache.load('second') == {'data': 'b' * 60}
+        assert sorted(os.listdir(path)) == ['second.json']
+        cache.clear()
+        assert cache.load('second') is None
+
+        # a failed write leaves no partial files behind
+        assert_raises(TypeError, cache.store, 'third', {'data': object()})
+        assert os.listdir(path) == []
+    finally:
+        shutil.rmtree(path)
+
+
+def test_load_from_cache():
+    import subprocess
+    import sys
+    from types import SimpleNamespace
+
+    import numpy as np
+    from discretizer import Discretizer
+    from discretizer import DiscreteModel
+
+    path = tempfile.mkdtemp()
+    try:
+        tb = Discretizer(kx * A(x) * kx + ky**2, {'x', 'y'}, cache=path)
+        model = DiscreteModel.from_cache(tb.cache_key, cache=path)
+        assert set(model.vectorized_hoppings) == set(tb.vectorized_hoppings)
+
+        pos = np.array([[0., 1.], [2., 3.]])
+        p = SimpleNamespace(A=np.cos)
+        assert np.allclose(model.vectorized_onsite(pos, p),
+                           tb.vectorized_onsite(pos, p))
+        for d, f in tb.vectorized_hoppings.items():
+            assert np.allclose(model.vectorized_hoppings[d](pos, pos, p),
+                               f(pos, pos, p))
+
+        assert_raises(KeyError, DiscreteModel.from_cache, 'missing',
+                      cache=path)
+        assert_raises(KeyError, DiscreteModel.from_cache, tb.cache_key, 2,
+                      cache=path)
+        # value functions are found independently of the type of the lattice
+        # constant
+        assert DiscreteModel.from_cache(tb.cache_key, 1.0, cache=path)
+        assert lattice_constant_key((1, 2)) == lattice_constant_key([1., 2])
+
+        # loading of a cached model imports neither sympy nor kwant
+        code = ("import sys; from discretizer import DiscreteModel; "
+                "DiscreteModel.from_cache({!r}, cache={!r}); "
+                "print('sympy' in sys.modules, 'kwant' in sys.modules)")
+        output = subprocess.check_output(
+            [sys.executable, '-c', code.format(tb.cache_key, path)])
+        assert output.split() == [b'False', b'False']
+    finally:
+        shutil.rmtree(path)
+
+
+def test_lazy_submodules():
+    import discretizer
+    from discretizer import algorithms
+
+    assert discretizer.algorithms is algorithms
+    assert discretizer.cache.DiscretizationCache is DiscretizationCache
+    assert_raises(AttributeError, getattr, discretizer, 'missing')
+
+
+def test_load_numba_entry():
+    import subprocess
+    import sys
+    from unittest import SkipTest
+
+    from discretizer import Discretizer
+    from discretizer import DiscreteModel
+    from discretizer.functions import NumbaFunction
+
+    try:
+        import numba
+    except ImportError:
+        raise SkipTest('Numba is not available.')
+
+    path = tempfile.mkdtemp()
+    try:
+        tb = Discretizer(kx * A(x) * kx + ky**2, {'x', 'y'}, cache=path,
+                         backend='numba')
+        model = DiscreteModel.from_cache(tb.cache_key, cache=path,
+                                         backend='numba')
+        assert isinstance(model.vectorized_onsite, NumbaFunction)
+
+        # kernels stored in the entry are used only with backend='numba'
+        code = ("import sys, numpy as np; from types import SimpleNamespace; "
+                "from discretizer import DiscreteModel; "
+                "m = DiscreteModel.from_cache({!r}, cache={!r}); "
+                "m.vectorized_onsite(np.zeros((2, 2)), "
+                "SimpleNamespace(A=np.cos)); "
+                "print('numba' in sys.modules)")
+        output = subprocess.check_output(
+            [sys.executable, '-c', code.format(tb.cache_key, path)])
+        assert output.split() == [b'False']
+    finally:
+        shutil.rmtree(path)
+
+
+def test_export():
+    import importlib
+    import subprocess
+    import sys
+    from types import SimpleNamespace
+
+    import numpy as np
+    from discretizer import Discretizer
+
+    path = tempfile.mkdtemp()
+    try:
+        hamiltonian = sympy.Matrix([[kx * A(x) * kx + ky**2, kx * ky],
+                                    [ky * kx, sympy.Symbol('B')]])
+        tb = Discretizer(hamiltonian, {'x', 'y'}, lattice_constant=(0.5, 2))
+        tb.export(os.path.join(path, 'exported_model.py'))
+
+        sys.path.insert(0, path)
+        try:
+            module = importlib.import_module('exported_model')
+        finally:
+            sys.path.remove(path)
+            sys.modules.pop('exported_model', None)
+
+        assert module.discrete_coordinates == {'x', 'y'}
+        assert module.lattice_constant == (0.5, 2)
+        assert np.allclose(module.lattice_vectors, np.diag([0.5, 2]))
+        assert set(module.hopping_directions) == set(tb.vectorized_hoppings)
+        assert set(module.hoppings) == set(tb.vectorized_hoppings)
+
+        pos = np.array([[0., 1.], [2., 3.]])
+        p = SimpleNamespace(A=np.cos, B=0.5)
+        assert np.allclose(module.vectorized_onsite(pos, p),
+                           tb.vectorized_onsite(pos, p))
+        for d, f in tb.vectorized_hoppings.items():
+            assert np.allclose(module.vectorized_hoppings[d](pos, pos, p),
+                               f(pos, pos, p))
+        assert np.allclose(module.hoppings[(0, 1)],
+                           tb._direction_hoppings[(0, 1)])
+
+        # importing the module does not import sympy
+        code = ("import sys; sys.path.insert(0, {!r}); import exported_model; "
+                "print('sympy' in sys.modules)")
+        output = subprocess.check_output([sys.executable, '-c',
+                                          code.format(path)])
+        assert output.split() == [b'False']
+    finally:
+        shutil.rmtree(path)
@@ -5,6 +5,7 @@ import discretizer
 from discretizer.algorithms import wavefunction_name
 from discretizer.algorithms import read_hopping_from_wf
 from discretizer.algorithms import extract_hoppings
+from discretizer.algorithms import shorten_hoppings
 
 from nose.tools import raises
 from nose.tools import assert_raises
@@ -61,11 +62,26 @@ def test_test_read_hoppings_from_wf_ValueError():
         wf(x, x),
         wf(x, ax),
         wf(y, A),
+        wf(x + ax**2),
+        wf(x + ax*ay),
+        wf(x + sympy.Symbol('n')*ax),
+        wf(sympy.Float(0.5)*ax + x),
     }
     for inp in tests:
         assert_raises(ValueError, read_hopping_from_wf, inp)
 
 
+def test_read_hoppings_from_wf_rational():
+    half = sympy.Rational(1, 2)
+    got = read_hopping_from_wf(wf(x + ax/2, y - 3*ay/2))
+    assert got == (half, -3*half)
+    assert all(isinstance(i, sympy.Rational) for i in got)
+
+    got = read_hopping_from_wf(wf(x + 4*ax/2, y))
+    assert got == (2, 0)
+    assert all(type(i) is int for i in got)
+
+
 def test_test_read_hoppings_from_wf_TypeError():
     tests = {
         wf(x,y,z) + A,
@@ -127,3 +143,28 @@ def test_extract_hoppings():
             out = sympy.sympify(test_out[key], locals=ns)
             assert sympy.simplify(sympy.expand(got - out)) == 0, \
                 "Should be: extract_hoppings({})=={}. Not {}".format(inp, test_out, result)
+
+
+def test_extract_hoppings_ValueError():
+    tests = [
+        'A*Psi(x, y)*B',
+        'Psi(x, y) + A',
+    ]
+    for inp in tests:
+        inp = sympy.sympify(inp, locals=ns)
+        assert_raises(ValueError, extract_hoppings, inp, {'x', 'y'})
+
+
+def test_shorten_hoppings():
+    a = sympy.Symbol('a')
+    half = sympy.Rational(1, 2)
+    tests = [
+        ({(-2, 0): 1/ax, (0, 0): ay}, {'x', 'y'}, {(-1, 0): 2/a, (0, 0): a}),
+        ({(2, 3): ax*ay, (4, -3): 1}, {'x', 'y'},
+         {(1, 1): a**2/6, (2, -1): 1}),
+        ({(half,): ax, (-half,): ax}, {'x'}, {(1,): 2*a, (-1,): 2*a}),
+    ]
+    for inp, coords, out in tests:
+        got = shorten_hoppings(inp, coords)
+        assert got == out, \
+            "Should be: shorten_hoppings({})=={}. Not {}".format(inp, out, got)
@@ -0,0 +1,45 @@
+from __future__ import print_function, division
+
+import sympy
+from discretizer.algorithms import discretize
+from discretizer.interpolation import interpolate_tb_hamiltonian
+
+
+kx, ky = sympy.symbols('k_x k_y', commutative=False)
+x, y = sympy.symbols('x y', commutative=False)
+a, a_x = sympy.symbols('a a_x')
+A = sympy.Function('A')
+B = sympy.Function('B')
+
+
+def test_interpolate_half_offsets():
+    tests = {
+        A(x + a/2): (A(x) + A(x + a)) / 2,
+        A(x - a/2): (A(x) + A(x - a)) / 2,
+        A(x + 3*a/2): (A(x + a) + A(x + 2*a)) / 2,
+        A(x + a/3): 2*A(x)/3 + A(x + a)/3,
+        A(x + a_x/2): (A(x) + A(x + a_x)) / 2,
+        A(x + a): A(x + a),
+        A(x + a/2, y + a/2): (A(x, y) + A(x + a, y) + A(x, y + a) +
+                              A(x + a, y + a)) / 4,
+        sympy.sin(B(x + a/2)) * A(x - a/2)**2 / a**2:
+            sympy.sin((B(x) + B(x + a)) / 2) *
+            ((A(x) + A(x - a)) / 2)**2 / a**2,
+    }
+    for inp, out in tests.items():
+        got = interpolate_tb_hamiltonian({(0,): inp})[(0,)]
+        assert sympy.expand(got - out) == 0, \
+            "Should be: {}. Not {}".format(out, got)
+
+
+def test_interpolate_matrix():
+    tb = discretize(sympy.Matrix([[kx * A(x) * kx, ky * B(y) * kx],
+                                  [kx * B(y) * ky, ky**2]]), {'x', 'y'})
+    interpolated = interpolate_tb_hamiltonian(tb)
+    assert set(interpolated) == set(tb)
+
+    for value in interpolated.values():
+        for element in value:
+            for f in element.atoms(sympy.Function):
+                for arg in f.args:
+                    assert sympy.expand(arg).coeff(a).is_Integer, f
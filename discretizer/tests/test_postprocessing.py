@@ -0,0 +1,345 @@
+from __future__ import print_function, division
+
+import sympy
+import numpy as np
+from collections import namedtuple
+from nose.tools import assert_raises
+
+from discretizer.postprocessing import make_kwant_functions
+from discretizer.postprocessing import make_function_lines
+from discretizer.postprocessing import affine_decomposition
+from discretizer.postprocessing import make_parameter_function
+from discretizer.postprocessing import function_axes
+from discretizer.functions import compile_functions
+from discretizer.functions import ParameterCachedFunction
+from discretizer.functions import SiteParameterCache
+
+
+x, y = sympy.symbols('x y', commutative=False)
+A = sympy.Function('A')
+B, a = sympy.symbols('B a')
+
+par = namedtuple('par', 'A B')(A=lambda x, y: 1 + x**2 - y, B=0.5)
+
+
+class _Site(object):
+    def __init__(self, pos):
+        self.pos = pos
+
+
+def _scalar_values(f, positions, onsite=True):
+    if onsite:
+        values = [f(_Site(r), par) for r in positions]
+    else:
+        values = [f(_Site(r + 1), _Site(r), par) for r in positions]
+    return np.array([np.atleast_2d(v) for v in values])
+
+
+def test_vectorized_functions():
+    tests = [
+        {
+            (0, 0): 4*A(x, y) + B,
+            (1, 0): -A(x + a/2, y),
+        },
+        {
+            (0, 0): sympy.Matrix([[B*A(x, y), sympy.I*B], [-sympy.I*B, 1]]),
+            (0, 1): sympy.Matrix([[-A(x, y + a/2), 0], [B, x]]),
+        },
+    ]
+    positions = np.random.rand(10, 2)
+    for test in tests:
+        test = {k: v.subs(a, 1) for k, v in test.items()}
+        scalar = make_kwant_functions(test, {'x', 'y'})
+        vectorized = make_kwant_functions(test, {'x', 'y'}, vectorized=True)
+
+        for offset, f in scalar.items():
+            onsite = offset == (0, 0)
+            expected = _scalar_values(f, positions, onsite)
+            if onsite:
+                got = vectorized[offset](positions, par)
+            else:
+                got = vectorized[offset](positions + 1, positions, par)
+            assert got.shape == expected.shape
+            assert np.allclose(got, expected), \
+                "Vectorized function for {} differs.".format(offset)
+
+
+def test_common_subexpressions():
+    calls = []
+
+    def f(x, y):
+        calls.append((x, y))
+        return x + y
+
+    p = namedtuple('par', 'A B')(A=f, B=0.5)
+    hamiltonian = {(0, 0): sympy.Matrix([[A(x, y) * B, A(x, y)],
+                                         [A(x, y), A(x + 1, y)**2]])}
+
+    for vectorized in [False, True]:
+        for cse in [True, False]:
+            del calls[:]
+            lines = make_function_lines(hamiltonian, {'x', 'y'},
+                                        vectorized=vectorized, cse=cse)
+            onsite = compile_functions(lines, vectorized=vectorized)[(0, 0)]
+            if vectorized:
+                got = onsite(np.array([[1., 2.]]), p)[0]
+            else:
+                got = onsite(_Site(np.array([1., 2.])), p)
+            assert np.allclose(got, [[1.5, 3], [3, 16]])
+            assert len(calls) == (2 if cse else 4)
+
+
+def test_constant_functions():
+    hamiltonian = {
+        (0, 0): sympy.Matrix([[4, sympy.I], [-sympy.I, 4]]),
+        (1, 0): sympy.Matrix([[-B, 0], [0, B**2]]),
+        (0, 1): sympy.Matrix([[-1, 0], [0, x]]),
+    }
+    functions = make_kwant_functions(hamiltonian, {'x', 'y'})
+
+    onsite = functions[(0, 0)]
+    assert not callable(onsite)
+    assert np.allclose(onsite, [[4, 1j], [-1j, 4]])
+
+    hopping = functions[(1, 0)]
+    assert isinstance(hopping, ParameterCachedFunction)
+    site = _Site(np.array([0., 0.]))
+    first = hopping(site, site, par)
+    assert np.allclose(first, [[-0.5, 0], [0, 0.25]])
+    assert hopping(site, site, par) is first
+    other = namedtuple('par', 'A B')(A=None, B=2)
+    assert np.allclose(hopping(site, site, other), [[-2, 0], [0, 4]])
+
+    assert not isinstance(functions[(0, 1)], ParameterCachedFunction)
+
+
+def test_affine_decomposition():
+    V, g = sympy.symbols('V g')
+    hamiltonian = {
+        (0, 0): sympy.Matrix([[V + 2*g*A(x, y), 3], [3, V*g**2 - 1]]),
+        (1, 0): -A(x + a/2, y) * g,
+    }
+    got = affine_decomposition(hamiltonian, ['V', 'g'])
+    assert set(got) == {1, V, g, V*g**2}
+    assert got[1][(0, 0)] == sympy.Matrix([[0, 3], [3, -1]])
+    assert got[V][(0, 0)] == sympy.Matrix([[1, 0], [0, 0]])
+    assert got[g][(0, 0)] == sympy.Matrix([[2*A(x, y), 0], [0, 0]])
+    assert got[g][(1, 0)] == -A(x + a/2, y)
+    assert (1, 0) not in got[V]
+
+    f = make_parameter_function(V*g**2)
+    assert f(namedtuple('par', 'V g')(V=2, g=3)) == 18
+
+    assert_raises(ValueError, affine_decomposition,
+                  {(0, 0): A(x - V, y)}, ['V'])
+    assert_raises(ValueError, affine_decomposition,
+                  {(0, 0): sympy.sqrt(V + x)}, ['V'])
+
+
+def test_site_parameter_cache():
+    calls = []
+
+    def f(x, y):
+        calls.append(np.size(x))
+        return x + 10 * y
+
+    cache = SiteParameterCache((0.5, 2), 2)
+    g = cache.bind('f', f, (0, 1))
+    assert cache.bind('f', f, (0, 1)) is g
+
+    # values at sites and (multi)linear interpolation between them
+    assert g(0.5, 2) == 20.5
+    assert np.isclose(g(0.25, 2), 20.25)
+    assert np.isclose(g(0.25, 1), (0 + 0.5 + 20 + 20.5) / 4)
+    assert len(calls) == 4
+
+    # arrays use stored values and evaluate only new sites, in bulk
+    del calls[:]
+    got = g(np.array([0.25, 0.5, 1.5]), np.array([2., 1., 2.]))
+    assert np.allclose(got, [20.25, 10.5, 21.5])
+    assert calls == [1]
+
+    # a different function under the same name discards stored values
+    h = cache.bind('f', lambda x, y: x, (0, 1))
+    assert h is not g and h(0.25, 0) == 0.25
+    cache.clear()
+    assert cache.bind('f', f, (0, 1)) is not g
+
+
+def test_site_parameter_functions():
+    hamiltonian = {
+        (0, 0): sympy.Matrix([[4*A(x, y) + B, A(x, y)], [A(x, y), B]]),
+        (1, 0): sympy.Matrix([[-A(x + a/2, y), 0], [0, -A(x + a/2, y)]]),
+    }
+    assert function_axes(hamiltonian, {'x', 'y'}) == {'A': (0, 1)}
+    assert function_axes(hamiltonian, {'y', 'x', 'z'}) == {'A': (0, 1)}
+    assert_raises(ValueError, function_axes, {(0,): A(x * y)}, {'x', 'y'})
+    assert_raises(ValueError, function_axes, hamiltonian, {'x'})
+    assert_raises(ValueError, function_axes,
+                  {(0,): A(x, y) + A(y, x)}, {'x', 'y'})
+
+    tb = {k: v.subs(a, 1) for k, v in hamiltonian.items()}
+    calls = []
+    p = namedtuple('par', 'A B')(
+        A=lambda x, y: calls.append(np.size(x)) or 1 + x**2 - y, B=0.5)
+    positions = np.array([[0., 0.], [1., 0.], [2., 0.], [0., 1.]])
+
+    cache = SiteParameterCache(1, 2)
+    functions = make_kwant_functions(tb, {'x', 'y'}, vectorized=True,
+                                     site_parameters=cache)
+    onsite = functions[(0, 0)](positions, p)
+    hopping = functions[(1, 0)](positions + [1, 0], positions, p)
+
+    values = p.A(*positions.T)
+    shifted = p.A(*(positions + [1, 0]).T)
+    assert np.allclose(onsite[:, 0, 0], 4 * values + 0.5)
+    assert np.allclose(hopping[:, 0, 0], -(values + shifted) / 2)
+    # every site is evaluated once, for all functions
+    assert calls[:2] == [4, 2]
+
+    scalar = make_kwant_functions(tb, {'x', 'y'}, site_parameters=cache)
+    assert np.allclose(_scalar_values(scalar[(1, 0)], positions, False),
+                       hopping)
+
+
+def test_grid_parameter():
+    from discretizer import GridParameter
+
+    values = np.arange(12.).reshape(3, 4)
+    grid = GridParameter(values, origin=(-1, 0), spacing=(0.5, 2))
+
+    # grid points are indexed directly, also in bulk
+    assert grid(-1, 0) == 0 and grid(-0.5, 6) == 7
+    xs, ys = np.array([-1, -0.5, 0]), np.array([2., 4., 6.])
+    assert np.array_equal(grid(xs, ys), [1, 6, 11])
+    assert np.array_equal(grid(xs[:, None], ys[None, :]), values[:, 1:])
+
+    # linear interpolation between grid points
+    assert np.isclose(grid(-0.75, 0), 2)
+    assert np.isclose(grid(-0.75, 1), 2.5)
+    assert np.allclose(grid(xs[:2] + 0.25, 3), [3.5, 7.5])
+
+    assert_raises(ValueError, grid, 0.25, 0)
+    assert_raises(ValueError, grid, xs, -ys)
+    assert_raises(TypeError, grid, 0)
+    clipped = GridParameter(values, origin=(-1, 0), spacing=(0.5, 2),
+                            clip=True)
+    assert clipped(0.25, -2) == 8
+
+    # grid parameters are not wrapped by the site cache
+    cache = SiteParameterCache(0.5, 2)
+    assert cache.bind('A', grid, (0, 1)) is grid
+
+    tb = {(0, 0): 4*A(x, y) + B, (1, 0): -A(x + a/2, y)}
+    tb = {k: v.subs(a, 0.5) for k, v in tb.items()}
+    positions = np.array([[-1, 0], [-1, 2], [-0.5, 2]])
+    p = namedtuple('par', 'A B')(A=grid, B=0.5)
+    functions = make_kwant_functions(tb, {'x', 'y'}, vectorized=True)
+    onsite = functions[(0, 0)](positions, p)
+    hopping = functions[(1, 0)](positions + [0.5, 0], positions, p)
+    assert np.allclose(onsite[:, 0, 0], 4 * values[[0, 0, 1], [0, 1, 1]] + 0.5)
+    assert np.allclose(hopping[:, 0, 0], [-2, -3, -7])
+
+
+def test_numba_kernels():
+    import warnings
+    from types import SimpleNamespace
+    from unittest import SkipTest
+    from discretizer import GridParameter
+    from discretizer.postprocessing import make_kernel_lines
+    from discretizer.functions import compile_kernels
+    from discretizer.functions import NumbaFunction
+
+    try:
+        import numba
+    except ImportError:
+        raise SkipTest('Numba is not available.')
+
+    tb = {
+        (0, 0): sympy.Matrix([[4*A(x, y) + B, sympy.I*B], [-sympy.I*B, x]]),
+        (1, 0): sympy.Matrix([[-A(x + a/2, y), 0], [0, -1]]),
+        (0, 1): sympy.Matrix([[B, 0], [0, -1]]),
+    }
+    tb = {k: v.subs(a, 1) for k, v in tb.items()}
+    coords = {'x', 'y'}
+    function_lines = make_function_lines(tb, coords)
+    scalar = compile_functions(function_lines)
+    vectorized = make_kwant_functions(tb, coords, vectorized=True)
+    python_scalar, python_vectorized = dict(scalar), dict(vectorized)
+    compile_kernels(function_lines, make_kernel_lines(tb, coords), scalar,
+                    vectorized)
+
+    assert not isinstance(scalar[(0, 1)], NumbaFunction)
+    assert all(isinstance(f, NumbaFunction) for f in vectorized.values())
+
+    positions = np.random.rand(10, 2)
+    values = np.arange(25.).reshape(5, 5)
+    def A_function(x, y):
+        return 1 + x**2 - y
+
+    for A_value in [A_function, GridParameter(values, origin=(-1, -1), spacing=1),
+                    lambda x, y: SimpleNamespace(value=x).value]:
+        p = SimpleNamespace(A=A_value, B=0.5)
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            for offset in [(0, 0), (1, 0)]:
+                f, g = scalar[offset], python_scalar[offset]
+                onsite = offset == (0, 0)
+                args = ([positions] if onsite else
+                        [positions + [1, 0], positions])
+                assert np.allclose(vectorized[offset](*args, p),
+                                   python_vectorized[offset](*args, p))
+                for r in positions:
+                    sites = ([_Site(r)] if onsite else
+                             [_Site(r + [1, 0]), _Site(r)])
+                    assert np.allclose(f(*sites, p), g(*sites, p))
+        # a function that Numba can not compile falls back to Python
+        fallback = getattr(A_value, '__name__', '') == '<lambda>'
+        assert len(w) == (2 if fallback else 0)
+
+    # the failure is stored only for the parameter functions that caused it
+    kernel = vectorized[(0, 0)].kernel
+    p = SimpleNamespace(A=A_function, B=0.5)
+    assert kernel(positions, p) is not None
+    assert kernel(positions, SimpleNamespace(A=A_value, B=0.5)) is None
+    assert [k is None for k, _ in kernel._kernels.values()].count(True) == 1
+
+
+def test_pickle_value_functions():
+    import inspect
+    import pickle
+
+    tb = {
+        (0, 0): sympy.Matrix([[4*A(x, y) + B, 1], [1, B]]),
+        (1, 0): sympy.Matrix([[-A(x + a/2, y), 0], [0, -B]]),
+    }
+    tb = {k: v.subs(a, 1) for k, v in tb.items()}
+    p = namedtuple('par', 'A B')(A=np.hypot, B=0.5)
+    positions = np.random.rand(10, 2)
+
+    for site_parameters in [None, SiteParameterCache(1, 2)]:
+        scalar = make_kwant_functions(tb, {'x', 'y'},
+                                      site_parameters=site_parameters)
+        vectorized = make_kwant_functions(tb, {'x', 'y'}, vectorized=True,
+                                          site_parameters=site_parameters)
+        assert list(inspect.signature(scalar[(0, 0)]).parameters) == \
+            ['site', 'p']
+        assert list(inspect.signature(vectorized[(1, 0)]).parameters) == \
+            ['pos1', 'pos2', 'p']
+
+        got = pickle.loads(pickle.dumps((scalar, vectorized)))
+        for offset in tb:
+            expected = _scalar_values(scalar[offset], positions,
+                                      offset == (0, 0))
+            assert np.allclose(_scalar_values(got[0][offset], positions,
+                                              offset == (0, 0)), expected)
+        assert np.allclose(got[1][(1, 0)](positions + [1, 0], positions, p),
+                           vectorized[(1, 0)](positions + [1, 0], positions,
+                                              p))
+        if site_parameters is not None:
+            # functions of a model still share a single cache
+            assert (got[0][(0, 0)].site_parameters is
+                    got[1][(1, 0)].site_parameters)
+
+    f = pickle.loads(pickle.dumps(make_parameter_function(2 * B)))
+    assert f(p) == 1
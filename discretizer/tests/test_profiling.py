@@ -0,0 +1,68 @@
+from __future__ import print_function, division
+
+import sympy
+from discretizer import Discretizer
+from discretizer import momentum_operators, coordinates
+from discretizer.algorithms import discretize
+from discretizer.profiling import DiscretizationStats
+from discretizer.profiling import ElementStats
+from discretizer.profiling import StageStats
+
+
+kx, ky, kz = momentum_operators
+x, y, z = coordinates
+A = sympy.Function('A')
+hamiltonian = sympy.Matrix([[kx * A(x) * kx, ky * kx],
+                            [kx * ky, ky**2 + A(x)]])
+
+
+def test_discretize_stats():
+    from concurrent.futures import ThreadPoolExecutor
+
+    stats = DiscretizationStats()
+    discretize(hamiltonian, {'x', 'y'}, stats=stats)
+    assert [e.index for e in stats.elements] == [(0, 0), (0, 1), (1, 0),
+                                                 (1, 1)]
+    element = stats.elements[0]
+    assert element.summands == 1
+    assert element.hoppings == 3
+    assert element.input_size > 0 and element.output_size > 0
+    assert element.time >= element.derivation_time + element.shortening_time
+
+    parallel = DiscretizationStats()
+    with ThreadPoolExecutor(2) as executor:
+        discretize(hamiltonian, {'x', 'y'}, stats=parallel, n_jobs=2,
+                   executor=executor)
+    assert ([e.index for e in parallel.elements] ==
+            [e.index for e in stats.elements])
+
+    scalar = DiscretizationStats()
+    discretize(kx * A(x) * kx, {'x'}, stats=scalar)
+    assert [e.index for e in scalar.elements] == [()]
+
+
+def test_discretizer_profile():
+    assert Discretizer(hamiltonian, {'x', 'y'}).stats is None
+
+    records = []
+    tb = Discretizer(hamiltonian, {'x', 'y'}, interpolate=True,
+                     profile=records.append)
+    stats = tb.stats
+
+    for name in ['discretize', 'offset_to_direction', 'interpolate',
+                 'substitute', 'codegen', 'codegen_vectorized', 'compile',
+                 'compile_vectorized']:
+        assert name in stats.stages
+        assert stats.stages[name].time >= 0
+    assert stats.stages['discretize'].info['hoppings'] == 9
+    assert len(stats.elements) == 4
+    assert set(stats.functions) == set(tb.symbolic_hamiltonian)
+    assert all(f['lines'] > 0 for f in stats.functions.values())
+    assert abs(stats.total_time -
+               sum(s.time for s in stats.stages.values())) < 1e-12
+
+    assert [r for r in records if isinstance(r, StageStats)] == \
+        list(stats.stages.values())
+    assert [r for r in records if isinstance(r, ElementStats)] == \
+        stats.elements
+    assert 'discretize' in stats.report()
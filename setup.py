@@ -8,5 +8,6 @@ setup(name='discretizer',
     #   author_email='',
       license='BSD 2-clause',
       packages=['discretizer'],
-      install_requires=['sympy', 'numpy'],
+      install_requires=['sympy', 'numpy', 'scipy'],
+      python_requires='>=3.7',
       zip_safe=False)